@@ -1,12 +1,78 @@
-from flask import Flask
+from flask import Flask, jsonify, request
 from model.erboh import ERBOH
+from model.cache import model_cache
+from model.jobs import job_queue, read_status, JOB_KINDS
 
 from totoml.controller import ModelController
 from totoml.config import ControllerConfig
+from totoml.cid import cid
 
 app = Flask(__name__)
 
-model_controller = ModelController(ERBOH(), app, ControllerConfig(enable_batch_predictions_events=True, enable_single_prediction_events=True))
+class JobModelController(ModelController): 
+    """
+    Model controller that runs the trainings, scorings and batch predictions as background jobs (see model/jobs.py): 
+    the train and predict-batch events and GET /score submit a job instead of running it in the process serving the online predictions
+    """
+
+    def train(self, request=None): 
+        correlation_id = request['correlationId'] if request is not None and 'correlationId' in request else cid()
+
+        return {"jobId": job_queue.submit('train', self.model, correlation_id=correlation_id)}
+
+    def score(self, request=None): 
+        correlation_id = request.headers['x-correlation-id'] if request is not None and 'x-correlation-id' in request.headers else cid()
+
+        return {"jobId": job_queue.submit('score', self.model, correlation_id=correlation_id)}
+
+    def predict_batch(self, data=None): 
+        correlation_id = data['correlationId'] if data is not None and 'correlationId' in data else cid()
+
+        return {"jobId": job_queue.submit('predict-batch', self.model, data=data, correlation_id=correlation_id)}
+
+model_controller = JobModelController(ERBOH(), app, ControllerConfig(enable_batch_predictions_events=True, enable_single_prediction_events=True))
+
+# Warm up the model cache, so that the first prediction doesn't have to load the model
+model_cache.get(model_controller.model)
+
+# The jobs left behind by a previous run of the service (e.g. a batch prediction interrupted by a restart)
+job_queue.resume(model_controller.model)
+
+@app.route('/modelcache', methods=['GET'])
+def model_cache_stats(): 
+    return jsonify(model_cache.stats())
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_job(kind): 
+    '''
+    Runs a batch prediction (predict-batch), a training (train) or a scoring (score) in the background. 
+    Returns the id of the job, to follow it on GET /jobs/<job_id>
+    '''
+    if kind not in JOB_KINDS: 
+        resp = jsonify({"message": "Job {k} not supported. Supported jobs: {s}".format(k=kind, s=JOB_KINDS)})
+        resp.status_code = 400
+        return resp
+
+    job_id = job_queue.submit(kind, model_controller.model, data=request.get_json(silent=True), correlation_id=request.headers.get('x-correlation-id'))
+
+    resp = jsonify({"jobId": job_id})
+    resp.status_code = 202
+
+    return resp
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id): 
+    '''
+    Returns the status of a job: queued, running, done or failed, the pipeline stages it went through and its result
+    '''
+    status = read_status(job_id)
+
+    if status is None: 
+        resp = jsonify({"message": "Job {j} not found".format(j=job_id)})
+        resp.status_code = 404
+        return resp
+
+    return jsonify(status)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
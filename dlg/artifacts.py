@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import glob
+import shutil
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from toto_logger.logger import TotoLogger
+
+# Parquet support is optional: it requires pyarrow
+try: 
+    import pyarrow.parquet as pq
+except ImportError: 
+    pq = None
+
+logger = TotoLogger()
+
+# Formats of the files (history, features, predictions, ...):
+# - parquet: columnar, typed, memory-mapped and column-selective reads (requires pyarrow)
+# - npz:     a single NumPy file with one array per column and the schema, column-selective reads
+# - csv:     plain CSV, kept as an export format
+ARTIFACTS_FORMATS = ['parquet', 'npz', 'csv']
+
+# How the debug artifacts (history, features, predictions) are written:
+# - sync:  written on the request path and returned to Toto ML (that deletes them once done)
+# - async: written by a background thread, off the request path, and kept on disk for a while (see sweep_artifacts())
+# - none:  not written at all
+ARTIFACTS_MODES = ['sync', 'async', 'none']
+
+# File marking the folders written asynchronously: they're deleted by sweep_artifacts() once old enough
+ASYNC_MARKER = '.async'
+
+def artifacts_format(): 
+    '''
+    Returns the format of the files: the TOTO_ARTIFACTS_FORMAT environment variable, 
+    or parquet if pyarrow is installed, npz otherwise
+    '''
+    default_format = 'parquet' if pq is not None else 'npz'
+
+    artifact_format = os.environ.get('TOTO_ARTIFACTS_FORMAT', default_format)
+
+    if artifact_format not in ARTIFACTS_FORMATS: 
+        raise ValueError('Artifacts format {f} not supported. Supported formats: {s}'.format(f=artifact_format, s=ARTIFACTS_FORMATS))
+
+    return artifact_format
+
+def write_npz(df, filename): 
+    '''
+    Writes a data frame as a single (uncompressed) .npz file, with one array per column and a schema describing the columns. 
+    Object columns are stored as fixed-width unicode (with a null mask), or as float (1, 0, NaN) when they only hold booleans and nulls. 
+    Categorical columns are stored as their values
+    '''
+    arrays = {}
+    schema = []
+
+    for i, column in enumerate(df.columns): 
+
+        values = df[column]
+        kind = 'native'
+
+        if isinstance(values.dtype, pd.CategoricalDtype): 
+            values = values.astype(object)
+
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype): 
+            nulls = values.isnull().to_numpy()
+
+            if values[~nulls].map(lambda x : isinstance(x, (bool, np.bool_))).all(): 
+                kind = 'bool'
+                data = np.where(nulls, np.nan, values.fillna(False).astype(bool).to_numpy(dtype=np.float64))
+            else: 
+                kind = 'str'
+                data = values.fillna('').astype(str).to_numpy(dtype=str)
+                arrays['{i}.mask'.format(i=i)] = nulls
+        else: 
+            data = values.to_numpy()
+
+        arrays[str(i)] = data
+
+        schema.append({"name": str(column), "kind": kind})
+
+    arrays['schema'] = np.array(json.dumps({"columns": schema, "rows": len(df)}))
+
+    # Written to the file object: np.savez() would add the extension to a filename
+    with open(filename, 'wb') as npz_file: 
+        np.savez(npz_file, **arrays)
+
+def read_npz(filename, columns=None): 
+    '''
+    Reads a data frame written by write_npz(). Only the arrays of the columns that are read are loaded
+    '''
+    with np.load(filename) as npz: 
+        schema = json.loads(str(npz['schema']))
+
+        data = {}
+
+        for i, column in enumerate(schema['columns']): 
+
+            if columns is not None and column['name'] not in columns: 
+                continue
+
+            values = npz[str(i)]
+
+            if column['kind'] == 'bool': 
+                known = ~np.isnan(values)
+                decoded = np.full(len(values), np.nan, dtype=object)
+                decoded[known] = values[known] == 1
+                values = decoded
+            elif column['kind'] == 'str': 
+                nulls = npz['{i}.mask'.format(i=i)]
+                values = values.astype(object)
+                values[nulls] = np.nan
+
+            data[column['name']] = values
+
+    return pd.DataFrame(data, index=pd.RangeIndex(schema['rows']))
+
+def artifact_filename(name, artifact_format=None): 
+    '''
+    Returns the filename of an artifact (e.g. '{folder}/features.all') in the specified format (default: artifacts_format())
+    '''
+    if artifact_format is None: 
+        artifact_format = artifacts_format()
+
+    return '{name}.{ext}'.format(name=name, ext=artifact_format)
+
+def write_artifact(df, name, artifact_format=None): 
+    """
+    Writes a data frame to file
+
+    Parameters
+    ----------
+    df (DataFrame)
+        The data frame to write
+
+    name (string)
+        The path of the file, without extension (e.g. '{folder}/features.all')
+
+    artifact_format (string, default None)
+        One of ARTIFACTS_FORMATS. Defaults to artifacts_format()
+
+    Returns
+    -------
+    filename (string)
+        The path of the file, with the extension of the format
+    """
+    if artifact_format is None: 
+        artifact_format = artifacts_format()
+
+    filename = artifact_filename(name, artifact_format)
+
+    if artifact_format == 'parquet': 
+        df.to_parquet(filename, index=False)
+    elif artifact_format == 'npz': 
+        write_npz(df, filename)
+    else: 
+        df.to_csv(filename)
+
+    return filename
+
+def read_artifact(filename, columns=None): 
+    """
+    Reads a data frame written by write_artifact() (the format is given by the extension)
+
+    Parameters
+    ----------
+    filename (string)
+        The file to read
+
+    columns (list, default None)
+        The columns to read. Columns that are not in the file are ignored. Default: all the columns
+    """
+    if filename.endswith('.parquet'): 
+        if columns is not None: 
+            columns = [c for c in pq.read_schema(filename).names if c in columns]
+
+        return pd.read_parquet(filename, columns=columns, memory_map=True)
+
+    if filename.endswith('.npz'): 
+        return read_npz(filename, columns)
+
+    if columns is not None: 
+        return pd.read_csv(filename, usecols=lambda c : c in columns)
+
+    return pd.read_csv(filename)
+
+def sweep_artifacts(root, max_age): 
+    """
+    Deletes the folders of root written asynchronously (see ASYNC_MARKER) whose last write is older than max_age seconds
+
+    Returns
+    -------
+    deleted (int)
+        The number of folders deleted
+    """
+    now = time.time()
+    deleted = 0
+
+    for marker in glob.glob('{root}/*/{m}'.format(root=root, m=ASYNC_MARKER)): 
+        try: 
+            if now - os.path.getmtime(marker) > max_age: 
+                shutil.rmtree(os.path.dirname(marker), ignore_errors=True)
+                deleted += 1
+
+        except FileNotFoundError: 
+            # Deleted in the meantime
+            continue
+
+    return deleted
+
+# Background writer, shared by the whole process
+writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='artifacts')
+
+class ArtifactWriter:
+    """
+    Writes the debug artifacts (data frames) of a pipeline run to its folder.
+    The pipeline stages pass data frames to each other in memory: this writer is the only one touching the disk.
+
+    Parameters
+    ----------
+    folder (string)
+        The folder where to store the artifacts. It's created when the first artifact is written
+
+    mode (string, default None)
+        One of ARTIFACTS_MODES. Defaults to the TOTO_ARTIFACTS environment variable, or default_mode if not set
+
+    default_mode (string, default 'async')
+        The mode when neither mode nor TOTO_ARTIFACTS are set: 'sync' where Toto ML needs the files (the training data of a trained model), 
+        'async' elsewhere, so that the predictions don't wait for the disk
+
+    artifact_format (string, default None)
+        One of ARTIFACTS_FORMATS. Defaults to artifacts_format()
+
+    retention (float, default None)
+        In async mode, how long (seconds) the artifacts are kept: the folders next to this one written asynchronously more than retention ago
+        are deleted by the background writer (see sweep_artifacts()). Defaults to the TOTO_ARTIFACTS_RETENTION environment variable (in hours), or 24 hours
+    """
+
+    def __init__(self, folder, correlation_id, mode=None, context='', artifact_format=None, retention=None, default_mode='async'):
+        self.folder = folder
+        self.correlation_id = correlation_id
+        self.context = context
+        self.mode = mode if mode is not None else os.environ.get('TOTO_ARTIFACTS', default_mode)
+        self.artifact_format = artifact_format if artifact_format is not None else artifacts_format()
+        self.written = []
+        self.pending = []
+
+        if self.mode not in ARTIFACTS_MODES:
+            raise ValueError('Artifacts mode {m} not supported. Supported modes: {s}'.format(m=self.mode, s=ARTIFACTS_MODES))
+
+        if self.mode == 'async':
+            self.retention = retention if retention is not None else float(os.environ.get('TOTO_ARTIFACTS_RETENTION', 24)) * 3600
+
+            # The artifacts of the older runs are kept until retention
+            writer_executor.submit(sweep_artifacts, os.path.dirname(self.folder), self.retention)
+
+    def _write(self, df, name):
+
+        try:
+            os.makedirs(name=self.folder, exist_ok=True)
+
+            write_artifact(df, name, self.artifact_format)
+
+            if self.mode == 'async':
+                # Marks (and dates) the folder for sweep_artifacts()
+                with open('{f}/{m}'.format(f=self.folder, m=ASYNC_MARKER), 'w'):
+                    pass
+
+        except Exception as e:
+            logger.compute(self.correlation_id, '[ {context} ] - [ ARTIFACTS ] - Failed to write {f}: {e}'.format(context=self.context, f=name, e=e), 'error')
+
+    def save(self, df, name):
+        """
+        Saves a data frame as an artifact
+
+        Parameters
+        ----------
+        df (DataFrame)
+            The data frame to save. Can be None, in which case nothing is saved
+
+        name (string)
+            The name of the artifact (e.g. 'history.all')
+
+        Returns
+        -------
+        filename (string)
+            The file where the artifact is (or is going to be) written. None if the artifact is not written
+        """
+        if df is None or self.mode == 'none':
+            return None
+
+        name = '{folder}/{name}'.format(folder=self.folder, name=name)
+        filename = artifact_filename(name, self.artifact_format)
+
+        if self.mode == 'async':
+            # Copy, so that the caller can keep on working on the data frame
+            self.pending.append(writer_executor.submit(self._write, df.copy(), name))
+        else:
+            self._write(df, name)
+            self.written.append(filename)
+
+        return filename
+
+    def files(self):
+        """
+        Returns the list of artifacts that the caller has to clean up (see totoml ModelPrediction), or None
+
+        Artifacts written asynchronously are not returned: they're still being written when the request completes.
+        """
+        if len(self.written) == 0:
+            return None
+
+        return self.written
+
+    def wait(self):
+        """
+        Waits for all the pending asynchronous writes
+        """
+        for future in self.pending:
+            future.result()
+
+        self.pending = []
@@ -0,0 +1,134 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import pandas as pd
+
+from dlg.compact import concat_history, trim_categories
+
+class BatchCheckpoint:
+    """
+    Durable checkpoint of a batch prediction split in units (one unit per user).
+
+    The work folder holds:
+    {folder}/history/{unit}/{shard}.pkl     the downloaded history of every unit, partitioned as it's downloaded
+    {folder}/manifest.json                  the list of units, written once the whole history is downloaded
+    {folder}/done.jsonl                     one line per completed unit, appended (and flushed to disk) as soon as it completes
+
+    A batch restarted on the same folder skips the download if the manifest is there, and skips the completed units.
+
+    Parameters
+    ----------
+    folder (string)
+        The work folder of the batch
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest_filename = '{f}/manifest.json'.format(f=folder)
+        self.done_filename = '{f}/done.jsonl'.format(f=folder)
+
+    def unit(self, user):
+        '''
+        Returns the unit (folder name) of a user
+        '''
+        return hashlib.sha1(str(user).encode('utf-8')).hexdigest()[:16]
+
+    def units(self):
+        """
+        Returns the units of the batch ({unit: user}), or None if the history hasn't been completely downloaded yet
+        """
+        try:
+            with open(self.manifest_filename) as manifest_file:
+                return json.load(manifest_file)['units']
+        except FileNotFoundError:
+            return None
+
+    def reset(self):
+        """
+        Drops everything: the batch restarts from the download
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder)
+
+    def save_shard(self, index, df):
+        """
+        Saves a downloaded shard of the history (data frame), partitioned by user
+
+        Returns
+        -------
+        units (dict)
+            The units ({unit: user}) that have expenses in the shard
+        """
+        units = {}
+
+        for user, user_df in df.groupby('user', sort=False, dropna=False, observed=True):
+
+            unit = self.unit(user)
+            os.makedirs('{f}/history/{u}'.format(f=self.folder, u=unit), exist_ok=True)
+
+            # Saved with the dictionaries of the user only, not with the ones of the whole shard
+            trim_categories(user_df).to_pickle('{f}/history/{u}/{i:05d}.pkl'.format(f=self.folder, u=unit, i=index))
+
+            units[unit] = None if pd.isnull(user) else user
+
+        return units
+
+    def save_units(self, units):
+        """
+        Writes the manifest: the history is completely downloaded
+        """
+        tmp_filename = '{f}.tmp'.format(f=self.manifest_filename)
+
+        with open(tmp_filename, 'w') as manifest_file:
+            json.dump({"units": units}, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+        os.replace(tmp_filename, self.manifest_filename)
+
+    def history(self, unit):
+        """
+        Returns the history of a unit (compact history, see compact.compact_history(), sorted by date)
+        """
+        shards = sorted(glob.glob('{f}/history/{u}/*.pkl'.format(f=self.folder, u=unit)))
+
+        return concat_history([pd.read_pickle(shard) for shard in shards])
+
+    def done(self):
+        """
+        Returns the completed units ({unit: what was recorded when it completed})
+        """
+        done = {}
+
+        try:
+            with open(self.done_filename) as done_file:
+                for line in done_file:
+                    try:
+                        record = json.loads(line)
+                        done[record['unit']] = record
+                    except ValueError:
+                        # Last line cut by a crash
+                        pass
+        except FileNotFoundError:
+            pass
+
+        return done
+
+    def complete(self, unit, record):
+        """
+        Records that a unit is completed
+
+        Parameters
+        ----------
+        record (dict)
+            What to record about the unit (e.g. the number of predictions)
+        """
+        with open(self.done_filename, 'a') as done_file:
+            done_file.write(json.dumps(dict(record, unit=unit)) + '\n')
+            done_file.flush()
+            os.fsync(done_file.fileno())
+
+        # The history of a completed unit is not needed anymore
+        shutil.rmtree('{f}/history/{u}'.format(f=self.folder, u=unit), ignore_errors=True)
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from dlg.months import month_index
+
+# Columns of the history, as used by the whole pipeline (see compact_history())
+HISTORY_COLUMNS = ['id', 'amount', 'category', 'date', 'description', 'monthly', 'month', 'user']
+
+# Columns of the history that are dictionary-encoded (categorical)
+CATEGORICAL_COLUMNS = ['id', 'category', 'user']
+
+# Amount (cents) of the expenses that have no amount: it never matches the amount of another expense (see lookback.LookbackIndex)
+MISSING_AMOUNT = np.iinfo(np.int64).min
+
+def to_cents(amount):
+    '''
+    Converts an amount (e.g. 699.9) into integer cents (69990), the unit of the amounts of the compact history
+    '''
+    return int(round(float(amount) * 100))
+
+def is_compact(df):
+    '''
+    Tells whether the history has already been converted by compact_history()
+    '''
+    return 'month' in df.columns
+
+def compact_history(df):
+    """
+    Converts the history (e.g. as downloaded, see history.expenses_frame()) into the compact, typed table used by all the pipeline stages:
+     - id, user and category are dictionary-encoded (categorical): every distinct value is stored once, the rows hold int codes
+     - amount is in integer cents (int64, see to_cents()), so that amounts compare exactly. MISSING_AMOUNT if missing
+     - date is the YYYYMMDD day number (int32), 0 if missing
+     - month is the month number of the date (int16, see months.month_index()), -1 if missing. It replaces the yearMonth
+     - description and monthly are kept as they are (monthly is dropped if the history doesn't have it)
+
+    The conversion is done once, when the history is loaded: a history that is already compact is returned as it is.
+
+    Parameters
+    ----------
+    df (DataFrame)
+        The history, with the id, amount, category, date, description and user columns (and optionally monthly)
+    """
+    if is_compact(df):
+        # Re-encode the columns that lost their dictionary (e.g. read back from an artifact)
+        for column in CATEGORICAL_COLUMNS:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+
+        return df
+
+    amounts = pd.to_numeric(df['amount'], errors='coerce').to_numpy(dtype=np.float64)
+    dates = pd.to_numeric(df['date'], errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+
+    cents = np.round(np.nan_to_num(amounts) * 100).astype(np.int64)
+    cents[np.isnan(amounts)] = MISSING_AMOUNT
+
+    compact = pd.DataFrame({
+        'id': pd.Categorical(df['id']),
+        'amount': cents,
+        'category': pd.Categorical(df['category']),
+        'date': dates.astype(np.int32),
+        'description': df['description'].to_numpy(),
+        'monthly': df['monthly'].to_numpy() if 'monthly' in df.columns else None,
+        'month': np.where(dates > 0, month_index(dates // 100), -1).astype(np.int16),
+        'user': pd.Categorical(df['user'])
+    })
+
+    if 'monthly' not in df.columns:
+        del compact['monthly']
+
+    return compact
+
+def empty_history():
+    '''
+    Returns a compact history without expenses
+    '''
+    return compact_history(pd.DataFrame(columns=[c for c in HISTORY_COLUMNS if c != 'month']))
+
+def concat_history(dfs):
+    """
+    Concatenates histories (e.g. the shards of a download) into a compact history (see compact_history()).
+    The dictionaries of the encoded columns are merged, so that those columns stay encoded
+
+    Returns None if there are no histories
+    """
+    dfs = [compact_history(df) for df in dfs if df is not None]
+
+    if len(dfs) == 0:
+        return None
+
+    # Empty histories don't add anything, and their dictionaries can have a different type
+    non_empty = [df for df in dfs if not df.empty]
+
+    if len(non_empty) <= 1:
+        return (non_empty or dfs)[0].reset_index(drop=True)
+
+    columns = {}
+
+    for column in HISTORY_COLUMNS:
+
+        if not any([column in df.columns for df in non_empty]):
+            continue
+
+        if column in CATEGORICAL_COLUMNS:
+            try:
+                columns[column] = union_categoricals([df[column] for df in non_empty], sort_categories=True)
+            except TypeError:
+                columns[column] = pd.concat([df[column].astype(object) for df in non_empty], ignore_index=True).astype('category')
+        else:
+            columns[column] = pd.concat([df[column] if column in df.columns else pd.Series([None] * len(df), dtype=object) for df in non_empty], ignore_index=True)
+
+    return pd.DataFrame(columns)
+
+def trim_categories(df):
+    """
+    Drops from the dictionaries of the encoded columns the values that are not used by the rows of df
+    (e.g. a slice of a bigger history), so that df can be saved on its own without carrying the dictionaries of the whole history
+    """
+    df = df.copy()
+
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].cat.remove_unused_categories()
+
+    return df
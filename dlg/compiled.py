@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+from sklearn.neural_network import MLPClassifier
+
+# Number of random binary feature vectors used to check a compiled model against the original one
+PARITY_CHECK_ROWS = 4096
+
+class CompiledMLP:
+    """
+    Compiled version of an MLPClassifier with identity activations and a single logistic output.
+
+    With identity activations the whole network is a linear map: x -> x.W1.W2...Wn + b
+    so it can be folded into a single weight vector and bias. The predicted class is 1 when the
+    logistic of that is > 0.5, that is when x.w + b > 0.
+
+    Predictions are a float32 dot product over a contiguous array of the features,
+    without going through sklearn's input validation.
+
+    Use compile_model() to build it.
+    """
+
+    def __init__(self, model):
+
+        weights = model.coefs_[0].astype(np.float64)
+        bias = model.intercepts_[0].astype(np.float64)
+
+        for (coefs, intercepts) in zip(model.coefs_[1:], model.intercepts_[1:]):
+            bias = bias @ coefs + intercepts
+            weights = weights @ coefs
+
+        self.weights = np.ascontiguousarray(weights.ravel(), dtype=np.float32)
+        self.bias = np.float32(bias.ravel()[0])
+        self.classes_ = model.classes_
+        self.model = model
+
+    def decision_function(self, X):
+        """
+        Returns x.w + b for every row of X (DataFrame or 2D array, with the features in the training order)
+        """
+        if isinstance(X, pd.DataFrame):
+            X = X.to_numpy(dtype=np.float32)
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+
+        return X @ self.weights + self.bias
+
+    def predict(self, X):
+        """
+        Same as MLPClassifier.predict()
+        """
+        return self.classes_[(self.decision_function(X) > 0).astype(np.int64)]
+
+    def predict_proba(self, X):
+        """
+        Same as MLPClassifier.predict_proba()
+        """
+        p = 1 / (1 + np.exp(-self.decision_function(X).astype(np.float64)))
+
+        return np.column_stack([1 - p, p])
+
+def qualifies(model):
+    '''
+    Tells whether the model can be compiled: a binary MLPClassifier with identity activations
+    '''
+    return isinstance(model, MLPClassifier) and model.activation == 'identity' and model.out_activation_ == 'logistic' and len(model.classes_) == 2
+
+def parity_check(model, compiled, X=None):
+    """
+    Checks that the compiled model predicts exactly the same as the original model
+
+    Parameters
+    ----------
+    X (DataFrame or 2D array, default None)
+        The features to check on. Defaults to PARITY_CHECK_ROWS random binary feature vectors (the model features are 0/1 flags)
+    """
+    if X is None:
+        X = np.random.default_rng(0).integers(0, 2, size=(PARITY_CHECK_ROWS, model.coefs_[0].shape[0]))
+
+        if hasattr(model, 'feature_names_in_'):
+            X = pd.DataFrame(X, columns=model.feature_names_in_)
+
+    return bool(np.array_equal(model.predict(X), compiled.predict(X)))
+
+def compile_model(model, X=None):
+    """
+    Compiles the model if it qualifies (see CompiledMLP) and if the compiled model passes the parity check
+
+    Returns
+    -------
+    compiled (CompiledMLP)
+        The compiled model, or None if the model can't be compiled
+    """
+    if not qualifies(model):
+        return None
+
+    compiled = CompiledMLP(model)
+
+    if not parity_check(model, compiled, X):
+        return None
+
+    return compiled
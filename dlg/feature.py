@@ -1,166 +1,324 @@
 # Test of ML Flow
+import os
 import re
 import numpy as np
 import pandas as pd
-from sklearn.neural_network import MLPClassifier
-from sklearn.model_selection import train_test_split
+from scipy import sparse
 from sklearn.feature_extraction.text import CountVectorizer
-from datetime import datetime as dt, timedelta
-from sklearn.metrics import f1_score, confusion_matrix, classification_report
+from concurrent.futures import ProcessPoolExecutor
 
 from toto_logger.logger import TotoLogger
 
+from dlg.lookback import LookbackIndex, LOOKBACK_FEATURE_NAMES, LOOKBACK_MONTHS, to_engineer, lookback_flags
+from dlg.months import MonthStore, month_index
+from dlg.featurestore import FeatureStore
+from dlg.compact import compact_history, to_cents, trim_categories
+from dlg.artifacts import write_artifact, read_artifact
+
 pd.options.mode.chained_assignment = None
 
 logger = TotoLogger()
 
-def get_expenses_of_month(full_dataset, current_date, yearMonthDelta): 
+# Splits a description into its words, as the bag of words does (see bow()). Built once: building it compiles the token pattern
+description_analyzer = CountVectorizer().build_analyzer()
+
+# Number of months engineered by a single task of the parallel feature engineering
+SHARD_MONTHS = 12
+
+CATEGORY_FEATURE_NAMES = ['category_SUPERMERCATO', 'category_FOOD', 'category_VIAGGI', 'category_PALESTRA', 'category_SALUTE', 'category_XMAS']
+
+# The features used by the model
+MODEL_FEATURE_NAMES = LOOKBACK_FEATURE_NAMES + CATEGORY_FEATURE_NAMES
+
+def clean_description(description): 
     '''
-    This function returns all the expenses of the specified month delta. 
-    - yearMonthDelta:  an integer that specifies how many months before or after this one to look at (+1, +2, -1, ...)
+    Removes all special characters from the description
     '''
-    now = current_date
-
-    currentMonth = now.month
-    currentYear = now.year
-    
-    targetMonth = currentMonth
-    targetYear = currentYear
-    
-    if (yearMonthDelta < 0): 
-        targetMonth = currentMonth + yearMonthDelta + 12*int( (12 - (currentMonth + yearMonthDelta)) / 12 )
-        targetYear -= int( (12 - (currentMonth + yearMonthDelta)) / 12 )
-    else: 
-        targetMonth = currentMonth + yearMonthDelta - 12*int( (currentMonth + yearMonthDelta - 1) / 12 )
-        targetYear += int( (currentMonth + yearMonthDelta - 1) / 12 )
-            
-    yearMonth = int(str(targetYear) + str(targetMonth).rjust(2, '0'))
-    
-    return full_dataset[full_dataset['yearMonth'] == yearMonth]
+    return re.sub(r'\.', ' ', description)
 
 def bow(df):
+    '''
+    Generates the bag of words of the descriptions of the data set. 
+    Returns a binarized CSR matrix (1 if the word is in the description) with one row per row of df (by position)
+    '''
     # Remove all special characters
-    df['description'] = df['description'].apply(lambda x : re.sub('[\.]', ' ', x))
+    df['description'] = df['description'].apply(clean_description)
     
     # Generate a bag of words for description
-    vectorizer = CountVectorizer()
-    vectorizer.fit(df['description'])
+    vectorizer = CountVectorizer(binary=True, dtype=np.int32)
 
-    df['description_bow'] = df['description'].apply(lambda x : vectorizer.transform([x]).toarray())
-    
-    return df
-
-def overlap_word_count(row1, row2): 
-    compared = np.logical_and(row1.tolist()[0], row2.tolist()[0])
-    return np.sum(compared)
+    try: 
+        return vectorizer.fit_transform(df['description'])
 
-def same_amt_cat(row, dataset): 
+    except ValueError as e: 
+        # No words at all (e.g. a shard whose descriptions are all empty or single characters): no shared words
+        if 'empty vocabulary' not in str(e): 
+            raise
 
-    ds = dataset[(dataset['category'] == row['category']) & (dataset['amount'] == row['amount']) & (dataset['user'] == row['user'])]
+        return sparse.csr_matrix((len(df), 0), dtype=np.int32)
 
-    # Features
-    same_amt_cat_sw = 0 # sw stands for share words
-    same_amt_cat_sw_2 = 0
-    same_amt_cat_sw_3more = 0
-    same_amt_cat = 0
-    same_amt_cat_2more = 0
-    sacd = 0
-    sacd3 = 0
-    
-    # If there are items with the same category and amount
-    if len(ds) > 0:
-        # Count the number of overlapping words in the description for all items that have the same cat and amt
-        overlaps = ds['description_bow'].apply(overlap_word_count, row2=row['description_bow'])
-        # Find the best match
-        best_match = ds.loc[overlaps.idxmax(), :]
-        # How many words in common?
-        words_in_common = overlaps[overlaps.idxmax()]
-        
-        # Check if one of the items has the same exact date
-        days = pd.to_datetime(ds['date'], format='%Y%m%d').dt.day
-        row_day = dt.strptime(str(row['date']), '%Y%m%d').day
-        if sum(days == row_day) > 0: 
-            sacd = 1
-        elif sum(days <= row_day + 3) > 0 and sum(days >= row_day - 3) > 0:
-            sacd3 = 1
-        
-        # Is there exactly 1 payment with the same amt, cat and that shares words?
-        if len(ds) == 1 and sum(overlaps > 0) == 1:
-            same_amt_cat_sw = 1
-        
-        # Is there exactly 1 payment with the same amt, cat and that DOES NOT share words?
-        if len(ds) == 1 and sum(overlaps > 0) == 0:
-            same_amt_cat = 1
-            
-        if len(ds) > 1: 
-            # Are there 2 or more payments with the same amt and cat that DO NOT share words?
-            if sum(overlaps > 0) == 0:
-                same_amt_cat_2more = 1
-            # Are there 2 payments with the same amt and cat that share some words?
-            elif sum(overlaps > 0) == 2:
-                same_amt_cat_sw_2 = 1
-            # Are there 3+ payments with the same amt and cat that share some words?
-            elif sum(overlaps > 0) > 2:
-                same_amt_cat_sw_3more = 1
-        
-    return pd.Series({'same_amt_cat_sw': same_amt_cat_sw, 'same_amt_cat_sw_2': same_amt_cat_sw_2, 'same_amt_cat_sw_3more': same_amt_cat_sw_3more, 'same_amt_cat': same_amt_cat, 'same_amt_cat_2more': same_amt_cat_2more, 'sacd': sacd, 'sacd3': sacd3})
-
-def sesm(row, dataset): 
-    
-    ds = dataset[(dataset['category'] == row['category']) & (dataset['amount'] == row['amount']) & (dataset['user'] == row['user'])]
-    
-    if len(ds) > 1:
-        overlaps = ds['description_bow'].apply(overlap_word_count, row2=row['description_bow'])
-    
-        if sum(overlaps > 0) > 1:
-            return 1
-    
-    return 0
+def sparse_nbytes(matrix): 
+    '''
+    Returns the memory (in bytes) used by a CSR matrix
+    '''
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
 
-def engineer_features_for_month(month, df, training=False): 
+def engineer_features(store, descriptions_bow, training=False, month_from=None, month_to=None): 
     '''
-    Engineers the features for the specified month:
-    - month: the month in a YYYYMM format
-    - df:   the whole data set
+    Engineers the features for the months from month_from to month_to (both included):
+    - store:            the MonthStore holding the whole data set
+    - descriptions_bow: the bag of words of the descriptions of the store (see bow())
+    - month_from:       the first month (month number, see months.month_index()). Default: the first month of the store
+    - month_to:         the last month (month number). Default: the last month of the store
+
+    Only the expenses of those months and of the 4 months before them are looked at.
+    Returns the expenses for which the features were built, in chronological order
 
     IMPORTANT: only generates features for the expenses that haven't the 'monthly' field already set WHEN NOT TRAINING!!
     '''
-    try: 
-        if not training:
-            features_m = df[(df['yearMonth'] == month) & (df['monthly'].isnull())]
-        else: 
-            features_m = df[(df['yearMonth'] == month)]
-    except KeyError: 
-        features_m = df[(df['yearMonth'] == month)]
+    if month_from is None: 
+        month_from = store.first_month
+    if month_to is None: 
+        month_to = store.last_month
 
-    if features_m.empty: 
-        return features_m
-    
-    year = int(str(month)[0:4])
-    m = int(str(month)[4:])
-    current_date = dt(year, m, 1)
-
-    # Features of month - 1
-    df_month_m1 = get_expenses_of_month(df, current_date, -1)
-    df_month_m2 = get_expenses_of_month(df, current_date, -2)
-    df_month_m3 = get_expenses_of_month(df, current_date, -3)
-    df_month_m4 = get_expenses_of_month(df, current_date, -4)
-
-    df_month_p1 = get_expenses_of_month(df, current_date, 1)
-
-    fm1 = features_m.apply(same_amt_cat, axis=1, dataset=df_month_m1)
-    fm2 = features_m.apply(same_amt_cat, axis=1, dataset=df_month_m2)
-    fm3 = features_m.apply(same_amt_cat, axis=1, dataset=df_month_m3)
-    fm4 = features_m.apply(same_amt_cat, axis=1, dataset=df_month_m4)
-    
-    features_m['sesm'] = features_m.apply(sesm, axis=1, dataset=features_m)
-    
-    features_m[['sacsw1_m1', 'sacsw2_m1', 'sacsw3m_m1', 'sac1_m1', 'sac2m_m1', 'sacd_m1', 'sacd3_m1']] = fm1[['same_amt_cat_sw', 'same_amt_cat_sw_2', 'same_amt_cat_sw_3more', 'same_amt_cat', 'same_amt_cat_2more', 'sacd', 'sacd3']]
-    features_m[['sacsw1_m2', 'sacsw2_m2', 'sacsw3m_m2', 'sac1_m2', 'sac2m_m2', 'sacd_m2', 'sacd3_m2']] = fm2[['same_amt_cat_sw', 'same_amt_cat_sw_2', 'same_amt_cat_sw_3more', 'same_amt_cat', 'same_amt_cat_2more', 'sacd', 'sacd3']]
-    features_m[['sacsw1_m3', 'sacsw2_m3', 'sacsw3m_m3', 'sac1_m3', 'sac2m_m3', 'sacd_m3', 'sacd3_m3']] = fm3[['same_amt_cat_sw', 'same_amt_cat_sw_2', 'same_amt_cat_sw_3more', 'same_amt_cat', 'same_amt_cat_2more', 'sacd', 'sacd3']]
-    features_m[['sacsw1_m4', 'sacsw2_m4', 'sacsw3m_m4', 'sac1_m4', 'sac2m_m4', 'sacd_m4', 'sacd3_m4']] = fm4[['same_amt_cat_sw', 'same_amt_cat_sw_2', 'same_amt_cat_sw_3more', 'same_amt_cat', 'same_amt_cat_2more', 'sacd', 'sacd3']]
-    
-    return features_m
+    # The months to process and their lookback window are contiguous ranges of the store
+    window = store.window(month_from - LOOKBACK_MONTHS, month_to)
+    months = store.window(month_from, month_to)
+
+    df = store.df.iloc[window]
+
+    selected = np.zeros(len(df), dtype=bool)
+    selected[months.start - window.start:months.stop - window.start] = True
+    selected &= to_engineer(df, training)
+
+    targets = np.flatnonzero(selected)
+
+    features = df.iloc[targets].reset_index(drop=True)
+
+    if features.empty: 
+        return features
+
+    # Index the window on (user, category, amount, month) to compute the lookback features
+    index = LookbackIndex(df, descriptions_bow[window])
+
+    features[LOOKBACK_FEATURE_NAMES] = index.compute(targets)
+
+    return features
+
+def change_keys(changes): 
+    '''
+    Returns the (user, category, amount in cents, month) of the new or changed expenses (list of dicts with the user, category, amount and date). 
+    A changed expense can carry its values before the change in a 'previous' dict (e.g. {"amount": ..., "date": ...}): 
+    the expenses that matched its old values are affected as well
+    '''
+    keys = []
+
+    for change in changes: 
+        for version in [change, dict(change, **change['previous']) if change.get('previous') else None]: 
+            if version is not None: 
+                keys.append((version['user'], version['category'], to_cents(version['amount']), month_index(int(str(version['date'])[:6]))))
+
+    return pd.DataFrame(keys, columns=['user', 'category', 'amount', 'month_changed']).drop_duplicates()
+
+def affected(df, changes): 
+    '''
+    Tells which expenses of df can have different features because of the new or changed expenses (see change_keys()): 
+    an expense of month M only changes the features of the expenses with the same user, category and amount, 
+    in the months M to M + LOOKBACK_MONTHS
+    Returns a boolean array with one item per row of df
+    '''
+    mask = np.zeros(len(df), dtype=bool)
+
+    rows = pd.DataFrame({
+        'user': df['user'].to_numpy(), 
+        'category': df['category'].to_numpy(), 
+        'amount': df['amount'].to_numpy(), 
+        'month': df['month'].to_numpy().astype(np.int64), 
+        'pos': np.arange(len(df))
+    })
+
+    pairs = rows.merge(change_keys(changes), on=['user', 'category', 'amount'], how='inner', sort=False)
+    pairs = pairs[(pairs['month'] >= pairs['month_changed']) & (pairs['month'] <= pairs['month_changed'] + LOOKBACK_MONTHS)]
+
+    mask[pairs['pos'].to_numpy(dtype=np.int64)] = True
+
+    return mask
+
+def engineer_affected_features(store, descriptions_bow, changes, candidates): 
+    '''
+    Engineers the features of the expenses affected by new or changed expenses (see affected()), and only of those: 
+    - store:            the MonthStore holding the history around the changes (the 4 months before the oldest change and after)
+    - descriptions_bow: the bag of words of the descriptions of the store (see bow())
+    - changes:          a list of dicts with the user, category, amount and date (YYYYMMDD) of the new or changed expenses
+    - candidates:       boolean array telling which expenses of the store can be (re)predicted, e.g. to_engineer(store.df)
+
+    The features are the same as the ones that engineer_features() would build for those expenses. 
+    Returns the expenses for which the features were built
+    '''
+    targets = np.flatnonzero(affected(store.df, changes) & candidates)
+
+    features = store.df.iloc[targets].reset_index(drop=True)
+
+    if features.empty: 
+        return features
+
+    index = LookbackIndex(store.df, descriptions_bow)
+
+    # sesm looks at all the expenses of the month that would be predicted, not only the affected ones
+    features[LOOKBACK_FEATURE_NAMES] = index.compute(targets, pool=np.flatnonzero(candidates))
+
+    return features
+
+def engineer_expense_features(expense, history): 
+    '''
+    Engineers the features of a single expense, without engineering the features of the rest of the history:
+    - expense:  a dict with the id, user, category, amount, description and date (YYYYMMDD) of the expense
+    - history:  the expenses of the 4 months before the expense's month and of its month (more months are ignored), as a compact history
+
+    Only the expenses of the history with the same user, category and amount are looked at. 
+    If the expense is already in the history (same id), that copy is ignored. 
+    Returns a data frame with a single row: the id and the features (MODEL_FEATURE_NAMES) of the expense
+    '''
+    date = str(expense['date'])
+    month = month_index(int(date[:6]))
+    day = int(date[6:8])
+
+    # Expenses with the same user, category and amount
+    matches = history[(history['user'] == expense['user']) & (history['category'] == expense['category']) & (history['amount'] == to_cents(expense['amount'])) & (history['id'] != expense['id'])]
+    matches = matches[matches['month'] >= 0]
+
+    months = matches['month'].to_numpy().astype(np.int64)
+    days = matches['date'].to_numpy().astype(np.int64) % 100
+
+    # Do they share words with the expense? 
+    words = set(description_analyzer(clean_description(expense['description'])))
+
+    shared = np.array([len(words.intersection(description_analyzer(clean_description(d)))) > 0 for d in matches['description']], dtype=bool)
+
+    features = []
+
+    for k in range(1, LOOKBACK_MONTHS + 1): 
+        in_month = months == month - k
+        m_days = days[in_month]
+
+        features.append(lookback_flags(in_month.sum(), shared[in_month].sum(), (m_days == day).any(), (m_days <= day + 3).any(), (m_days >= day - 3).any()))
+
+    # sesm: the expense itself and the expenses of its month that would be predicted with it
+    in_month = (months == month) & to_engineer(matches)
+    n = in_month.sum() + 1
+    s = shared[in_month].sum() + int(len(words) > 0)
+
+    features.append(np.array([[int(n > 1 and s > 1)]]))
+
+    features.append(category_dummies(expense['category']).to_numpy()[None, :])
+
+    features = pd.DataFrame(np.hstack(features).astype(np.int64), columns=MODEL_FEATURE_NAMES)
+    features['id'] = expense['id']
+
+    return features
+
+def engineer_expenses_features(expenses, history): 
+    '''
+    Engineers the features of a list of expenses (see engineer_expense_features()) on a shared history:
+    - expenses: a list of dicts with the id, user, category, amount, description and date (YYYYMMDD) of the expenses
+    - history:  the expenses of the 4 months before the oldest expense's month and up to the newest expense's month, as a compact history
+
+    The history is filtered once down to the expenses with the same user, category and amount as one of the expenses. 
+    Returns a data frame with one row per expense, in the same order: the id and the features (MODEL_FEATURE_NAMES)
+    '''
+    keys = set([(e['user'], e['category'], to_cents(e['amount'])) for e in expenses])
+
+    candidates = history[history['user'].isin([k[0] for k in keys]) & history['category'].isin([k[1] for k in keys]) & history['amount'].isin([k[2] for k in keys])]
+
+    return pd.concat([engineer_expense_features(expense, candidates) for expense in expenses], axis=0, ignore_index=True)
+
+def feature_shards(store): 
+    '''
+    Splits the store in independent units of work for the parallel feature engineering. 
+    Features only look at the expenses of the same user, so users are independent. 
+    The months of every user are then split in windows of SHARD_MONTHS months (+ the 4 months before them). 
+
+    Returns a list of (data frame, month_from, month_to). 
+    The data frames carry a '_pos' column with the position of each expense in the store.
+    '''
+    df = store.df.iloc[store.window(store.first_month, store.last_month)]
+    df['_pos'] = np.arange(len(df))
+
+    shards = []
+
+    for user, user_df in df.groupby('user', sort=True, dropna=False, observed=True): 
+
+        user_store = MonthStore(user_df)
+
+        for month_from in range(user_store.first_month, user_store.last_month + 1, SHARD_MONTHS): 
+            month_to = min(month_from + SHARD_MONTHS - 1, user_store.last_month)
+
+            if len(user_store.expenses(month_from, month_to)) == 0: 
+                continue
+
+            shard_df = user_store.df.iloc[user_store.window(month_from - LOOKBACK_MONTHS, month_to)]
+
+            shards.append((shard_df, month_from, month_to))
+
+    return shards
+
+def engineer_features_shard(shard, training=False): 
+    '''
+    Engineers the features of a single shard (see feature_shards()). 
+    This runs in a worker process.
+    '''
+    (shard_df, month_from, month_to) = shard
+
+    store = MonthStore(shard_df)
+
+    return engineer_features(store, bow(store.df), training, month_from, month_to)
+
+def engineer_shards(shards, training=False, workers=1): 
+    '''
+    Engineers the features of a list of shards, on a pool of #workers processes if workers > 1. 
+    Returns the list of features data frames, one per shard
+    '''
+    if workers <= 1 or len(shards) <= 1: 
+        return [engineer_features_shard(shard, training) for shard in shards]
+
+    # Every shard is sent to a worker with its own dictionaries only, not with the ones of the whole history
+    shards = [(trim_categories(shard[0]), ) + tuple(shard[1:]) for shard in shards]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool: 
+        return list(pool.map(engineer_features_shard, shards, [training] * len(shards)))
+
+def gather_features(results): 
+    '''
+    Gathers the features of multiple shards in a single data frame, in the store order (see feature_shards())
+    '''
+    results = [r for r in results if not r.empty]
+
+    if len(results) == 0: 
+        return pd.DataFrame()
+
+    # Gather the results in a single concatenation and put them back in the store order
+    features = pd.concat(results, ignore_index=True, sort=False)
+    features = features.sort_values(by='_pos', kind='stable').drop(columns=['_pos']).reset_index(drop=True)
+
+    return features
+
+def engineer_features_parallel(store, training=False, workers=2): 
+    '''
+    Engineers the features for all the months of the store, splitting the work by user and month window
+    across a pool of #workers processes. 
+
+    The result is exactly the same (rows and order) as engineer_features(store, bow(store.df), training)
+    '''
+    return gather_features(engineer_shards(feature_shards(store), training, workers))
+
+def category_flags(categories): 
+    '''
+    Same as category_dummies(), for a whole column of categories at once. 
+    Returns an array with one row per category and the CATEGORY_FEATURE_NAMES columns
+    '''
+    categories = pd.Series(categories)
+
+    return np.column_stack([(categories == name.replace('category_', '', 1)).to_numpy() for name in CATEGORY_FEATURE_NAMES]).astype(np.int64)
 
 def category_dummies(cat): 
     if cat == 'SUPERMERCATO':
@@ -180,7 +338,31 @@ def category_dummies(cat):
 
 class FeatureEngineering: 
 
-    def __init__(self, folder, data_file, correlation_id, training=False, context=''):
+    def __init__(self, folder, data_file, correlation_id, training=False, context='', workers=None, feature_store=None, changes=None, predicted=None):
+        """
+        Constructor
+
+        Parameters
+        ----------
+        data_file (string, DataFrame or MonthStore)
+            The history file to engineer the features on, or the already loaded history (compact history, see compact_history(), or MonthStore)
+
+        workers (int, default None)
+            The number of processes to use to engineer the features. 
+            Defaults to the TOTO_FEATURE_WORKERS environment variable, or 1 (no parallelism) if not set
+
+        feature_store (FeatureStore, default None)
+            The store of already engineered features: only the months whose inputs changed are recomputed. 
+            Defaults to a store in the TOTO_FEATURE_STORE folder, or no store if that variable is not set
+
+        changes (list, default None)
+            New or changed expenses (dicts with the user, category, amount and date): only the features of the expenses 
+            they affect are engineered (see engineer_affected_features())
+
+        predicted (collection, default None)
+            With changes: the ids of the expenses whose "monthly" label was set by the model (see PublishedStore). 
+            They are re-predicted as well, together with the expenses that have no label
+        """
         self.data_file = data_file
         self.folder = folder
         self.model_feature_names = None
@@ -189,28 +371,88 @@ class FeatureEngineering:
         self.training = training
         self.correlation_id = correlation_id
         self.context = context
+        self.workers = workers if workers is not None else int(os.environ.get('TOTO_FEATURE_WORKERS', 1))
+        self.feature_store = feature_store
+        self.changes = changes
+        self.predicted = predicted
+
+        if self.feature_store is None and os.environ.get('TOTO_FEATURE_STORE'): 
+            self.feature_store = FeatureStore(os.environ['TOTO_FEATURE_STORE'])
 
     def do(self, user): 
+        """
+        Engineers the features and saves them in the features file
 
-        logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Starting feature engineering'.format(context=self.context), 'info')
+        Returns
+        -------
+        (model_feature_names, output_file_name)
+            (None, None) if there was nothing to engineer
+        """
+        (model_feature_names, features) = self.engineer(user)
 
-        output_file_name = '{folder}/features.{user}.csv'.format(user=user, folder=self.folder);
+        if features is None: 
+            return (None, None)
+
+        # Save all the features to file
+        output_file_name = write_artifact(features, '{folder}/features.{user}'.format(user=user, folder=self.folder))
 
-        # Read all the data
-        data = pd.read_csv(self.data_file)
+        return (model_feature_names, output_file_name)
 
-        # Generate bow for descriptions
-        data = bow(data)
+    def engineer(self, user): 
+        """
+        Engineers the features and returns them in memory
 
-        # Get the distinct months in the data
-        months = data['yearMonth'].value_counts().index.sort_values()
+        Returns
+        -------
+        (model_feature_names, features)
+            features is a data frame with the model features, the id 
+            and the monthly label (when training) or the current monthly label of the expenses (current_monthly, when predicting)
+            (None, None) if there was nothing to engineer
+        """
+        logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Starting feature engineering'.format(context=self.context), 'info')
+
+        # Read all the data, partitioned by month
+        if isinstance(self.data_file, MonthStore): 
+            store = self.data_file
+        elif isinstance(self.data_file, pd.DataFrame): 
+            store = MonthStore(compact_history(self.data_file))
+        else: 
+            store = MonthStore(compact_history(read_artifact(self.data_file)))
 
         # Create the features data frame
         # This dataframe won't just contain features, but also needed references (e.g. id)
-        features = pd.DataFrame()
+        if self.changes is not None: 
+
+            candidates = to_engineer(store.df, self.training)
+
+            if self.predicted is not None and not self.training: 
+                candidates = candidates | store.df['id'].isin(self.predicted).to_numpy()
+
+            features = engineer_affected_features(store, bow(store.df), self.changes, candidates)
+
+            logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - {c} changed expenses affect {r} expenses'.format(context=self.context, c=len(self.changes), r=len(features)), 'info')
+
+        elif self.feature_store is not None: 
+
+            (features, reused, recomputed) = self.feature_store.engineer(store, self.training, lambda shards: engineer_shards(shards, self.training, self.workers))
+
+            features = gather_features(features)
 
-        for month in months: 
-            features = pd.concat([features, engineer_features_for_month(month, data, self.training)], ignore_index=True, sort=False)
+            logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Feature store: {r} months reused, {c} months recomputed'.format(context=self.context, r=reused, c=recomputed), 'info')
+
+        elif self.workers > 1: 
+
+            logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Engineering features on {w} processes'.format(context=self.context, w=self.workers), 'info')
+
+            features = engineer_features_parallel(store, self.training, self.workers)
+
+        else: 
+            # Generate bow for descriptions
+            descriptions_bow = bow(store.df)
+
+            logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Bag of words: {w} words, {b} bytes'.format(context=self.context, w=descriptions_bow.shape[1], b=sparse_nbytes(descriptions_bow)), 'info')
+
+            features = engineer_features(store, descriptions_bow, self.training)
 
         if features.empty:
             self.empty = True
@@ -218,24 +460,22 @@ class FeatureEngineering:
             return (None, None)
 
         # Finally: create dummies for the category
-        features[['category_SUPERMERCATO', 'category_FOOD', 'category_VIAGGI', 'category_PALESTRA', 'category_SALUTE', 'category_XMAS']] = features['category'].apply(category_dummies)
+        features[CATEGORY_FEATURE_NAMES] = category_flags(features['category'])
 
         # Define the name of the features
-        self.model_feature_names = ['sacsw1_m1', 'sacsw2_m1', 'sacsw3m_m1', 'sac1_m1', 'sac2m_m1', 'sacd_m1', 'sacd3_m1',
-              'sacsw1_m2', 'sacsw2_m2', 'sacsw3m_m2', 'sac1_m2', 'sac2m_m2', 'sacd_m2', 'sacd3_m2',
-              'sacsw1_m3', 'sacsw2_m3', 'sacsw3m_m3', 'sac1_m3', 'sac2m_m3', 'sacd_m3', 'sacd3_m3',
-              'sacsw1_m4', 'sacsw2_m4', 'sacsw3m_m4', 'sac1_m4', 'sac2m_m4', 'sacd_m4', 'sacd3_m4', 
-              'sesm', 
-              'category_SUPERMERCATO', 'category_FOOD', 'category_VIAGGI', 'category_PALESTRA', 'category_SALUTE', 'category_XMAS'
-              ]
+        self.model_feature_names = MODEL_FEATURE_NAMES.copy()
 
         all_features_names = self.model_feature_names.copy()
         all_features_names.append('id')
         if self.training: 
             all_features_names.append('monthly')
+        elif 'monthly' in features.columns: 
+            # Current label of the expenses, so that only the predictions that change it are published
+            features['current_monthly'] = features['monthly']
+            all_features_names.append('current_monthly')
 
-        # Save all the features to file
-        features[all_features_names].to_csv(output_file_name)
+        # The ids of the features only: the dictionary of the whole history isn't carried along
+        features = trim_categories(features[all_features_names])
 
         # Save additional data
         self.count = len(features)
@@ -243,5 +483,5 @@ class FeatureEngineering:
         logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - Features engineered successfully'.format(context=self.context), 'info')
         logger.compute(self.correlation_id, '[ {context} ] - [ FEATURE ENGINEERING ] - # of rows: {r}'.format(context=self.context, r=self.count), 'info')
 
-        return (self.model_feature_names, output_file_name)
+        return (self.model_feature_names, features)
 
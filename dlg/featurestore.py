@@ -0,0 +1,171 @@
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+
+from dlg.months import MonthStore
+from dlg.lookback import LOOKBACK_MONTHS, to_engineer
+from dlg.compact import trim_categories
+
+# Version of the feature engineering code
+# Change it whenever the features change, so that all the stored features get recomputed
+FEATURE_VERSION = '1'
+
+# Columns of the history that the features depend on
+INPUT_COLUMNS = ['id', 'amount', 'category', 'date', 'description', 'monthly', 'month', 'user']
+
+class FeatureStore:
+    """
+    Persistent store of the engineered features, per user and per month.
+
+    The features of a month only depend on the expenses of that month and of the 4 months before it.
+    Every month's features are stored under a key made of the content hash of those 5 months of input rows,
+    so that a run only recomputes the months whose own inputs or lookback window changed.
+    Everything else is read from the store.
+
+    The store is organized as:
+    {folder}/{user hash}/{month}.{train|predict}.{key}.pkl
+
+    Parameters
+    ----------
+    folder (string)
+        The folder where the features are stored
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _user_folder(self, user):
+        return '{folder}/{user}'.format(folder=self.folder, user=hashlib.sha1(str(user).encode('utf-8')).hexdigest()[:16])
+
+    def _filename(self, user_folder, month, mode, key):
+        return '{folder}/{month}.{mode}.{key}.pkl'.format(folder=user_folder, month=month, mode=mode, key=key)
+
+    def _save(self, user_folder, month, mode, key, features):
+        '''
+        Saves the features of a month and removes the previous versions of them
+        '''
+        os.makedirs(user_folder, exist_ok=True)
+
+        filename = self._filename(user_folder, month, mode, key)
+
+        # Write and rename, so that concurrent readers never see a partial file
+        tmp_filename = '{f}.{pid}.tmp'.format(f=filename, pid=os.getpid())
+        features.to_pickle(tmp_filename)
+        os.replace(tmp_filename, filename)
+
+        for old in glob.glob(self._filename(user_folder, month, mode, '*')):
+            if old != filename:
+                try:
+                    os.remove(old)
+                except FileNotFoundError:
+                    pass
+
+    def _month_hashes(self, user_store, row_hashes):
+        '''
+        Returns a dict {month: hash of the input rows of that month} for all the months of the user store,
+        including the 4 months before its first month
+        '''
+        hashes = {}
+
+        for month in range(user_store.first_month - LOOKBACK_MONTHS, user_store.last_month + 1):
+            hashes[month] = hashlib.sha1(row_hashes[user_store.month(month)].tobytes()).hexdigest()
+
+        return hashes
+
+    def engineer(self, store, training, compute):
+        """
+        Engineers the features of all the months of the store, reusing the stored months whose inputs didn't change
+
+        Parameters
+        ----------
+        store (MonthStore)
+            The history
+
+        training (boolean)
+            True if the features are engineered for training (all expenses), False for predicting
+
+        compute (function)
+            The function that engineers a list of shards (see feature.feature_shards() and feature.engineer_shards())
+
+        Returns
+        -------
+        (features, reused, recomputed)
+            The list of features data frames (carrying the '_pos' column, see feature.gather_features()),
+            the number of months read from the store and the number of months recomputed
+        """
+        mode = 'train' if training else 'predict'
+
+        df = store.df.iloc[store.window(store.first_month, store.last_month)]
+        df['_pos'] = np.arange(len(df))
+
+        input_columns = [c for c in INPUT_COLUMNS if c in df.columns]
+        df['_hash'] = pd.util.hash_pandas_object(df[input_columns], index=False).to_numpy()
+
+        results = []
+        shards = []
+        keys = {}
+
+        for user, user_df in df.groupby('user', sort=True, dropna=False, observed=True):
+
+            user_store = MonthStore(user_df)
+            user_folder = self._user_folder(user)
+
+            row_hashes = user_store.df['_hash'].to_numpy()
+            month_hashes = self._month_hashes(user_store, row_hashes)
+
+            dirty = []
+
+            for month in user_store.months():
+
+                month_df = user_store.expenses(month)
+                targets = month_df[to_engineer(month_df, training)]
+
+                if targets.empty:
+                    continue
+
+                lookback = ''.join([month_hashes[m] for m in range(month - LOOKBACK_MONTHS, month + 1)])
+                key = hashlib.sha1('{v}.{mode}.{h}'.format(v=FEATURE_VERSION, mode=mode, h=lookback).encode('utf-8')).hexdigest()
+
+                filename = self._filename(user_folder, month, mode, key)
+
+                if os.path.exists(filename):
+                    # Same inputs: same expenses, in the same order, as when the features were stored
+                    features = pd.read_pickle(filename)
+                    features['_pos'] = targets['_pos'].to_numpy()
+                    results.append(features)
+                else:
+                    dirty.append(month)
+                    keys[(user_folder, month)] = key
+
+            # Recompute the dirty months, grouping consecutive months in a single shard
+            runs = []
+            for month in dirty:
+                if len(runs) > 0 and runs[-1][1] == month - 1:
+                    runs[-1][1] = month
+                else:
+                    runs.append([month, month])
+
+            for (month_from, month_to) in runs:
+                shards.append((user_store.df.iloc[user_store.window(month_from - LOOKBACK_MONTHS, month_to)], month_from, month_to, user_folder))
+
+        reused = len(results)
+
+        computed = compute([shard[:3] for shard in shards])
+
+        for (shard, features) in zip(shards, computed):
+
+            if features.empty:
+                continue
+
+            features = features.drop(columns=['_hash'])
+            results.append(features)
+
+            months = features['month'].to_numpy()
+
+            # Every month is stored with its own dictionaries only (see compact.trim_categories())
+            for month in np.unique(months):
+                self._save(shard[3], int(month), mode, keys[(shard[3], int(month))], trim_categories(features[months == month].drop(columns=['_pos']).reset_index(drop=True)))
+
+        return (results, reused, len(keys))
@@ -0,0 +1,83 @@
+import os
+import fcntl
+import threading
+
+class FileLock:
+    """
+    Exclusive lock shared by the threads of a process and by the processes (e.g. the gunicorn workers and the job workers),
+    held with flock() on a lock file. The lock is released when the process dies, so it's never left behind by a crash.
+
+    Usage: with FileLock(filename): ...
+
+    Parameters
+    ----------
+    filename (string)
+        The lock file. Its folder is created if needed
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.thread_lock = threading.Lock()
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquires the lock. Returns False if blocking is False and the lock is held by another thread or process
+        """
+        if not self.thread_lock.acquire(blocking):
+            return False
+
+        try:
+            folder = os.path.dirname(self.filename)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self.fd)
+                self.fd = None
+                self.thread_lock.release()
+                return False
+
+        except Exception:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self.thread_lock.release()
+            raise
+
+        return True
+
+    def release(self):
+        # Closing the file releases the flock
+        os.close(self.fd)
+        self.fd = None
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def is_locked(filename):
+    """
+    Tells whether the lock file is held (see FileLock) by a process, this one included.
+    A missing lock file is not held
+    """
+    try:
+        fd = os.open(filename, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
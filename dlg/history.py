@@ -1,28 +1,133 @@
 import os
+import time
 import requests
+import requests.adapters
 import pandas as pd
 import numpy as np
 import datetime 
 import dateutil.relativedelta
 
-from pandas import json_normalize
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from toto_logger.logger import TotoLogger
 
+from dlg.artifacts import write_artifact, read_artifact, artifact_filename
+from dlg.compact import compact_history, concat_history
+from dlg.historycache import history_cache
+from dlg.jsonstream import iter_array
+
 toto_auth = os.environ['TOTO_API_AUTH']
 toto_host = os.environ['TOTO_HOST']
 
 logger = TotoLogger()
 
+# Fields of the expenses kept in the history
+EXPENSE_FIELDS = ['id', 'amount', 'category', 'date', 'description', 'monthly', 'user']
+
+# Size of the chunks in which the expenses API response is read
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Number of history shards downloaded at the same time
+DOWNLOAD_WORKERS = int(os.environ.get('TOTO_HISTORY_DOWNLOAD_WORKERS', 4))
+
+# Retries of a failed shard download, the first one after DOWNLOAD_BACKOFF seconds, then doubling
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+
+# Timeout (seconds) of the connection and of every read of a shard download
+DOWNLOAD_TIMEOUT = 60
+
+# HTTP session shared by the whole process: keeps the connections to the expenses API alive
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS))
+
+# Background downloaders, shared by the whole process: bounds the number of concurrent requests to the expenses API
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='history')
+
+class HistoryDownloadError(Exception): 
+    pass
+
+def retryable(error): 
+    '''
+    Tells whether a failed download is worth retrying: a connection error or timeout, or a 5xx or 429 (too many requests) response. 
+    A malformed response (KeyError, ValueError) or another 4xx response would fail again
+    '''
+    if isinstance(error, requests.HTTPError): 
+        return error.response is not None and (error.response.status_code >= 500 or error.response.status_code == 429)
+
+    return isinstance(error, requests.RequestException)
+
+def date_shards(date_gte, months): 
+    """
+    Splits the dates from date_gte (YYYYMMDD) to today in shards of #months calendar months. 
+    Returns a list of (date_gte, date_lte) tuples, the last one with date_lte None (no upper bound)
+    """
+    start = datetime.datetime.strptime(date_gte, '%Y%m%d')
+    today = datetime.datetime.today()
+
+    shards = []
+
+    while True: 
+        end = start.replace(day=1) + dateutil.relativedelta.relativedelta(months=months)
+
+        if end > today: 
+            shards.append((start.strftime('%Y%m%d'), None))
+            return shards
+
+        shards.append((start.strftime('%Y%m%d'), (end - datetime.timedelta(days=1)).strftime('%Y%m%d')))
+        start = end
+
+def expenses_frame(expenses): 
+    """
+    Builds the history data frame from the expenses (dicts, e.g. as decoded from the expenses API), 
+    keeping only the EXPENSE_FIELDS, and converts it to the compact history (see compact_history()). 
+    The expenses are consumed one at a time, so that only the columns are kept in memory. 
+
+    The "monthly" column is dropped if no expense has it. 
+    """
+    columns = {column: [] for column in EXPENSE_FIELDS}
+    amounts = array('d')
+    has_monthly = False
+
+    for expense in expenses: 
+        for column in ['id', 'category', 'date', 'description', 'user']: 
+            columns[column].append(expense.get(column))
+
+        amount = expense.get('amount')
+        amounts.append(np.nan if amount is None else float(amount))
+
+        monthly = expense.get('monthly')
+        columns['monthly'].append(monthly)
+        has_monthly = has_monthly or 'monthly' in expense
+
+    columns['amount'] = np.frombuffer(amounts, dtype=np.float64) if len(amounts) > 0 else np.empty(0)
+
+    if not has_monthly: 
+        del columns['monthly']
+
+    return compact_history(pd.DataFrame(columns))
+
 class HistoryDownloader: 
 
-    def __init__(self, folder, correlation_id, context=''): 
+    def __init__(self, folder, correlation_id, context='', cache=None): 
+        """
+        Constructor
+
+        Parameters
+        ----------
+        cache (HistoryCache, default None)
+            The local cache of the history: only the expenses since the last sync are downloaded. 
+            Defaults to the cache configured with the TOTO_HISTORY_CACHE environment variable, or no cache if that variable is not set
+        """
         self.correlation_id = correlation_id
         self.folder = folder
         self.context = context
+        self.cache = cache if cache is not None else history_cache()
 
     def download_from(self, user, num_months, from_date): 
         """
         This method will download the historical data starting #num_months before #from_date
+        and save it as a temporary file (see download())
 
         Parameters
         ----------
@@ -32,6 +137,18 @@ class HistoryDownloader:
         from_date (string) formatted YYYYMMDD
             The date from which to start the download, going back #num_months
         """
+        return self.download(user, dateGte=self.date_from(num_months, from_date))
+
+    def load_from(self, user, num_months, from_date): 
+        """
+        Same as download_from(), but returns the historical data as a data frame, without saving it
+        """
+        return self.load(user, dateGte=self.date_from(num_months, from_date))
+
+    def date_from(self, num_months, from_date): 
+        """
+        Returns the first day (YYYYMMDD) of the month #num_months before #from_date
+        """
         date_obj = datetime.datetime.strptime(from_date, '%Y%m%d')
         ym = str(date_obj.year) + str(date_obj.month).rjust(2, '0')
 
@@ -39,68 +156,151 @@ class HistoryDownloader:
         date_obj = date_obj.replace(day=1)
         date_obj -= dateutil.relativedelta.relativedelta(months=num_months)
 
-        dateGte = date_obj.strftime('%Y%m%d')
-
-        return self.download(user, dateGte=dateGte)
-
+        return date_obj.strftime('%Y%m%d')
 
     def download(self, user, dateGte='20100101'): 
         '''
         This method downloads all historical movements and saves it as a temporary file, to be used to then feature
         engineer the data to infer
         '''
+        df = self.load(user, dateGte=dateGte)
 
-        logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Starting historical data download from date {date}'.format(context=self.context, date=dateGte), 'info')
+        if df is None: 
+            return None
+
+        # Save the dataframe and return the filename
+        return write_artifact(df, '{folder}/history.{user}'.format(user=user, folder=self.folder))
+
+    def load(self, user, dateGte='20100101'): 
+        '''
+        This method downloads all historical movements and returns them as a compact history (see compact_history(), None if there's no history), 
+        without going through a temporary file. 
+        If there's a history cache, the movements are served from the cache, after downloading the ones since the last sync
+        '''
+        if self.cache is None: 
+            return self.fetch(user, dateGte=dateGte)
+
+        try: 
+            df = self.cache.get(user, dateGte, lambda date : self.fetch_shards(user, dateGte=date))
+        except HistoryDownloadError as e: 
+            logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - {e}'.format(context=self.context, e=e), 'error')
+            return None
 
-        history_filename = '{folder}/history.{user}.csv'.format(user=user, folder=self.folder);
+        if df.empty: 
+            return None
 
-        # Call the API to download the data
-        response = requests.get(
-            'https://{host}/apis/expenses/expenses?user={user}&dateGte={dateGte}'.format(user=user, dateGte=dateGte, host=toto_host),
-            headers={
-                'Accept': 'application/json',
-                'Authorization': toto_auth,
-                'x-correlation-id': self.correlation_id
-            }
-        )
+        logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Historical data served from the cache: {r} rows'.format(context=self.context, r=len(df)), 'info')
 
-        # Convert to JSON
-        json_response = response.json()
+        return df
 
-        # Extract the expenses array
+    def fetch(self, user, dateGte='20100101'): 
+        '''
+        This method calls the expenses API to download the historical movements from dateGte, 
+        and returns them as a data frame sorted by date (None if there's no history or if the download failed)
+        '''
         try: 
-            expenses = json_response['expenses']
-        except: 
-            logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Error reading the following microservice response: {r}'.format(context=self.context, r=json_response), 'error')
-            logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - No historical data'.format(context=self.context), 'warn')
+            return self.fetch_shards(user, dateGte=dateGte)
+        except HistoryDownloadError as e: 
+            logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - {e}'.format(context=self.context, e=e), 'error')
             return None
 
-        # Create a pandas data frame
-        df = json_normalize(expenses)
+    def fetch_shards(self, user, dateGte='20100101'): 
+        '''
+        Downloads the historical movements from dateGte in shards (see iter_shards()), merged in date order. 
+        Returns them as a compact history (see compact_history()) sorted by date, or None if there's no history. 
+        Raises HistoryDownloadError if a shard can't be downloaded
+        '''
+        logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Starting historical data download from date {date}'.format(context=self.context, date=dateGte), 'info')
+
+        # The shards are disjoint date ranges, each sorted by date: concatenating them in order keeps the whole history sorted
+        dfs = list(self.iter_shards(user, dateGte=dateGte))
 
-        if df.empty: 
+        if len(dfs) == 0: 
             logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - No historical data'.format(context=self.context), 'warn')
             return None
-        
-        try: 
-            df = df[['id', 'amount', 'category', 'date', 'description', 'monthly', 'yearMonth', 'user']]
-        except KeyError: 
+
+        df = concat_history(dfs)
+
+        if 'monthly' not in df.columns: 
             logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - No "monthly" field found in the response! Skipping it!'.format(context=self.context), 'warn')
-            df = df[['id', 'amount', 'category', 'date', 'description', 'yearMonth', 'user']]
 
-        # Generate a new yearMonth column
-        df['yearMonth'] = pd.to_numeric(df['date'].str[:-2])
+        logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Historical data downloaded: {r} rows'.format(context=self.context, r=len(df)), 'info')
+
+        return df
 
-        # Sort the dataframe
-        df.sort_values(by=['date'], ascending=True, inplace=True)
+    def iter_shards(self, user, dateGte='20100101'): 
+        '''
+        Downloads the historical movements from dateGte in shards of TOTO_HISTORY_SHARD_MONTHS months, 
+        fetched concurrently (see download_executor). 
+        Yields the shards that have movements (data frames sorted by date), in date order. 
+        Raises HistoryDownloadError if a shard can't be downloaded
+        '''
+        shards = date_shards(dateGte, int(os.environ.get('TOTO_HISTORY_SHARD_MONTHS', 3)))
 
-        # Save the dataframe
-        df.to_csv(history_filename) 
+        futures = [download_executor.submit(self.fetch_shard, user, date_gte, date_lte) for (date_gte, date_lte) in shards]
 
-        logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Historical data downloaded: {r} rows'.format(context=self.context, r=len(df)), 'info')
+        try: 
+            for future in futures: 
+                df = future.result()
+
+                if df is not None: 
+                    yield df
+        finally: 
+            for future in futures: 
+                future.cancel()
+
+    def fetch_shard(self, user, date_gte, date_lte=None): 
+        '''
+        Downloads the historical movements from date_gte to date_lte (both included, no upper bound if None), 
+        retrying up to DOWNLOAD_RETRIES times the failures that can be retried (see retryable()). 
+        The dates are also filtered here: the shard is right even if the API ignores the dateLte parameter. 
+        Returns them as a compact history (see compact_history()) sorted by date, or None if there are none
+        '''
+        url = 'https://{host}/apis/expenses/expenses?user={user}&dateGte={dateGte}'.format(user=user, dateGte=date_gte, host=toto_host)
+
+        if date_lte is not None: 
+            url = '{url}&dateLte={dateLte}'.format(url=url, dateLte=date_lte)
 
-        # Return the filename
-        return history_filename
+        for attempt in range(DOWNLOAD_RETRIES + 1): 
+
+            try: 
+                # Call the API to download the data, streaming the response
+                with session.get(url, headers={'Accept': 'application/json', 'Authorization': toto_auth, 'x-correlation-id': self.correlation_id}, stream=True, timeout=DOWNLOAD_TIMEOUT) as response: 
+
+                    response.raise_for_status()
+
+                    # Decode the expenses array one expense at a time, straight into the columns
+                    df = expenses_frame(iter_array(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), 'expenses'))
+
+                break
+
+            except (requests.RequestException, KeyError, ValueError) as e: 
+
+                if attempt == DOWNLOAD_RETRIES or not retryable(e): 
+                    raise HistoryDownloadError('Failed to download the history from {f} to {t} after {n} attempts: {e}'.format(f=date_gte, t=date_lte, n=attempt + 1, e=repr(e)))
+
+                logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Download from {f} to {t} failed, retrying: {e}'.format(context=self.context, f=date_gte, t=date_lte, e=repr(e)), 'warn')
+
+                time.sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
+
+        # The expenses of the neighbouring shards, if the API doesn't filter on the dates: they'd be counted twice
+        in_shard = df['date'].to_numpy() >= int(date_gte)
+
+        if date_lte is not None: 
+            in_shard &= df['date'].to_numpy() <= int(date_lte)
+
+        if not in_shard.all(): 
+            logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - {n} expenses out of the dates {f} to {t} dropped: the API ignored the date filters'.format(context=self.context, n=int((~in_shard).sum()), f=date_gte, t=date_lte), 'warn')
+
+            df = df[in_shard].reset_index(drop=True)
+
+        if df.empty: 
+            return None
+
+        # Sort the dataframe
+        df.sort_values(by=['date'], ascending=True, inplace=True)
+
+        return df
 
     def append_expense(self, expense_id, user, amount, category, description, date): 
         """
@@ -108,24 +308,17 @@ class HistoryDownloader:
         """
         logger.compute(self.correlation_id, '[ {context} ] - [ HISTORICAL ] - Appending expense to historical data.'.format(context=self.context), 'info')
 
-        history_filename = '{folder}/history.{user}.csv'.format(user=user, folder=self.folder);
-
-        date_obj = datetime.datetime.strptime(date, '%Y%m%d')
-        ym = str(date_obj.year) + str(date_obj.month).rjust(2, '0')
+        history_filename = artifact_filename('{folder}/history.{user}'.format(user=user, folder=self.folder))
 
         # Read the historical data
-        history_df = pd.read_csv(history_filename)
+        history_df = read_artifact(history_filename)
 
         # Create a new Data Frame for the expense to add
-        new_df = pd.DataFrame(np.array([[expense_id, amount, category, date, description, None, ym, user]]), columns=['id','amount','category','date','description','monthly','yearMonth','user'])
+        new_df = pd.DataFrame([[expense_id, float(amount), category, date, description, None, user]], columns=EXPENSE_FIELDS)
 
         # Merge the df 
-        full_df = pd.concat([history_df, new_df], axis=0, ignore_index=True, sort=False)
+        full_df = concat_history([history_df, new_df])
 
         # Save to a new file
-        history_ext_filename = history_filename[:-4] + '.ext.csv'
-
-        full_df.to_csv(history_ext_filename)
-
-        return history_ext_filename
+        return write_artifact(full_df, '{folder}/history.{user}.ext'.format(user=user, folder=self.folder))
 
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import pandas as pd
+
+from dlg.compact import is_compact, concat_history, empty_history
+from dlg.filelock import FileLock
+
+# Expenses dated up to this many days before the last synced expense are downloaded again at every sync,
+# to catch the expenses that are added or changed with a date in the past
+DELTA_OVERLAP_DAYS = 31
+
+class HistoryCache:
+    """
+    Local, per-user cache of the expenses history.
+
+    Every user (or 'all') has its own entry, with the history downloaded from the first requested date and a sync watermark.
+    A lookup downloads only the expenses dated on or after the watermark, replaces those of the cached history with them,
+    and serves the requested window from the cache.
+    The watermark is DELTA_OVERLAP_DAYS before the last synced expense.
+
+    An entry is downloaded again in full when:
+     - it's older than the TTL, to catch changes to old expenses that the watermark can't see (e.g. a label set by hand)
+     - a window starting before the cached history is requested
+
+    Changes to the "monthly" labels are applied by invalidating the entries (see invalidate()).
+
+    The entries are stored on disk and the least recently used ones are evicted when the cache exceeds its size.
+    An entry is read and written under the lock of its user, shared by the threads and the processes (e.g. the job workers) using the cache.
+    The cache is organized as:
+    {folder}/{user hash}/history.pkl
+    {folder}/{user hash}/meta.json
+    {folder}/{user hash}/.lock          the lock of the user (see FileLock), kept when the entry is dropped
+
+    Parameters
+    ----------
+    folder (string)
+        The folder where the history is cached
+
+    max_bytes (int, default 1 GB)
+        The max size of the cache on disk
+
+    ttl (int, default 24 hours)
+        The max age of an entry, in seconds, after which it's downloaded again in full
+    """
+
+    def __init__(self, folder, max_bytes=1024 * 1024 * 1024, ttl=24 * 3600):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.user_locks = {}
+
+    def _user_folder(self, user):
+        return '{folder}/{user}'.format(folder=self.folder, user=hashlib.sha1(str(user).encode('utf-8')).hexdigest()[:16])
+
+    def _user_lock(self, user):
+        with self.lock:
+            if user not in self.user_locks:
+                self.user_locks[user] = FileLock('{f}/.lock'.format(f=self._user_folder(user)))
+
+            return self.user_locks[user]
+
+    def _drop(self, user_folder):
+        '''
+        Drops an entry (under the lock of its user): its files are deleted, the folder and its lock are kept
+        '''
+        for name in ['meta.json', 'history.pkl']:
+            try:
+                os.remove('{f}/{n}'.format(f=user_folder, n=name))
+            except FileNotFoundError:
+                pass
+
+    def _read_meta(self, user_folder):
+        try:
+            with open('{f}/meta.json'.format(f=user_folder)) as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, user_folder, meta):
+        # Write and rename, so that concurrent readers never see a partial file
+        tmp_filename = '{f}/meta.json.{pid}.tmp'.format(f=user_folder, pid=os.getpid())
+
+        with open(tmp_filename, 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        os.replace(tmp_filename, '{f}/meta.json'.format(f=user_folder))
+
+    def _read(self, user_folder):
+        try:
+            df = pd.read_pickle('{f}/history.pkl'.format(f=user_folder))
+        except (FileNotFoundError, EOFError):
+            return None
+
+        # Cached before the history was compact (see compact_history()): downloaded again
+        if not is_compact(df):
+            return None
+
+        return df
+
+    def _write(self, user_folder, df, meta):
+        os.makedirs(user_folder, exist_ok=True)
+
+        filename = '{f}/history.pkl'.format(f=user_folder)
+        tmp_filename = '{f}.{pid}.tmp'.format(f=filename, pid=os.getpid())
+
+        df.to_pickle(tmp_filename)
+        os.replace(tmp_filename, filename)
+
+        meta['bytes'] = os.path.getsize(filename)
+
+        self._write_meta(user_folder, meta)
+
+    def _watermark(self, df, default):
+        '''
+        Returns the date (YYYYMMDD) from which the next sync has to download the expenses
+        '''
+        if df.empty:
+            return default
+
+        last_date = min(str(df['date'].max()), datetime.date.today().strftime('%Y%m%d'))
+
+        watermark = datetime.datetime.strptime(last_date, '%Y%m%d') - datetime.timedelta(days=DELTA_OVERLAP_DAYS)
+
+        return max(watermark.strftime('%Y%m%d'), default)
+
+    def get(self, user, date_gte, fetch):
+        """
+        Returns the history of the user from the date_gte date, syncing the cached history first
+
+        Parameters
+        ----------
+        user (string)
+            The user (or 'all')
+
+        date_gte (string) formatted YYYYMMDD
+            The first date of the history to return
+
+        fetch (function)
+            The function that downloads the history: fetch(date_gte) returns the expenses dated on or after date_gte,
+            sorted by date (compact history, see compact_history()), or None if there are none
+
+        Returns
+        -------
+        history (DataFrame)
+            The expenses of the user dated on or after date_gte (compact history), sorted by date. Can be empty
+        """
+        user_folder = self._user_folder(user)
+        now = time.time()
+
+        with self._user_lock(user):
+
+            meta = self._read_meta(user_folder)
+            cached = None
+
+            if meta is not None and meta['from'] <= date_gte and now - meta['refreshed'] < self.ttl:
+                cached = self._read(user_folder)
+
+            if cached is None:
+                # Full download
+                df = fetch(date_gte)
+                meta = {"user": str(user), "from": date_gte, "refreshed": now}
+            else:
+                # Delta download: the expenses from the watermark replace the cached ones
+                delta = fetch(meta['watermark'])
+                df = concat_history([cached[cached['date'] < int(meta['watermark'])], delta])
+
+            if df is None:
+                df = empty_history()
+
+            df = df.reset_index(drop=True)
+
+            meta['watermark'] = self._watermark(df, meta['from'])
+            meta['accessed'] = now
+
+            self._write(user_folder, df, meta)
+
+        self.evict(keep=user_folder)
+
+        return df[df['date'] >= int(date_gte)].reset_index(drop=True)
+
+    def invalidate(self, since=None):
+        """
+        Invalidates the cached history (e.g. when the "monthly" labels of some expenses change)
+
+        Parameters
+        ----------
+        since (string or int, default None) formatted YYYYMMDD
+            The date of the oldest changed expense: the expenses from that date are downloaded again at the next sync.
+            If None, the whole cache is dropped
+        """
+        if not os.path.isdir(self.folder):
+            return
+
+        if since is not None:
+            since = str(since)
+
+        for entry in os.listdir(self.folder):
+
+            user_folder = '{folder}/{entry}'.format(folder=self.folder, entry=entry)
+            meta = self._read_meta(user_folder)
+
+            if meta is None:
+                continue
+
+            with self._user_lock(meta['user']):
+
+                if since is None:
+                    self._drop(user_folder)
+                    continue
+
+                meta = self._read_meta(user_folder)
+
+                if meta is not None and since < meta['watermark']:
+                    meta['watermark'] = max(since, meta['from'])
+                    self._write_meta(user_folder, meta)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+
+        Parameters
+        ----------
+        keep (string, default None)
+            The folder of an entry not to evict (e.g. the one that has just been used)
+        """
+        entries = []
+
+        for entry in os.listdir(self.folder):
+
+            user_folder = '{folder}/{entry}'.format(folder=self.folder, entry=entry)
+            meta = self._read_meta(user_folder)
+
+            if meta is not None:
+                entries.append((meta['accessed'], meta.get('bytes', 0), user_folder, meta['user']))
+
+        total = sum([entry[1] for entry in entries])
+
+        for (accessed, size, user_folder, user) in sorted(entries):
+
+            if total <= self.max_bytes:
+                break
+
+            if user_folder == keep:
+                continue
+
+            with self._user_lock(user):
+                self._drop(user_folder)
+
+            total -= size
+
+# The caches shared by the whole process, by folder
+history_caches = {}
+
+def history_cache():
+    '''
+    Returns the history cache configured with the TOTO_HISTORY_CACHE environment variable (folder),
+    TOTO_HISTORY_CACHE_MB (max size, default 1024) and TOTO_HISTORY_CACHE_TTL (hours, default 24), or None if not configured
+    '''
+    folder = os.environ.get('TOTO_HISTORY_CACHE')
+
+    if not folder:
+        return None
+
+    if folder not in history_caches:
+        history_caches[folder] = HistoryCache(
+            folder,
+            max_bytes=int(os.environ.get('TOTO_HISTORY_CACHE_MB', 1024)) * 1024 * 1024,
+            ttl=float(os.environ.get('TOTO_HISTORY_CACHE_TTL', 24)) * 3600
+        )
+
+    return history_caches[folder]
@@ -0,0 +1,139 @@
+import json
+import codecs
+
+# Whitespace and separators skipped between JSON values
+SKIPPED = ' \t\n\r,:'
+
+decoder = json.JSONDecoder()
+
+class JsonStream:
+    """
+    Incremental reader of a JSON document coming in chunks (e.g. requests' Response.iter_content()).
+
+    Only the unread part of the document (at most one value plus one chunk) is kept in memory.
+
+    Parameters
+    ----------
+    chunks (iterable of bytes)
+        The chunks of the UTF-8 encoded document
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.done = False
+
+    def _more(self):
+        '''
+        Reads the next chunk into the buffer. Returns False if the document is over
+        '''
+        if self.done:
+            return False
+
+        chunk = next(self.chunks, None)
+
+        if chunk is None:
+            self.done = True
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(b'', final=True)
+        else:
+            self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+
+        self.pos = 0
+
+        return True
+
+    def peek(self):
+        '''
+        Skips whitespace and separators and returns the next character (None at the end of the document)
+        '''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in SKIPPED:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._more():
+                return None
+
+    def expect(self, char):
+        '''
+        Consumes the next character, that has to be char
+        '''
+        if self.peek() != char:
+            raise ValueError('Invalid JSON: expected "{c}" at "{s}"'.format(c=char, s=self.buffer[self.pos:self.pos + 50]))
+
+        self.pos += 1
+
+    def value(self):
+        '''
+        Decodes the next value
+        '''
+        self.peek()
+
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(self.buffer, self.pos)
+
+                # A value at the end of the buffer could be truncated (e.g. a number): only accept it if something follows it
+                if end < len(self.buffer) or self.done:
+                    self.pos = end
+                    return value
+
+            except json.JSONDecodeError:
+                if self.done:
+                    raise
+
+            self._more()
+
+def iter_array(chunks, key):
+    """
+    Iterates over the items of the array stored under the key of a top-level JSON object (e.g. the "expenses" of {"expenses": [...]}),
+    decoding one item at a time
+
+    Parameters
+    ----------
+    chunks (iterable of bytes)
+        The chunks of the UTF-8 encoded document
+
+    key (string)
+        The key of the array in the top-level object
+
+    Raises
+    ------
+    KeyError if the top-level object doesn't have the key, ValueError if the document is not valid JSON
+    """
+    stream = JsonStream(chunks)
+
+    stream.expect('{')
+
+    while stream.peek() != '}':
+
+        if stream.peek() is None:
+            raise ValueError('Invalid JSON: unexpected end of document')
+
+        name = stream.value()
+        stream.peek()
+
+        if name != key:
+            # Not the array: decode and drop the value
+            stream.value()
+            continue
+
+        if stream.peek() != '[':
+            raise KeyError(key)
+
+        stream.expect('[')
+
+        while stream.peek() != ']':
+
+            if stream.peek() is None:
+                raise ValueError('Invalid JSON: unexpected end of document')
+
+            yield stream.value()
+
+        return
+
+    raise KeyError(key)
@@ -0,0 +1,181 @@
+import numpy as np
+import pandas as pd
+
+from dlg.compact import MISSING_AMOUNT
+
+# Names of the features computed on each of the 4 previous months
+# The month offset is appended as a suffix (e.g. sacsw1_m1, sacsw1_m2, ...)
+MONTH_FEATURE_NAMES = ['sacsw1', 'sacsw2', 'sacsw3m', 'sac1', 'sac2m', 'sacd', 'sacd3']
+
+LOOKBACK_MONTHS = 4
+
+LOOKBACK_FEATURE_NAMES = ['{f}_m{k}'.format(f=f, k=k) for k in range(1, LOOKBACK_MONTHS + 1) for f in MONTH_FEATURE_NAMES] + ['sesm']
+
+# Max number of (expense, candidate) pairs whose word overlap is computed in one go
+# Bounds the temporary sparse matrices to 2 * OVERLAP_CHUNK_SIZE rows of the bag of words
+OVERLAP_CHUNK_SIZE = 65536
+
+def to_engineer(df, training=False):
+    '''
+    Returns a boolean array telling which expenses of df need their features engineered:
+    all of them when training, only those that haven't the 'monthly' field set otherwise
+    '''
+    if not training and 'monthly' in df.columns:
+        return df['monthly'].isnull().to_numpy()
+
+    return np.ones(len(df), dtype=bool)
+
+def lookback_flags(n, s, same_day, before, after):
+    '''
+    Computes the 7 features of a month (see MONTH_FEATURE_NAMES), for one or more expenses, given:
+    - n:        the number of items of the month with the same cat and amt
+    - s:        how many of them share words with the expense
+    - same_day: whether one of them has the same day of the month as the expense
+    - before:   whether one of them is at most 3 days after the expense's day
+    - after:    whether one of them is at most 3 days before the expense's day
+
+    Returns an array with one row per expense and 7 columns
+    '''
+    n = np.asarray(n)
+    s = np.asarray(s)
+    same_day = np.asarray(same_day) & (n > 0)
+
+    features = np.column_stack([
+        (n == 1) & (s == 1),    # sacsw1: exactly 1 payment with the same amt, cat and that shares words
+        (n > 1) & (s == 2),     # sacsw2: 2 payments with the same amt and cat that share some words
+        (n > 1) & (s > 2),      # sacsw3m: 3+ payments with the same amt and cat that share some words
+        (n == 1) & (s == 0),    # sac1: exactly 1 payment with the same amt, cat and that DOES NOT share words
+        (n > 1) & (s == 0),     # sac2m: 2 or more payments with the same amt and cat that DO NOT share words
+        same_day,               # sacd: one of the items has the same exact date
+        (n > 0) & ~same_day & np.asarray(before) & np.asarray(after)  # sacd3: no item on the same date, but items within +- 3 days
+    ])
+
+    return features.astype(np.int64)
+
+class LookbackIndex:
+    """
+    Keyed index on (user, category, amount, month) of a data set, used to compute
+    the "same amount & category" lookback features (sacsw*, sac*, sacd*) and sesm of
+    any set of expenses of that data set with grouped joins instead of row-by-row scans.
+
+    Parameters
+    ----------
+    df (DataFrame)
+        The data set, as a compact history (see compact.compact_history())
+
+    bow (scipy.sparse.csr_matrix)
+        The binarized bag of words of the descriptions, one row per row of df (by position)
+    """
+
+    def __init__(self, df, bow):
+
+        self.bow = bow
+
+        # Rows with a missing user, category or amount never match anything (NaN != NaN)
+        keys = df.groupby(['user', 'category', 'amount'], sort=False, dropna=True, observed=True).ngroup()
+        keys = keys.fillna(-1).to_numpy(dtype=np.int64, copy=True)
+        keys[df['amount'].to_numpy() == MISSING_AMOUNT] = -1
+
+        months = df['month'].to_numpy().astype(np.int64)
+        valid = (keys >= 0) & (months >= 0)
+
+        self.keys = keys
+        self.months = np.where(valid, months, -1)
+        self.days = df['date'].to_numpy().astype(np.int64) % 100
+        self.valid = valid
+
+        # The index itself: every valid row, identified by its position in the data set
+        positions = np.flatnonzero(valid)
+        self.table = pd.DataFrame({'key': self.keys[positions], 'month': self.months[positions], 'pos': positions})
+
+    def _pairs(self, targets, candidates, month_delta):
+        '''
+        Joins the targets (positions) with the candidates (index table) on the same key and on month = target month + month_delta
+        Returns two aligned arrays: the index (in targets) of the target and the position of the matching candidate
+        '''
+        t = pd.DataFrame({'key': self.keys[targets], 'month': self.months[targets] + month_delta, 'ti': np.arange(len(targets))})
+        t = t[self.valid[targets]]
+
+        pairs = t.merge(candidates, on=['key', 'month'], how='inner', sort=False)
+
+        return (pairs['ti'].to_numpy(dtype=np.int64), pairs['pos'].to_numpy(dtype=np.int64))
+
+    def _overlaps(self, a, b):
+        '''
+        Returns, for each pair of positions (a[i], b[i]), the number of distinct words that the two descriptions share
+        Since the bag of words is binarized, that's the row-wise product of the two sets of rows
+        '''
+        overlaps = np.zeros(len(a), dtype=np.int64)
+
+        for start in range(0, len(a), OVERLAP_CHUNK_SIZE):
+            end = start + OVERLAP_CHUNK_SIZE
+            overlaps[start:end] = np.asarray(self.bow[a[start:end]].multiply(self.bow[b[start:end]]).sum(axis=1)).ravel()
+
+        return overlaps
+
+    def _month_features(self, targets, month_delta):
+        '''
+        Computes the 7 features of the targets against the expenses of the month (target month + month_delta)
+        '''
+        n_targets = len(targets)
+
+        (ti, pos) = self._pairs(targets, self.table, month_delta)
+
+        shared = self._overlaps(targets[ti], pos) > 0
+        t_days = self.days[targets][ti]
+        c_days = self.days[pos]
+
+        # Number of items with the same cat and amt, and how many of them share words
+        n = np.bincount(ti, minlength=n_targets)
+        s = np.bincount(ti, weights=shared, minlength=n_targets)
+
+        # Date checks: same day, or at least one item before (day + 3) and one item after (day - 3)
+        same_day = np.bincount(ti, weights=(c_days == t_days), minlength=n_targets) > 0
+        before = np.bincount(ti, weights=(c_days <= t_days + 3), minlength=n_targets) > 0
+        after = np.bincount(ti, weights=(c_days >= t_days - 3), minlength=n_targets) > 0
+
+        return lookback_flags(n, s, same_day, before, after)
+
+    def _sesm(self, targets, pool):
+        '''
+        sesm: are there other expenses in the pool, in the same month, with the same amt and cat, that share words?
+        The expense itself is part of the pool
+        '''
+        n_targets = len(targets)
+
+        candidates = pd.DataFrame({'key': self.keys[pool], 'month': self.months[pool], 'pos': pool})
+
+        (ti, pos) = self._pairs(targets, candidates, 0)
+
+        shared = self._overlaps(targets[ti], pos) > 0
+
+        n = np.bincount(ti, minlength=n_targets)
+        s = np.bincount(ti, weights=shared, minlength=n_targets)
+
+        return ((n > 1) & (s > 1)).astype(np.int64)
+
+    def compute(self, targets, pool=None):
+        """
+        Computes the lookback features of the specified expenses
+
+        Parameters
+        ----------
+        targets (array of int)
+            The positions (in the data set) of the expenses for which to compute the features
+
+        pool (array of int, default None)
+            The positions of the expenses to consider when computing sesm (same month items).
+            Defaults to the targets themselves
+
+        Returns
+        -------
+        features (DataFrame)
+            A data frame with one row per target (in the same order) and the LOOKBACK_FEATURE_NAMES columns
+        """
+        targets = np.asarray(targets, dtype=np.int64)
+        pool = targets if pool is None else np.asarray(pool, dtype=np.int64)
+
+        blocks = [self._month_features(targets, -k) for k in range(1, LOOKBACK_MONTHS + 1)]
+        blocks.append(self._sesm(targets, pool)[:, None])
+
+        return pd.DataFrame(np.hstack(blocks), columns=LOOKBACK_FEATURE_NAMES)
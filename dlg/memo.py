@@ -0,0 +1,98 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# Max number of feature patterns memoized per model
+MEMO_MAX_PATTERNS = 65536
+
+class MemoizedModel:
+    """
+    Memo table of the predictions of a model, keyed on the feature vector.
+
+    All the model features are 0/1 flags, so every row can be packed into an integer key
+    (one bit per feature) and there's a bounded number of distinct inputs that the model can see.
+    A prediction evaluates the model once per pattern that was never seen before and broadcasts
+    the results to all the rows. Rows that are not binary (or with more than 64 features) go to the model.
+
+    One MemoizedModel is created per loaded model (see model.cache.ModelCache), so the memo table
+    never outlives the model version it was built with.
+
+    Parameters
+    ----------
+    model (object)
+        The model to memoize: a classifier with predict() and classes_ (e.g. MLPClassifier or CompiledMLP)
+
+    max_patterns (int, default MEMO_MAX_PATTERNS)
+        The max number of patterns in the memo table. When full, the table is cleared
+    """
+
+    def __init__(self, model, max_patterns=MEMO_MAX_PATTERNS):
+        self.model = model
+        self.max_patterns = max_patterns
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.hits = 0
+        self.evaluated = 0
+
+    def _keys(self, X):
+        '''
+        Packs every (binary) row of X into an integer key. Returns None if X can't be packed
+        '''
+        if X.shape[1] > 64 or not np.isin(X, (0, 1)).all():
+            return None
+
+        bits = np.left_shift(np.uint64(1), np.arange(X.shape[1], dtype=np.uint64))
+
+        return X.astype(np.uint64) @ bits
+
+    def predict(self, X):
+        """
+        Same as the model's predict()
+        """
+        values = X.to_numpy() if isinstance(X, pd.DataFrame) else np.asarray(X)
+
+        keys = self._keys(values) if len(values) > 0 else None
+
+        if keys is None:
+            return self.model.predict(X)
+
+        (patterns, first, inverse) = np.unique(keys, return_index=True, return_inverse=True)
+
+        memo = self.memo
+        known = np.array([p in memo for p in patterns.tolist()], dtype=bool)
+        unknown = ~known
+
+        results = np.empty(len(patterns), dtype=self.model.classes_.dtype)
+        results[known] = [memo[p] for p in patterns[known].tolist()]
+
+        # Evaluate the model once per new pattern
+        if unknown.any():
+            rows = first[unknown]
+            results[unknown] = self.model.predict(X.iloc[rows] if isinstance(X, pd.DataFrame) else values[rows])
+
+            with self.lock:
+                if len(self.memo) + len(rows) > self.max_patterns:
+                    self.memo = {}
+
+                self.memo.update(zip(patterns[unknown].tolist(), results[unknown].tolist()))
+
+        evaluated = int(unknown.sum())
+
+        self.rows += len(values)
+        self.hits += len(values) - evaluated
+        self.evaluated += evaluated
+
+        return results[inverse.ravel()]
+
+    def stats(self):
+        """
+        Returns the memo table metrics: rows predicted, rows served without evaluating the model (hits), patterns evaluated
+        """
+        return {
+            "rows": self.rows,
+            "hits": self.hits,
+            "hitRate": self.hits / self.rows if self.rows > 0 else None,
+            "patternsEvaluated": self.evaluated,
+            "patterns": len(self.memo)
+        }
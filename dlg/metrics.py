@@ -0,0 +1,192 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Max number of ids per SQL query
+QUERY_CHUNK_SIZE = 500
+
+def class1_scores(tp, fp, fn):
+    '''
+    Returns the precision, recall and F1 score of class 1 (0 when not defined), in the format of Scorer.do()
+    '''
+    precision = tp / (tp + fp) if tp + fp > 0 else 0.0
+    recall = tp / (tp + fn) if tp + fn > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+    return [
+        {"name": "Precision Class 1", "value": precision},
+        {"name": "Recall Class 1", "value": recall},
+        {"name": "F1 score", "value": f1}
+    ]
+
+class MetricsStore:
+    """
+    Persistent confusion matrix of every model version, accumulated as the predictions get their labels.
+
+    Every prediction (published or suppressed) is recorded as pending, with the version of the model that made it (see record_predictions()).
+    When the label of the expense arrives (see record_labels()), the pending prediction is counted in the confusion matrix
+    of its model version (true/false positives and negatives) and is no longer pending: every prediction is counted once.
+    A newer prediction of the same expense replaces the pending one.
+
+    A published prediction comes back as a label: the echo of the model's own update (the first label equal to a published prediction).
+    The echo counts the prediction as kept by the user (true positive or negative), and the prediction stays pending: 
+    if the user later sets another label, the count is moved to the false negatives or positives.
+
+    The metrics of a version (see scores()) are then computed from its 4 counts.
+
+    The store is a SQLite database, safe to share between the threads of a process and between processes.
+
+    Parameters
+    ----------
+    filename (string)
+        The SQLite database file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False, timeout=30)
+
+        # Readers don't block the writer of another process
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, version TEXT NOT NULL, predicted INTEGER NOT NULL, ts REAL NOT NULL, echo INTEGER NOT NULL DEFAULT 0, kept INTEGER NOT NULL DEFAULT 0)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS confusion (version TEXT PRIMARY KEY, tp INTEGER NOT NULL, fp INTEGER NOT NULL, fn INTEGER NOT NULL, tn INTEGER NOT NULL)')
+
+            # Stores created before the echo and kept columns
+            columns = [column[1] for column in self.connection.execute('PRAGMA table_info(pending)')]
+
+            for column in ['echo', 'kept']:
+                if column not in columns:
+                    self.connection.execute('ALTER TABLE pending ADD COLUMN {c} INTEGER NOT NULL DEFAULT 0'.format(c=column))
+
+    def record_predictions(self, version, ids, predicted, published=True):
+        """
+        Records the predictions (iterable of bools) made by the model version for the ids, waiting for their labels
+
+        Parameters
+        ----------
+        published (boolean, default True)
+            True if the predictions have been published (their echo is expected), False if they've been suppressed
+        """
+        now = time.time()
+
+        with self.lock, self.connection:
+            # A suppressed prediction equal to the pending one still expects the echo of the pending one. 
+            # A prediction already counted as kept stays so, unless another prediction (or version) replaces it
+            self.connection.executemany(
+                'INSERT INTO pending (id, version, predicted, ts, echo) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET version = excluded.version, predicted = excluded.predicted, ts = excluded.ts, '
+                'echo = CASE WHEN excluded.echo = 1 OR pending.predicted = excluded.predicted THEN MAX(pending.echo, excluded.echo) ELSE 0 END, '
+                'kept = CASE WHEN pending.predicted = excluded.predicted AND pending.version = excluded.version THEN pending.kept ELSE 0 END',
+                [(str(id), str(version), int(p), now, int(published)) for (id, p) in zip(ids, predicted)]
+            )
+
+    def record_labels(self, ids, labels):
+        """
+        Records the labels (iterable of bools) of the ids: the pending predictions of those ids are counted in the confusion matrix
+        of their model version. The echo of a published prediction counts it as kept, a later label of the user corrects the count (see MetricsStore)
+
+        Returns
+        -------
+        counted (int)
+            The number of predictions counted (or corrected)
+        """
+        labels = {str(id): bool(label) for (id, label) in zip(ids, labels)}
+        keys = list(labels.keys())
+        counts = {}
+        counted = 0
+
+        with self.lock, self.connection:
+            for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+                chunk = keys[i:i + QUERY_CHUNK_SIZE]
+                placeholders = ','.join(['?'] * len(chunk))
+
+                rows = self.connection.execute('SELECT id, version, predicted, echo, kept FROM pending WHERE id IN ({p})'.format(p=placeholders), chunk).fetchall()
+
+                echoes = []
+                done = []
+
+                for (id, version, predicted, echo, kept) in rows:
+                    label = labels[id]
+                    count = counts.setdefault(version, {"tp": 0, "fp": 0, "fn": 0, "tn": 0})
+
+                    if kept and label == bool(predicted):
+                        # Confirmed by the user: already counted
+                        done.append(id)
+                        continue
+
+                    if kept:
+                        # Corrected by the user: it was counted as kept
+                        count['tp' if predicted else 'tn'] -= 1
+
+                    count[('tp' if label else 'fp') if predicted else ('fn' if label else 'tn')] += 1
+                    counted += 1
+
+                    if echo and label == bool(predicted):
+                        echoes.append(id)
+                    else:
+                        done.append(id)
+
+                # The echoes stay pending, counted as kept, for a correction of the user
+                self.connection.executemany('UPDATE pending SET echo = 0, kept = 1 WHERE id = ?', [(id, ) for id in echoes])
+
+                if len(done) > 0:
+                    self.connection.execute('DELETE FROM pending WHERE id IN ({p})'.format(p=','.join(['?'] * len(done))), done)
+
+            for (version, c) in counts.items():
+                self.connection.execute(
+                    'INSERT INTO confusion (version, tp, fp, fn, tn) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT(version) DO UPDATE SET tp = tp + excluded.tp, fp = fp + excluded.fp, fn = fn + excluded.fn, tn = tn + excluded.tn',
+                    (version, c['tp'], c['fp'], c['fn'], c['tn'])
+                )
+
+        return counted
+
+    def confusion(self, version):
+        """
+        Returns the confusion matrix of the model version: a dict with the tp, fp, fn and tn counts (all 0 if nothing was counted yet)
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT tp, fp, fn, tn FROM confusion WHERE version = ?', (str(version), )).fetchone()
+
+        if row is None:
+            return {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+
+        return dict(zip(['tp', 'fp', 'fn', 'tn'], row))
+
+    def scores(self, version):
+        """
+        Returns the precision, recall and F1 score of class 1 of the model version, from its confusion matrix (see class1_scores())
+        """
+        c = self.confusion(version)
+
+        return class1_scores(c['tp'], c['fp'], c['fn'])
+
+# The stores shared by the whole process, by file
+metrics_stores = {}
+
+def metrics_store():
+    '''
+    Returns the confusion matrices of the model versions: the TOTO_METRICS_STORE environment variable (SQLite file),
+    or {TOTO_TMP_FOLDER}/erboh/metrics.sqlite if not set. TOTO_METRICS_STORE can be set to 'none' to disable them
+    '''
+    filename = os.environ.get('TOTO_METRICS_STORE')
+
+    if filename is None and os.environ.get('TOTO_TMP_FOLDER'):
+        filename = '{tmp}/erboh/metrics.sqlite'.format(tmp=os.environ['TOTO_TMP_FOLDER'])
+
+    if filename is None or filename == 'none':
+        return None
+
+    if filename not in metrics_stores:
+        metrics_stores[filename] = MetricsStore(filename)
+
+    return metrics_stores[filename]
@@ -0,0 +1,124 @@
+import numpy as np
+
+from dlg.artifacts import read_artifact
+
+def month_index(year_month):
+    '''
+    Converts a YYYYMM month (int or array of ints) into a progressive month number (year * 12 + month - 1)
+    so that month arithmetics (m - 1, m - 4, ...) become simple subtractions
+    '''
+    return (year_month // 100) * 12 + (year_month % 100) - 1
+
+def year_month(month):
+    '''
+    Converts a progressive month number back to a YYYYMM month
+    '''
+    return (month // 12) * 100 + (month % 12) + 1
+
+class MonthStore:
+    """
+    Month-partitioned expense history.
+
+    The history is sorted once by (month, date) so that the expenses of every month are a contiguous
+    range of rows. Looking up a month, or a window of months (e.g. the 4 months before a month),
+    is then a slice of the data frame and not a scan of the month column.
+
+    Expenses without a month are kept at the end of the data frame, outside of any month.
+
+    Parameters
+    ----------
+    df (DataFrame)
+        The expenses history, as a compact history (see compact.compact_history()): the month and date columns are numbers
+    """
+
+    def __init__(self, df):
+
+        months = df['month'].to_numpy().astype(np.int64)
+        dates = df['date'].to_numpy().astype(np.int64)
+
+        has_month = months >= 0
+        months = np.where(has_month, months, np.iinfo(np.int64).max)
+
+        # Stable sort: expenses of the same day keep their original order
+        order = np.lexsort((dates, months))
+
+        self.df = df.iloc[order].reset_index(drop=True)
+
+        sorted_months = months[order][:int(has_month.sum())]
+
+        if len(sorted_months) == 0:
+            self.first_month = 0
+            self.last_month = -1
+        else:
+            self.first_month = int(sorted_months[0])
+            self.last_month = int(sorted_months[-1])
+
+        # offsets[m - first_month] is the first row of month m, offsets[m - first_month + 1] the row after its last
+        self.offsets = np.searchsorted(sorted_months, np.arange(self.first_month, self.last_month + 2))
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Loads a history file (a compact history, as saved by the HistoryDownloader) into a MonthStore
+        """
+        return cls(read_artifact(filename))
+
+    def __len__(self):
+        return len(self.df)
+
+    def months(self):
+        """
+        Returns the month numbers (see month_index()) that have at least one expense, in chronological order
+        """
+        counts = np.diff(self.offsets)
+
+        return np.flatnonzero(counts) + self.first_month
+
+    def _offset(self, month):
+        '''
+        Returns the first row of the specified month (or of the first month after it)
+        '''
+        i = min(max(month - self.first_month, 0), len(self.offsets) - 1)
+
+        return int(self.offsets[i])
+
+    def window(self, month_from, month_to):
+        """
+        Returns the slice of rows of all the expenses from month_from to month_to (both included)
+
+        Parameters
+        ----------
+        month_from (int)
+            The first month, as a month number (see month_index())
+
+        month_to (int)
+            The last month, as a month number (see month_index())
+        """
+        if month_to < month_from:
+            return slice(0, 0)
+
+        return slice(self._offset(month_from), self._offset(month_to + 1))
+
+    def month(self, month, delta=0):
+        """
+        Returns the slice of rows of the expenses of the month (month + delta)
+
+        Parameters
+        ----------
+        month (int)
+            The month, as a month number (see month_index())
+
+        delta (int, default 0)
+            How many months before or after this one to look at (+1, +2, -1, ...)
+        """
+        return self.window(month + delta, month + delta)
+
+    def expenses(self, month_from, month_to=None):
+        """
+        Returns the data frame of the expenses from month_from to month_to (both included)
+        If month_to is not provided, only returns the expenses of month_from
+        """
+        if month_to is None:
+            month_to = month_from
+
+        return self.df.iloc[self.window(month_from, month_to)]
@@ -3,6 +3,8 @@ import joblib
 
 from toto_logger.logger import TotoLogger
 
+from dlg.artifacts import write_artifact, read_artifact
+
 logger = TotoLogger()
 
 class Predictor: 
@@ -24,6 +26,11 @@ class Predictor:
 
         model (object) MANDATORY
             The model pickle file to use for the prediction. 
+
+        features_filename (string or DataFrame)
+            The features file, or the features data frame when the pipeline runs in memory
+
+        After do(), the predictions (features + 'occurs_monthly' column) are available in memory as self.predictions
         """
         self.correlation_id = cid
         self.features_filename = features_filename
@@ -32,18 +39,23 @@ class Predictor:
         self.save_to_folder = save_to_folder
         self.model = model
         self.context = context
+        self.predictions = None
 
     def do(self): 
         """
         Predicts based on the provided data
         """
 
-        if self.features_filename == None: 
+        if self.features_filename is None: 
             return (None, None, None)
 
         try: 
             # 1. Get the features
-            features = pd.read_csv(self.features_filename)
+            if isinstance(self.features_filename, pd.DataFrame): 
+                features = self.features_filename.copy()
+            else: 
+                # Only read the columns that are needed
+                features = read_artifact(self.features_filename, columns=self.predict_feature_names + ['id', 'monthly', 'current_monthly'])
             
             if self.predict_only_labeled:
                 # Only keep the features that are labeled!
@@ -54,7 +66,7 @@ class Predictor:
                 features['monthly'] = features['monthly'].apply(lambda x : int(x == True))
 
         except:
-            logger.compute(self.correlation_id, '[ {context} ] - [ PREDICTING ] - Problem reading file {f}. Stopping'.format(context=self.context, f=self.features_filename), 'error')
+            logger.compute(self.correlation_id, '[ {context} ] - [ PREDICTING ] - Problem reading the features. Stopping'.format(context=self.context), 'error')
             return (None, None, None)
 
         logger.compute(self.correlation_id, '[ {context} ] - [ PREDICTING ] - Predicting on {r} rows'.format(context=self.context, r=len(features)),'info')
@@ -69,12 +81,12 @@ class Predictor:
 
         logger.compute(self.correlation_id, '[ {context} ] - [ PREDICTING ] - Prediction completed. Generated {p} predictions'.format(context=self.context, p=len(y_pred)),'info')
 
+        features['occurs_monthly'] = y_pred
+        self.predictions = features
+
         if self.save_to_folder != None:
             # Save to file
-            predictions_filename = '{folder}/predictions.csv'.format(folder=self.save_to_folder)
-
-            features['occurs_monthly'] = y_pred
-            features.to_csv(predictions_filename)
+            predictions_filename = write_artifact(features, '{folder}/predictions'.format(folder=self.save_to_folder))
 
             logger.compute(self.correlation_id, '[ {context} ] - [ PREDICTING ] - Predictions saved on disk: {f}'.format(context=self.context, f=predictions_filename), 'info')
 
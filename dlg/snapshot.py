@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import glob
+import shutil
+import pandas as pd
+
+from toto_logger.logger import TotoLogger
+
+from dlg.featurestore import FEATURE_VERSION
+from dlg.filelock import FileLock
+from dlg.history import HistoryDownloadError
+
+logger = TotoLogger()
+
+class FeatureSnapshots:
+    """
+    Versioned snapshots of the training features (the features of all the labeled expenses, see FeatureEngineering(training=True)),
+    shared by the training and the scoring.
+
+    A snapshot is keyed by the feature code version (FEATURE_VERSION) and by the watermark of the history it was built on (see history_watermark()): 
+    the date of the last expense, the number of expenses of that day, and the label changes counter (see count_label_changes()) when the download started.
+    A run reuses the newest snapshot of the current version that is younger than max_age and whose history hasn't changed, skipping 
+    the history download and the feature engineering: no label changes since, and no new expenses since its last expense date 
+    (checked downloading the expenses of that date onwards only). Otherwise it builds the features and stores them as a new snapshot.
+    The label changes are counted as this service sees them (the labels it publishes, the labels of the changed expenses it receives): 
+    max_age bounds how long a snapshot can miss the changes made elsewhere.
+
+    Retention: only the newest #keep snapshots are kept. Snapshots older than retention, or of another feature version, are deleted.
+
+    The snapshots are organized as:
+    {folder}/{version}.{built}/features.pkl
+    {folder}/{version}.{built}/meta.json
+    {folder}/label-changes                      the label changes counter
+
+    Parameters
+    ----------
+    folder (string)
+        The folder where the snapshots are stored
+
+    max_age (float, default 24 hours)
+        The max age (seconds) of a snapshot to be reused
+
+    keep (int, default 2)
+        The number of snapshots to keep
+
+    retention (float, default 7 days)
+        The max age (seconds) of a snapshot before it's deleted
+    """
+
+    def __init__(self, folder, max_age=24 * 3600, keep=2, retention=7 * 24 * 3600):
+        self.folder = folder
+        self.max_age = max_age
+        self.keep = keep
+        self.retention = retention
+
+    def _read_meta(self, snapshot_folder):
+        try:
+            with open('{f}/meta.json'.format(f=snapshot_folder)) as meta_file:
+                return json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def snapshots(self):
+        """
+        Returns the metadata of the complete snapshots (dicts with the folder, version, built time, history watermark, rows and feature names), newest first
+        """
+        snapshots = []
+
+        for snapshot_folder in glob.glob('{f}/*.*'.format(f=self.folder)):
+            if snapshot_folder.endswith('.tmp'):
+                continue
+
+            meta = self._read_meta(snapshot_folder)
+
+            if meta is not None:
+                # Snapshots saved before the history watermark: their build time was the watermark
+                meta.setdefault('built', meta.get('watermark'))
+
+                snapshots.append(dict(meta, folder=snapshot_folder))
+
+        return sorted(snapshots, key=lambda meta: meta['built'], reverse=True)
+
+    def label_changes(self):
+        """
+        Returns the label changes counter (see count_label_changes())
+        """
+        try:
+            with open('{f}/label-changes'.format(f=self.folder)) as counter_file:
+                return int(counter_file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def count_label_changes(self, n):
+        """
+        Counts #n label changes (labels published by the model, labels set by the users): the snapshots built before are not reused anymore
+        """
+        if n <= 0:
+            return
+
+        os.makedirs(self.folder, exist_ok=True)
+
+        # Read, increment and rename under the lock: every process counts on the last value
+        with FileLock('{f}/label-changes-lock'.format(f=self.folder)):
+            tmp_filename = '{f}/label-changes.{pid}.tmp'.format(f=self.folder, pid=os.getpid())
+
+            with open(tmp_filename, 'w') as counter_file:
+                counter_file.write(str(self.label_changes() + n))
+
+            os.replace(tmp_filename, '{f}/label-changes'.format(f=self.folder))
+
+    def unchanged(self, meta, probe):
+        """
+        Tells whether the history the snapshot was built on is still the current one: no label changes since, 
+        and the expenses downloaded from its last expense date on (probe) are the ones of that date it was built with
+        """
+        history = meta.get('history')
+
+        if history is None or history['labelChanges'] != self.label_changes():
+            return False
+
+        latest = probe(str(history['lastDate']))
+
+        if latest is None:
+            return history['lastDateExpenses'] == 0
+
+        return history_watermark(latest, history['labelChanges']) == history
+
+    def latest(self, probe):
+        """
+        Returns the metadata of the newest snapshot that can be reused (current feature version, younger than max_age, history unchanged), or None
+
+        Parameters
+        ----------
+        probe (function)
+            Downloads the history from a date (YYYYMMDD string) on. Returns it as a compact history, or None if there are no expenses
+        """
+        for meta in self.snapshots():
+            if meta['version'] == FEATURE_VERSION and time.time() - meta['built'] <= self.max_age:
+                # Only the newest one: the older ones were built on an older history
+                return meta if self.unchanged(meta, probe) else None
+
+        return None
+
+    def save(self, built, watermark, model_feature_names, features):
+        """
+        Stores the features as a new snapshot and applies the retention
+
+        Parameters
+        ----------
+        built (float)
+            The time the history the features were built on was downloaded
+
+        watermark (dict)
+            The watermark of that history (see history_watermark())
+        """
+        snapshot_folder = '{f}/{v}.{b}'.format(f=self.folder, v=FEATURE_VERSION, b=int(built * 1000))
+
+        # Written in a temporary folder and renamed: a snapshot is either complete or not there
+        tmp_folder = '{f}.{pid}.tmp'.format(f=snapshot_folder, pid=os.getpid())
+        os.makedirs(tmp_folder, exist_ok=True)
+
+        features.to_pickle('{f}/features.pkl'.format(f=tmp_folder))
+
+        with open('{f}/meta.json'.format(f=tmp_folder), 'w') as meta_file:
+            json.dump({"version": FEATURE_VERSION, "built": built, "history": watermark, "rows": len(features), "modelFeatureNames": model_feature_names}, meta_file)
+
+        shutil.rmtree(snapshot_folder, ignore_errors=True)
+        os.replace(tmp_folder, snapshot_folder)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Deletes the snapshots beyond the newest #keep, the ones older than retention and the ones of another feature version
+        """
+        now = time.time()
+
+        for (i, meta) in enumerate(self.snapshots()):
+            if i >= self.keep or now - meta['built'] > self.retention or meta['version'] != FEATURE_VERSION:
+                shutil.rmtree(meta['folder'], ignore_errors=True)
+
+    def get(self, build, probe, correlation_id, context=''):
+        """
+        Returns the training features: from the newest reusable snapshot, or built (and stored as a new snapshot)
+
+        Parameters
+        ----------
+        build (function)
+            Downloads the history and engineers the features. 
+            Returns (model_feature_names, features, history), (None, None, history) if there's nothing to engineer
+
+        probe (function)
+            Downloads the history from a date on (see latest())
+
+        Returns
+        -------
+        (model_feature_names, features)
+        """
+        try:
+            meta = self.latest(probe)
+        except HistoryDownloadError as e:
+            logger.compute(correlation_id, '[ {context} ] - [ SNAPSHOT ] - Failed to check the history of the features snapshot: {e}'.format(context=context, e=e), 'warn')
+            meta = None
+
+        if meta is not None:
+            try:
+                features = pd.read_pickle('{f}/features.pkl'.format(f=meta['folder']))
+
+                logger.compute(correlation_id, '[ {context} ] - [ SNAPSHOT ] - Reusing the features snapshot {s} ({r} rows, {a:.0f} minutes old, history up to {d})'.format(context=context, s=os.path.basename(meta['folder']), r=meta['rows'], a=(time.time() - meta['built']) / 60, d=meta['history']['lastDate']), 'info')
+
+                return (meta['modelFeatureNames'], features)
+
+            except (FileNotFoundError, EOFError):
+                # Evicted in the meantime
+                pass
+
+        # Read before the download: a label changed during the download invalidates the snapshot
+        built = time.time()
+        label_changes = self.label_changes()
+
+        (model_feature_names, features, history) = build()
+
+        if features is not None:
+            self.save(built, history_watermark(history, label_changes), model_feature_names, features)
+
+            logger.compute(correlation_id, '[ {context} ] - [ SNAPSHOT ] - Features snapshot saved ({r} rows)'.format(context=context, r=len(features)), 'info')
+
+        return (model_feature_names, features)
+
+def history_watermark(history, label_changes):
+    '''
+    Returns the watermark of a (compact) history: the date of its last expense (YYYYMMDD), the number of expenses of that day, 
+    and the label changes counter (see FeatureSnapshots.count_label_changes())
+    '''
+    if history is None or len(history) == 0:
+        return {"lastDate": 0, "lastDateExpenses": 0, "labelChanges": label_changes}
+
+    last_date = int(history['date'].max())
+
+    return {"lastDate": last_date, "lastDateExpenses": int((history['date'] == last_date).sum()), "labelChanges": label_changes}
+
+def feature_snapshots():
+    '''
+    Returns the features snapshots shared by the training and the scoring, or None if disabled. 
+    The TOTO_FEATURE_SNAPSHOT_MAX_AGE environment variable (hours, default 24) sets how old a snapshot can be to be reused, 0 disables the snapshots.
+    The snapshots are in the TOTO_FEATURE_SNAPSHOTS environment variable folder, or {TOTO_TMP_FOLDER}/erboh/snapshots if not set.
+    TOTO_FEATURE_SNAPSHOTS can be set to 'none' to disable the snapshots.
+    The TOTO_FEATURE_SNAPSHOT_KEEP (default 2) and TOTO_FEATURE_SNAPSHOT_RETENTION (hours, default 168) environment variables configure the retention
+    '''
+    folder = os.environ.get('TOTO_FEATURE_SNAPSHOTS')
+    max_age = float(os.environ.get('TOTO_FEATURE_SNAPSHOT_MAX_AGE', 24)) * 3600
+
+    if folder is None and os.environ.get('TOTO_TMP_FOLDER'):
+        folder = '{tmp}/erboh/snapshots'.format(tmp=os.environ['TOTO_TMP_FOLDER'])
+
+    if folder is None or folder == 'none' or max_age <= 0:
+        return None
+
+    return FeatureSnapshots(
+        folder,
+        max_age=max_age,
+        keep=int(os.environ.get('TOTO_FEATURE_SNAPSHOT_KEEP', 2)),
+        retention=float(os.environ.get('TOTO_FEATURE_SNAPSHOT_RETENTION', 168)) * 3600
+    )
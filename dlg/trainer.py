@@ -1,56 +1,264 @@
+import os
+import math
+import time
+import warnings
+import multiprocessing
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from sklearn.neural_network import MLPClassifier
-from sklearn.model_selection import GridSearchCV
+from sklearn.model_selection import train_test_split, StratifiedKFold
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.metrics import f1_score
 
 from toto_logger.logger import TotoLogger
 
+from dlg.artifacts import write_artifact, read_artifact
+
 logger = TotoLogger()
 
-class Trainer: 
+# The hyperparameters searched
+PARAM_GRID = {
+    'hidden_layer_sizes': [(5, ), (5, 5), (9, 9)],
+    'alpha': [0.01, 0.1, 1.0]
+}
+
+# The hyperparameters of the fixed trainer (see trainer_nogrid), used if the search can't complete a single round in its budget
+DEFAULT_PARAMS = {'hidden_layer_sizes': (5, 5), 'alpha': 0.1}
+
+# Successive halving: the candidates are trained for MIN_EPOCHS epochs,
+# then only the best 1 / HALVING_FACTOR of them are trained further, for HALVING_FACTOR times more epochs, and so on
+MIN_EPOCHS = 50
+HALVING_FACTOR = 3
+
+# The candidates check the deadline of the search every DEADLINE_EPOCHS epochs (see fit_candidate()).
+# Not fewer than the epochs MLPClassifier needs to detect that the loss stopped improving (n_iter_no_change)
+DEADLINE_EPOCHS = 50
+
+# The cross validation folds of the process running the candidates (see init_folds())
+folds = None
+
+def init_folds(fold_arrays):
+    '''
+    Sets the cross validation folds: a list of (X_train, y_train, X_val, y_val) arrays.
+    Runs once per worker, so that the arrays are sent to a worker once and not with every candidate
+    '''
+    global folds
+    folds = fold_arrays
+
+def fit_candidate(params, fold, model, epochs, deadline):
+    '''
+    Trains a candidate on a fold for #epochs epochs and scores it (F1 score of class 1) on the validation set of the fold.
+    The training continues from model (the candidate trained on the same fold in the previous round), if not None.
+    Runs in a worker.
+
+    The candidate is trained DEADLINE_EPOCHS epochs at a time, and stops at the deadline (time.time()): 
+    a candidate still training when the search budget is over doesn't keep its worker busy.
+
+    Returns (model, score), score None if the deadline passed before the candidate was trained
+    '''
+    (X_train, y_train, X_val, y_val) = folds[fold]
+
+    if model is None:
+        model = MLPClassifier(activation='identity', warm_start=True, random_state=100, **params)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+
+        for chunk in range(0, epochs, DEADLINE_EPOCHS):
+
+            if time.time() >= deadline:
+                return (model, None)
+
+            trained = len(getattr(model, 'loss_curve_', []))
+
+            model.set_params(max_iter=min(DEADLINE_EPOCHS, epochs - chunk))
+            model.fit(X_train, y_train)
 
-    def __init__(self, folder, features_filename, model_feature_names, cid):
+            # Stopped before max_iter: the loss doesn't improve anymore
+            if len(model.loss_curve_) - trained < model.max_iter:
+                break
+
+    return (model, f1_score(y_val, model.predict(X_val), zero_division=0))
+
+class Trainer:
+    """
+    Trains the model searching the best hyperparameters (PARAM_GRID) with cross validation and successive halving.
+
+    All the candidates are trained for MIN_EPOCHS epochs on every fold, then only the best ones keep on training (see HALVING_FACTOR),
+    until one is left or the time budget is over. The best candidate is then trained on the whole training set.
+
+    The folds are split once into NumPy arrays and the candidates run on a pool of n_jobs processes.
+
+    Parameters
+    ----------
+    n_jobs (int, default None)
+        The number of processes training the candidates. Defaults to the TOTO_TRAIN_JOBS environment variable, or 1 (no parallelism)
+
+    budget (float, default None)
+        The max duration (seconds) of the search. Defaults to the TOTO_TRAIN_BUDGET environment variable (minutes), or 30 minutes
+
+    n_folds (int, default 3)
+        The number of cross validation folds
+    """
+
+    def __init__(self, folder, features_filename, model_feature_names, cid, context='', n_jobs=None, budget=None, n_folds=3):
         self.features_filename = features_filename
         self.correlation_id = cid
         self.model_feature_names = model_feature_names
         self.folder = folder
+        self.context = context
+        self.n_jobs = n_jobs if n_jobs is not None else int(os.environ.get('TOTO_TRAIN_JOBS', 1))
+        self.budget = budget if budget is not None else float(os.environ.get('TOTO_TRAIN_BUDGET', 30)) * 60
+        self.n_folds = n_folds
+
+    def do(self):
+        """
+        Trains the model and saves the train and test sets in the folder
+
+        Returns
+        -------
+        (trained_model, train_filename, test_filename)
+        """
+        (best_nn, train_df, test_df) = self.fit()
+
+        # Save the sets
+        train_filename = write_artifact(train_df, '{folder}/features_train'.format(folder=self.folder))
+        test_filename = write_artifact(test_df, '{folder}/features_test'.format(folder=self.folder))
+
+        # Return the model and the split features files
+        return (best_nn, train_filename, test_filename)
+
+    def search(self, X, y):
+        """
+        Searches the best hyperparameters (see PARAM_GRID) on the training set
 
-    def do(self): 
-        
-        logger.compute(self.correlation_id, '[ TRAINING ] - Starting training on historical data', 'info')
+        Returns
+        -------
+        params (dict)
+            The best hyperparameters
+        """
+        start = time.time()
+
+        candidates = [{"hidden_layer_sizes": h, "alpha": a} for h in PARAM_GRID['hidden_layer_sizes'] for a in PARAM_GRID['alpha']]
+
+        # Split the folds once
+        fold_arrays = [(X[t], y[t], X[v], y[v]) for (t, v) in StratifiedKFold(n_splits=self.n_folds, shuffle=True, random_state=100).split(X, y)]
+
+        if self.n_jobs > 1:
+            # Spawned: the workers don't inherit the threads and locks of this process
+            executor = ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context('spawn'), initializer=init_folds, initargs=(fold_arrays, ))
+        else:
+            executor = ThreadPoolExecutor(max_workers=1, initializer=init_folds, initargs=(fold_arrays, ))
+
+        alive = list(range(len(candidates)))
+        futures = {}
+        models = {}
+        scores = None
+        epochs = MIN_EPOCHS
+        rounds = 0
+
+        try:
+            while True:
+
+                if time.time() >= start + self.budget:
+                    break
+
+                futures = {executor.submit(fit_candidate, candidates[c], k, models.get((c, k)), epochs, start + self.budget): (c, k) for c in alive for k in range(self.n_folds)}
+
+                # The candidates stop at the deadline: the round ends shortly after it at most
+                wait(futures)
+
+                # Out of time: this round doesn't count
+                if any([future.result()[1] is None for future in futures]):
+                    logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Search budget ({b:.0f}s) over during round {r}'.format(context=self.context, b=self.budget, r=rounds + 1), 'warn')
+                    break
+
+                round_scores = {c: [] for c in alive}
+
+                for (future, (c, k)) in futures.items():
+                    (models[(c, k)], score) = future.result()
+                    round_scores[c].append(score)
+
+                scores = {c: np.mean(s) for (c, s) in round_scores.items()}
+                rounds += 1
+
+                logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Search round {r}: {n} candidates, {e} epochs, best F1 {f:.4f}'.format(context=self.context, r=rounds, n=len(alive), e=epochs, f=max(scores.values())), 'info')
+
+                if len(alive) == 1:
+                    break
+
+                # Successive halving: only the best candidates go on, for more epochs
+                alive = sorted(alive, key=lambda c: scores[c], reverse=True)[:math.ceil(len(alive) / HALVING_FACTOR)]
+                models = {key: model for (key, model) in models.items() if key[0] in alive}
+                epochs *= HALVING_FACTOR
+
+        finally:
+            # Candidates not started yet (e.g. after an error)
+            for future in futures:
+                future.cancel()
+
+            executor.shutdown(wait=True)
+
+        if scores is None:
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - No search round completed in the budget: using the default hyperparameters'.format(context=self.context), 'warn')
+            return DEFAULT_PARAMS
+
+        best = candidates[max(scores, key=lambda c: scores[c])]
+
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Search completed in {s:.0f}s: best hyperparameters {p}'.format(context=self.context, s=time.time() - start, p=best), 'info')
+
+        return best
+
+    def fit(self):
+        """
+        Searches the hyperparameters and trains the model, keeping the train and test sets in memory
+
+        Returns
+        -------
+        (trained_model, train_df, test_df)
+
+        Raises the error if the features can't be read
+        """
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Starting training on historical data, with hyperparameters search'.format(context=self.context), 'info')
+
+        try:
+            if isinstance(self.features_filename, pd.DataFrame):
+                features = self.features_filename.copy()
+            else:
+                features = read_artifact(self.features_filename, columns=self.model_feature_names + ['monthly'])
 
-        try: 
-            features = pd.read_csv(self.features_filename)
-            
             # Only keep the features that are labeled!
             features = features[features['monthly'].notnull()]
 
             # Change the value of the monthly from bool to 0-1 values
             features['monthly'] = features['monthly'].apply(lambda x : int(x == True))
 
-        except: 
-            logger.compute(self.correlation_id, '[ TRAINING ] - Problem reading file {}. Stopping'.format(self.features_filename), 'error')
-            return
+        except Exception:
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Problem reading the features. Stopping'.format(context=self.context), 'error')
+            raise
 
-        logger.compute(self.correlation_id, '[ TRAINING ] - Training on {} rows'.format(len(features)),'info')
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Training on {r} rows'.format(context=self.context, r=len(features)),'info')
 
         X = features[self.model_feature_names]
         y = features['monthly']
 
-        # Train the model
-        # Do a GridSearch CV for hyper param
-        gs = GridSearchCV(MLPClassifier(activation='identity', max_iter=500), param_grid={
-            'hidden_layer_sizes': [(5, 5), (9, 9)], 
-            'alpha': [0.01, 0.1], 
-        }, )
+        # Split train and test set, cause the accuracy is going to be calculated on the test set
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, shuffle=True, random_state=100)
 
-        gs.fit(X, y)
-        
-        results = gs.cv_results_
+        train_df = pd.DataFrame(X_train, columns=self.model_feature_names)
+        test_df = pd.DataFrame(X_test, columns=self.model_feature_names)
+        train_df['monthly'] = y_train
+        test_df['monthly'] = y_test
 
-        print(results)
+        # Search the hyperparameters on the training set
+        params = self.search(np.ascontiguousarray(X_train.to_numpy(dtype=np.float64)), y_train.to_numpy(dtype=np.int64))
 
-        logger.compute(self.correlation_id, '[ TRAINING ] - Model trained.','info')
+        # Train the model
+        best_nn = MLPClassifier(activation='identity', max_iter=1000, **params)
+        best_nn.fit(X_train, y_train)
 
-        # Return the model and the split features files
-        return (best_nn, features_filename, features_filename)
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Model trained.'.format(context=self.context),'info')
+
+        # Return the model and the split features sets
+        return (best_nn, train_df, test_df)
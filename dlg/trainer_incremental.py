@@ -0,0 +1,201 @@
+import os
+import copy
+import warnings
+import pandas as pd
+import numpy as np
+from sklearn.neural_network import MLPClassifier
+from sklearn.model_selection import train_test_split
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.metrics import f1_score
+
+from toto_logger.logger import TotoLogger
+
+from dlg.artifacts import read_artifact
+
+logger = TotoLogger()
+
+# Max number of epochs of an incremental training
+INCREMENTAL_EPOCHS = 200
+
+def label_hashes(features):
+    '''
+    Returns the hashes (uint64 array) of the (id, monthly) pairs of the labeled expenses of the features:
+    saved with every trained model (the hashes of its training set), so that the next incremental training can tell the new (or changed) labels
+    '''
+    labeled = features[features['monthly'].notnull()]
+
+    return pd.util.hash_pandas_object(pd.DataFrame({"id": labeled['id'].astype(str), "monthly": labeled['monthly'].apply(lambda x : int(x == True))}), index=False).to_numpy()
+
+class Trainer:
+    """
+    Trains the model incrementally: the currently promoted model keeps on training (warm start) on the newly labeled expenses
+    (the ones whose label is not among the labels the promoted model was trained with, see label_hashes()),
+    plus a random replay sample of the older ones, so that it doesn't forget them.
+    The duration of the training depends on the new labels, not on the whole history.
+
+    Falls back to a full training (same as trainer_nogrid) when:
+     - there's no promoted model, or it wasn't saved with its labels
+     - the new labels drift from the old ones: the rate of the label, or the average rate of the features, differs by more than max_drift
+     - the incrementally trained model scores (F1 on the test rows the promoted model wasn't trained on) worse than the promoted model by more than max_regression
+
+    After fit(), self.mode tells which training was done: 'incremental' or 'full'
+
+    Parameters
+    ----------
+    base_model (MLPClassifier, default None)
+        The promoted model
+
+    base_labels (array, default None)
+        The label hashes of the promoted model (see label_hashes())
+
+    replay_size (int, default None)
+        The max number of older expenses replayed. Defaults to the TOTO_TRAIN_REPLAY environment variable, or 10000
+
+    max_drift (float, default None)
+        Defaults to the TOTO_TRAIN_MAX_DRIFT environment variable, or 0.2
+
+    max_regression (float, default None)
+        Defaults to the TOTO_TRAIN_MAX_REGRESSION environment variable, or 0.02
+    """
+
+    def __init__(self, folder, features_filename, model_feature_names, cid, context='', base_model=None, base_labels=None, replay_size=None, max_drift=None, max_regression=None):
+        self.features_filename = features_filename
+        self.correlation_id = cid
+        self.model_feature_names = model_feature_names
+        self.folder = folder
+        self.context = context
+        self.base_model = base_model
+        self.base_labels = base_labels
+        self.replay_size = replay_size if replay_size is not None else int(os.environ.get('TOTO_TRAIN_REPLAY', 10000))
+        self.max_drift = max_drift if max_drift is not None else float(os.environ.get('TOTO_TRAIN_MAX_DRIFT', 0.2))
+        self.max_regression = max_regression if max_regression is not None else float(os.environ.get('TOTO_TRAIN_MAX_REGRESSION', 0.02))
+        self.mode = None
+
+    def full(self, X_train, y_train):
+        '''
+        Trains a new model on the whole training set
+        '''
+        self.mode = 'full'
+
+        best_nn = MLPClassifier(hidden_layer_sizes=(5, 5), activation='identity', alpha=0.1, max_iter=1000)
+        best_nn.fit(X_train, y_train)
+
+        return best_nn
+
+    def incremental(self, X_train, y_train, new):
+        '''
+        Trains the promoted model on the new rows (boolean mask of the training set) and on a replay sample of the older rows.
+        Returns None if the new rows drift from the older ones
+        '''
+        (X_new, y_new) = (X_train[new], y_train[new])
+        (X_old, y_old) = (X_train[~new], y_train[~new])
+
+        if len(X_new) == 0:
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - No new labels: keeping the promoted model'.format(context=self.context), 'info')
+            return copy.deepcopy(self.base_model)
+
+        # Drift: how much the rate of the label, and on average the rates of the features (0/1 flags), differ between the new and the old rows
+        if len(X_old) > 0:
+            drift = max(np.abs(X_new.mean(axis=0) - X_old.mean(axis=0)).mean(), abs(y_new.mean() - y_old.mean()))
+
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - {n} new labels, drift {d:.3f}'.format(context=self.context, n=len(X_new), d=drift), 'info')
+
+            if drift > self.max_drift:
+                logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Drift over {m}: full training'.format(context=self.context, m=self.max_drift), 'warn')
+                return None
+
+        # Replay a sample of the older rows
+        replay = np.random.default_rng(100).choice(len(X_old), size=min(self.replay_size, len(X_old)), replace=False)
+
+        X = pd.concat([X_new, X_old.iloc[replay]])
+        y = pd.concat([y_new, y_old.iloc[replay]])
+
+        model = copy.deepcopy(self.base_model)
+        model.set_params(warm_start=True, max_iter=INCREMENTAL_EPOCHS)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=ConvergenceWarning)
+            model.fit(X, y)
+
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Promoted model trained on {n} new and {r} replayed labels'.format(context=self.context, n=len(X_new), r=len(replay)), 'info')
+
+        return model
+
+    def fit(self):
+        """
+        Trains the model (incrementally if possible), keeping the train and test sets in memory
+
+        Returns
+        -------
+        (trained_model, train_df, test_df)
+
+        Raises the error if the features can't be read
+        """
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Starting incremental training on historical data'.format(context=self.context), 'info')
+
+        try:
+            if isinstance(self.features_filename, pd.DataFrame):
+                features = self.features_filename.copy()
+            else:
+                features = read_artifact(self.features_filename, columns=self.model_feature_names + ['id', 'monthly'])
+
+            # Only keep the features that are labeled!
+            features = features[features['monthly'].notnull()]
+
+            hashes = label_hashes(features)
+
+            # Change the value of the monthly from bool to 0-1 values
+            features['monthly'] = features['monthly'].apply(lambda x : int(x == True))
+
+        except Exception:
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Problem reading the features. Stopping'.format(context=self.context), 'error')
+            raise
+
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Training on {r} rows'.format(context=self.context, r=len(features)),'info')
+
+        X = features[self.model_feature_names]
+        y = features['monthly']
+
+        # Split train and test set, cause the accuracy is going to be calculated on the test set
+        X_train, X_test, y_train, y_test, hashes_train, hashes_test = train_test_split(X, y, hashes, test_size=0.2, stratify=y, shuffle=True, random_state=100)
+
+        train_df = pd.DataFrame(X_train, columns=self.model_feature_names)
+        test_df = pd.DataFrame(X_test, columns=self.model_feature_names)
+        train_df['monthly'] = y_train
+        test_df['monthly'] = y_test
+
+        best_nn = None
+
+        if self.base_model is None or self.base_labels is None:
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - No promoted model with its labels: full training'.format(context=self.context), 'info')
+        else:
+            new = ~np.isin(hashes_train, self.base_labels)
+
+            best_nn = self.incremental(X_train, y_train, new)
+
+            # Score regression with respect to the promoted model, on the test rows it wasn't trained on
+            unseen = ~np.isin(hashes_test, self.base_labels)
+
+            if best_nn is not None and not unseen.any():
+                logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - No test labels unseen by the promoted model: regression not checked'.format(context=self.context), 'warn')
+                self.mode = 'incremental'
+
+            elif best_nn is not None:
+                base_f1 = f1_score(y_test[unseen], self.base_model.predict(X_test[unseen]), zero_division=0)
+                f1 = f1_score(y_test[unseen], best_nn.predict(X_test[unseen]), zero_division=0)
+
+                logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - F1 score on {n} unseen test labels: {f:.4f} (promoted model: {b:.4f})'.format(context=self.context, n=unseen.sum(), f=f1, b=base_f1), 'info')
+
+                if f1 < base_f1 - self.max_regression:
+                    logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - F1 score regression over {m}: full training'.format(context=self.context, m=self.max_regression), 'warn')
+                    best_nn = None
+                else:
+                    self.mode = 'incremental'
+
+        if best_nn is None:
+            best_nn = self.full(X_train, y_train)
+
+        logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Model trained ({m}).'.format(context=self.context, m=self.mode),'info')
+
+        # Return the model and the split features sets
+        return (best_nn, train_df, test_df)
@@ -5,6 +5,8 @@ from sklearn.model_selection import train_test_split
 
 from toto_logger.logger import TotoLogger
 
+from dlg.artifacts import write_artifact, read_artifact
+
 logger = TotoLogger()
 
 class Trainer: 
@@ -17,11 +19,39 @@ class Trainer:
         self.context = context
 
     def do(self): 
-        
+        """
+        Trains the model and saves the train and test sets in the folder
+
+        Returns
+        -------
+        (trained_model, train_filename, test_filename)
+        """
+        (best_nn, train_df, test_df) = self.fit()
+
+        # Save the sets 
+        train_filename = write_artifact(train_df, '{folder}/features_train'.format(folder=self.folder))
+        test_filename = write_artifact(test_df, '{folder}/features_test'.format(folder=self.folder))
+
+        # Return the model and the split features files
+        return (best_nn, train_filename, test_filename)
+
+    def fit(self): 
+        """
+        Trains the model, keeping the train and test sets in memory
+
+        Returns
+        -------
+        (trained_model, train_df, test_df)
+
+        Raises the error if the features can't be read
+        """
         logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Starting training on historical data'.format(context=self.context), 'info')
 
         try: 
-            features = pd.read_csv(self.features_filename)
+            if isinstance(self.features_filename, pd.DataFrame): 
+                features = self.features_filename.copy()
+            else: 
+                features = read_artifact(self.features_filename, columns=self.model_feature_names + ['monthly'])
             
             # Only keep the features that are labeled!
             features = features[features['monthly'].notnull()]
@@ -29,9 +59,9 @@ class Trainer:
             # Change the value of the monthly from bool to 0-1 values
             features['monthly'] = features['monthly'].apply(lambda x : int(x == True))
 
-        except: 
-            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Problem reading file {f}. Stopping'.format(context=self.context, f=self.features_filename), 'error')
-            return
+        except Exception: 
+            logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Problem reading the features. Stopping'.format(context=self.context), 'error')
+            raise
 
         logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Training on {r} rows'.format(context=self.context, r=len(features)),'info')
 
@@ -41,23 +71,16 @@ class Trainer:
         # Split train and test set, cause the accuracy is going to be calculated on the test set
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, shuffle=True, random_state=100)
 
-        # Save the sets 
-        train_filename = '{folder}/features_train.csv'.format(folder=self.folder);
-        test_filename = '{folder}/features_test.csv'.format(folder=self.folder);
-
         train_df = pd.DataFrame(X_train, columns=self.model_feature_names)
         test_df = pd.DataFrame(X_test, columns=self.model_feature_names)
         train_df['monthly'] = y_train
         test_df['monthly'] = y_test
 
-        train_df.to_csv(train_filename)
-        test_df.to_csv(test_filename)
-
         # Train the model
         best_nn = MLPClassifier(hidden_layer_sizes=(5, 5), activation='identity', alpha=0.1, max_iter=1000)
         best_nn.fit(X_train, y_train)
 
         logger.compute(self.correlation_id, '[ {context} ] - [ TRAINING ] - Model trained.'.format(context=self.context),'info')
 
-        # Return the model and the split features files
-        return (best_nn, train_filename, test_filename)
+        # Return the model and the split features sets
+        return (best_nn, train_df, test_df)
@@ -0,0 +1,109 @@
+import os
+import threading
+import joblib
+
+from toto_logger.logger import TotoLogger
+
+from dlg.compiled import compile_model, CompiledMLP
+from dlg.memo import MemoizedModel
+
+logger = TotoLogger()
+
+class ModelCache:
+    """
+    Process-wide cache of the loaded (unpickled) models.
+
+    When the model qualifies, the cache holds its compiled version (see dlg.compiled), which has the same predict().
+    Every loaded model is wrapped in its own memo table of predictions (see dlg.memo), dropped with the model.
+
+    Models are keyed by model file path, model version and file modification time:
+    when Toto ML promotes a new model (new version or new file), the next lookup loads it,
+    swaps it in and evicts the older entries of the same file.
+
+    Parameters
+    ----------
+    max_entries (int, default 2)
+        The max number of models kept in memory
+    """
+
+    def __init__(self, max_entries=2):
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, model):
+        path = model.files['model']
+
+        return (path, model.info.get('version'), os.path.getmtime(path))
+
+    def get(self, model, correlation_id=None):
+        """
+        Returns the loaded model, loading it if it's not in the cache
+
+        Parameters
+        ----------
+        model (totoml.model.Model)
+            The model, as provided by Toto ML. Its 'model' file is the pickle of the trained model
+        """
+        key = self._key(model)
+
+        # Fast path: no lock, reading a dict is atomic
+        trained_model = self.entries.get(key)
+
+        if trained_model is not None:
+            self.hits += 1
+            return trained_model
+
+        with self.lock:
+
+            # Another thread might have loaded it in the meantime
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+
+            self.misses += 1
+
+            trained_model = joblib.load(key[0])
+
+            compiled = compile_model(trained_model)
+
+            if compiled is not None:
+                trained_model = compiled
+
+            trained_model = MemoizedModel(trained_model)
+
+            # Evict the other versions of the same file, and the oldest entries if there are too many
+            entries = {k: v for (k, v) in self.entries.items() if k[0] != key[0]}
+            while len(entries) >= self.max_entries:
+                entries.pop(next(iter(entries)))
+
+            self.evictions += len(self.entries) - len(entries)
+
+            entries[key] = trained_model
+
+            # Swap the whole dict, so that readers never see a partial update
+            self.entries = entries
+
+        logger.compute(correlation_id, '[ MODEL CACHE ] - Loaded model {f} (version {v}, compiled: {c})'.format(f=key[0], v=key[1], c=compiled is not None), 'info')
+
+        return trained_model
+
+    def stats(self):
+        """
+        Returns the cache metrics
+        """
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / lookups if lookups > 0 else None,
+            "models": [{"file": k[0], "version": k[1], "compiled": isinstance(v.model, CompiledMLP), "memo": v.stats()} for (k, v) in self.entries.items()]
+        }
+
+# The cache shared by the whole process
+model_cache = ModelCache()
@@ -8,6 +8,7 @@ from totoml.model import ModelType
 from model.train import TrainingProcess
 from model.predict import SinglePredictor
 from model.predict_batch import BatchPredictor
+from model.rescore import IncrementalPredictor
 from model.score import ScoreProcess
 
 from toto_logger.logger import TotoLogger
@@ -31,6 +32,10 @@ class ERBOH:
 
     def predict_batch(self, model, context, data=None): 
 
+        # New or changed expenses: only the expenses they affect are predicted again
+        if data is not None and 'expenses' in data: 
+            return IncrementalPredictor().predict(model, context, data)
+
         return BatchPredictor().predict(model, context, data)
 
     def train(self, model_info, context):
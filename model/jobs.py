@@ -0,0 +1,387 @@
+import os
+import json
+import glob
+import time
+import uuid
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from toto_logger.logger import TotoLogger
+
+from dlg.filelock import FileLock, is_locked
+
+logger = TotoLogger()
+
+# The kinds of jobs that can be run in the background
+JOB_KINDS = ['predict-batch', 'train', 'score']
+
+# The job run by this process (only set in the job worker processes)
+current_job = None
+
+def jobs_folder():
+    '''
+    Returns the folder where the status of the jobs is stored: {TOTO_TMP_FOLDER}/erboh/jobs
+    '''
+    return '{tmp}/erboh/jobs'.format(tmp=os.environ['TOTO_TMP_FOLDER'])
+
+def status_filename(job_id):
+    return '{folder}/{job}.json'.format(folder=jobs_folder(), job=job_id)
+
+def lock_filename(name):
+    '''
+    Returns the lock file held by a running job (name = its id) or by a live job queue (name = owner.{its id}), see FileLock
+    '''
+    return '{folder}/{name}.lock'.format(folder=jobs_folder(), name=name)
+
+def read_status(job_id):
+    """
+    Returns the status of the job (dict), or None if there's no such job
+    """
+    try:
+        with open(status_filename(job_id)) as status_file:
+            return json.load(status_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def write_status(status):
+    '''
+    Writes the status of a job. Write and rename, so that readers (in any process) never see a partial file
+    '''
+    os.makedirs(jobs_folder(), exist_ok=True)
+
+    filename = status_filename(status['jobId'])
+    tmp_filename = '{f}.{pid}.tmp'.format(f=filename, pid=os.getpid())
+
+    with open(tmp_filename, 'w') as status_file:
+        json.dump(status, status_file)
+
+    os.replace(tmp_filename, filename)
+
+def sweep_status(max_age):
+    """
+    Deletes the status files of the jobs that ended (done or failed) more than max_age seconds ago, 
+    and the temporary files left by an interrupted write_status()
+
+    Returns
+    -------
+    deleted (int)
+        The number of status files deleted
+    """
+    now = time.time()
+    deleted = 0
+
+    for filename in glob.glob('{folder}/*.json*'.format(folder=jobs_folder())):
+        try:
+            if filename.endswith('.tmp'):
+                if now - os.path.getmtime(filename) > max_age:
+                    os.remove(filename)
+                continue
+
+            with open(filename) as status_file:
+                status = json.load(status_file)
+
+            if status['status'] in ['done', 'failed'] and now - status.get('ended', status['submitted']) > max_age:
+                os.remove(filename)
+                deleted += 1
+
+                if os.path.exists(lock_filename(status['jobId'])):
+                    os.remove(lock_filename(status['jobId']))
+
+        except (FileNotFoundError, ValueError, KeyError):
+            # Deleted or replaced in the meantime
+            continue
+
+    return deleted
+
+def stage(name):
+    """
+    Records that the job run by this process entered a new pipeline stage (e.g. 'history', 'features', 'predict').
+    Does nothing when the pipeline doesn't run as a job
+    """
+    if current_job is None:
+        return
+
+    now = time.time()
+
+    if len(current_job['stages']) > 0 and 'ended' not in current_job['stages'][-1]:
+        current_job['stages'][-1]['ended'] = now
+
+    current_job['stages'].append({"stage": name, "started": now})
+
+    write_status(current_job)
+
+def run_job(job_id, kind, model_info, model_files, data, correlation_id):
+    '''
+    Runs a job (in a job worker process) and records its status, stages and result
+    '''
+    global current_job
+
+    # Held while the job runs: tells the job queues that the job isn't orphaned (see JobQueue.resume())
+    job_lock = FileLock(lock_filename(job_id))
+
+    if not job_lock.acquire(blocking=False):
+        logger.compute(correlation_id, '[ JOBS ] - Job {j} is already running'.format(j=job_id), 'warn')
+        return
+
+    current_job = read_status(job_id)
+    current_job['status'] = 'running'
+    current_job['started'] = time.time()
+    current_job['pid'] = os.getpid()
+
+    write_status(current_job)
+
+    try:
+        # Imported here: the worker processes only need them when they run a job
+        from totoml.model import Model
+        from totoml.context import ModelExecutionContext
+        from totoml.remote.totoml_registry import TotoMLRegistry
+        from totoml.remote.gcpstorage import GCPStorage
+        from model.erboh import ERBOH
+
+        model = Model(model_info, model_files)
+        delegate = ERBOH()
+
+        if kind == 'predict-batch':
+            context = ModelExecutionContext(correlation_id, 'PREDICT BATCH')
+
+            prediction = delegate.predict_batch(model, context, data=data)
+            prediction.delete_files(context)
+
+            result = {"success": True}
+
+        elif kind == 'score':
+            context = ModelExecutionContext(correlation_id, 'SCORING')
+
+            score = delegate.score(model, context)
+
+            stage('registry')
+            TotoMLRegistry(context).put_champion_metrics(model_info['name'], score.score)
+
+            score.delete_files(context)
+
+            result = {"metrics": score.score}
+
+        else:
+            context = ModelExecutionContext(correlation_id, 'TRAINING')
+            registry = TotoMLRegistry(context)
+
+            registry.put_model_status(model_info['name'], {"trainingStatus": "training"})
+
+            try:
+                retrained_model = delegate.train(model_info, context)
+
+                stage('registry')
+                GCPStorage(context).save_retrained_model(model_info, retrained_model)
+                registry.post_retrained_model(model_info['name'], retrained_model.score)
+
+                retrained_model.delete_files(context)
+            finally:
+                registry.put_model_status(model_info['name'], {"trainingStatus": "not-training"})
+
+            result = {"success": True, "metrics": retrained_model.score}
+
+        stage('done')
+
+        current_job['status'] = 'done'
+        current_job['result'] = result
+
+    except Exception as e:
+        logger.compute(correlation_id, '[ JOBS ] - Job {j} ({k}) failed: {e}'.format(j=job_id, k=kind, e=e), 'error')
+
+        current_job['status'] = 'failed'
+        current_job['error'] = traceback.format_exc()
+
+    current_job['ended'] = time.time()
+
+    if len(current_job['stages']) > 0 and 'ended' not in current_job['stages'][-1]:
+        current_job['stages'][-1]['ended'] = current_job['ended']
+
+    write_status(current_job)
+
+    current_job = None
+
+    job_lock.release()
+
+class JobQueue:
+    """
+    Runs the long operations (batch predictions, training, scoring) as background jobs, in separate worker processes,
+    so that they never block the processes serving the online predictions.
+
+    Every job gets an id and a status file (see jobs_folder()), that any process can read:
+    status (queued, running, done, failed), the pipeline stages with their start and end times, and the result.
+    The status files of the jobs that ended more than retention ago are deleted when a job is submitted (see sweep_status()).
+
+    A job that fails (error, or worker process killed) is run again, up to max_attempts times.
+    The jobs left behind by a process that died (e.g. a restart) are run again by resume(): a batch prediction 
+    resumes from its checkpoint (see BatchPredictor.predict_all()).
+
+    Parameters
+    ----------
+    workers (int, default None)
+        The number of worker processes (jobs run at the same time). Defaults to the TOTO_JOB_WORKERS environment variable, or 1
+
+    retention (float, default None)
+        How long (seconds) the status of an ended job is kept. Defaults to the TOTO_JOB_RETENTION environment variable (in hours), or 7 days
+
+    max_attempts (int, default None)
+        The max number of runs of a job. Defaults to the TOTO_JOB_ATTEMPTS environment variable, or 3
+    """
+
+    def __init__(self, workers=None, retention=None, max_attempts=None):
+        self.workers = workers if workers is not None else int(os.environ.get('TOTO_JOB_WORKERS', 1))
+        self.retention = retention if retention is not None else float(os.environ.get('TOTO_JOB_RETENTION', 168)) * 3600
+        self.max_attempts = max_attempts if max_attempts is not None else int(os.environ.get('TOTO_JOB_ATTEMPTS', 3))
+        self.executor = None
+        self.owner = str(uuid.uuid1())
+        self.owner_lock = None
+
+    def _own(self):
+        '''
+        Holds the lock of this queue for the life of the process: the jobs it queued are not orphaned as long as it's alive
+        '''
+        if self.owner_lock is None:
+            self.owner_lock = FileLock(lock_filename('owner.{o}'.format(o=self.owner)))
+            self.owner_lock.acquire()
+
+    def _run(self, status, model):
+        '''
+        Queues the run of a job (its status is written as queued)
+        '''
+        # The pool is created at the first job: spawned processes don't inherit the threads and locks of this process
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+        status.update({"status": "queued", "owner": self.owner, "stages": []})
+
+        for key in ['pid', 'error', 'result', 'started', 'ended']:
+            status.pop(key, None)
+
+        write_status(status)
+
+        (job_id, correlation_id) = (status['jobId'], status['correlationId'])
+
+        future = self.executor.submit(run_job, job_id, status['kind'], model.info, model.files, status.get('data'), correlation_id)
+        future.add_done_callback(lambda f : self._check(f, job_id, correlation_id, model))
+
+    def _check(self, future, job_id, correlation_id, model):
+        '''
+        Marks the job as failed if its worker process died without recording the outcome (e.g. killed, out of memory),
+        and runs a failed job again if it has attempts left
+        '''
+        error = future.exception()
+
+        # A pool whose process died is broken: the next job gets a new one
+        if isinstance(error, BrokenProcessPool):
+            self.executor = None
+
+        status = read_status(job_id)
+
+        if status is None:
+            return
+
+        if error is not None:
+            logger.compute(correlation_id, '[ JOBS ] - Job {j} failed: {e}'.format(j=job_id, e=repr(error)), 'error')
+
+            if status['status'] in ['queued', 'running']:
+                status['status'] = 'failed'
+                status['error'] = repr(error)
+                status['ended'] = time.time()
+                write_status(status)
+
+        if status['status'] == 'failed' and status.get('attempts', 1) < self.max_attempts:
+            status['attempts'] = status.get('attempts', 1) + 1
+
+            logger.compute(correlation_id, '[ JOBS ] - Job {j} ({k}): attempt {a} of {m}'.format(j=job_id, k=status['kind'], a=status['attempts'], m=self.max_attempts), 'warn')
+
+            self._run(status, model)
+
+    def submit(self, kind, model, data=None, correlation_id=None):
+        """
+        Submits a job
+
+        Parameters
+        ----------
+        kind (string)
+            One of JOB_KINDS
+
+        model (totoml.model.Model)
+            The champion model
+
+        data (dict, default None)
+            The data of the job (e.g. {"user": ...} for a batch prediction)
+
+        Returns
+        -------
+        job_id (string)
+            The id of the job
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError('Job {k} not supported. Supported jobs: {s}'.format(k=kind, s=JOB_KINDS))
+
+        self._own()
+
+        sweep_status(self.retention)
+
+        job_id = str(uuid.uuid1())
+        correlation_id = correlation_id if correlation_id is not None else job_id
+
+        self._run({"jobId": job_id, "kind": kind, "correlationId": correlation_id, "data": data, "submitted": time.time(), "attempts": 1}, model)
+
+        logger.compute(correlation_id, '[ JOBS ] - Job {j} ({k}) submitted'.format(j=job_id, k=kind), 'info')
+
+        return job_id
+
+    def orphaned(self, status):
+        """
+        Tells whether a job was left behind: not ended, not running (see run_job()) and not queued by a live job queue
+        """
+        if status['status'] not in ['queued', 'running']:
+            return False
+
+        return not is_locked(lock_filename(status['jobId'])) and not is_locked(lock_filename('owner.{o}'.format(o=status.get('owner'))))
+
+    def resume(self, model):
+        """
+        Runs again the jobs left behind by the processes that died (e.g. a restart during a batch prediction), 
+        with the champion model. A job that used all its attempts is marked as failed. 
+        Safe to call from every process at startup: every job is taken over by one process only
+
+        Returns
+        -------
+        job_ids (list)
+            The ids of the jobs resumed
+        """
+        self._own()
+
+        resumed = []
+
+        with FileLock(lock_filename('resume')):
+            for filename in glob.glob('{folder}/*.json'.format(folder=jobs_folder())):
+
+                try:
+                    with open(filename) as status_file:
+                        status = json.load(status_file)
+                except (FileNotFoundError, ValueError):
+                    continue
+
+                if not self.orphaned(status):
+                    continue
+
+                if status.get('attempts', 1) >= self.max_attempts:
+                    status.update({"status": "failed", "error": "Interrupted: no attempts left", "ended": time.time()})
+                    write_status(status)
+                    continue
+
+                status['attempts'] = status.get('attempts', 1) + 1
+
+                logger.compute(status['correlationId'], '[ JOBS ] - Resuming job {j} ({k}): attempt {a} of {m}'.format(j=status['jobId'], k=status['kind'], a=status['attempts'], m=self.max_attempts), 'warn')
+
+                self._run(status, model)
+                resumed.append(status['jobId'])
+
+        return resumed
+
+# The job queue shared by the whole process
+job_queue = JobQueue()
@@ -0,0 +1,144 @@
+import os
+import time
+import threading
+import pandas as pd
+
+from toto_logger.logger import TotoLogger
+
+from dlg.history import HistoryDownloader
+from dlg.compact import empty_history
+from dlg.feature import engineer_expenses_features, MODEL_FEATURE_NAMES
+from dlg.predictor import Predictor
+
+logger = TotoLogger()
+
+class MicroBatch:
+    '''
+    The single predictions of a user waiting to be run together
+    '''
+
+    def __init__(self):
+        self.expenses = []
+        self.done = threading.Event()
+        self.y_pred = None
+        self.features = None
+        self.history = None
+        self.error = None
+
+class MicroBatcher:
+    """
+    Coalesces the concurrent single predictions of the same user.
+
+    The first prediction of a user opens a batch and waits for window seconds: the predictions of the same user (and model)
+    that come in meanwhile join the batch. Only the predictions that can wait should be batched (e.g. the single prediction events,
+    not the online predictions, see predict()). The batch then downloads the history covering all its expenses once,
+    engineers the features of all the expenses together, calls the model once and hands every caller its own prediction.
+
+    Parameters
+    ----------
+    window (float, default None)
+        How long (seconds) a batch waits for other predictions. Defaults to the TOTO_PREDICT_BATCH_WINDOW environment variable
+        (in milliseconds), or 20 ms. With 0, every prediction runs alone
+
+    max_size (int, default None)
+        The max number of predictions in a batch. Defaults to the TOTO_PREDICT_BATCH_SIZE environment variable, or 500
+    """
+
+    def __init__(self, window=None, max_size=None):
+        self.window = window if window is not None else float(os.environ.get('TOTO_PREDICT_BATCH_WINDOW', 20)) / 1000
+        self.max_size = max_size if max_size is not None else int(os.environ.get('TOTO_PREDICT_BATCH_SIZE', 500))
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def _run(self, batch, user, trained_model, correlation_id, context):
+        '''
+        Runs the predictions of a batch
+        '''
+        downloader = HistoryDownloader(None, correlation_id, context=context)
+
+        # 1. Download the data for the 4 months before the oldest expense
+        date_from = min([downloader.date_from(4, str(expense['date'])) for expense in batch.expenses])
+
+        history = downloader.load(user=user, dateGte=date_from)
+
+        if history is None:
+            history = empty_history()
+
+        # 2. Feature Engineering: only the features of the expenses to predict
+        features = engineer_expenses_features(batch.expenses, history)
+
+        # 3. Predict
+        (y_pred, y) = Predictor(features, MODEL_FEATURE_NAMES, correlation_id, model=trained_model, context=context).do()
+
+        if len(batch.expenses) > 1:
+            logger.compute(correlation_id, '[ {context} ] - [ MICROBATCH ] - Predicted {n} expenses of the same user together'.format(context=context, n=len(batch.expenses)), 'info')
+
+        batch.history = history
+        batch.features = features
+        batch.y_pred = y_pred
+
+    def predict(self, trained_model, expense, correlation_id, context='', batch=True):
+        """
+        Predicts the "monthly" classification of the expense, together with the other pending expenses of the same user
+
+        Parameters
+        ----------
+        trained_model (object)
+            The model to predict with
+
+        expense (dict)
+            The id, user, category, amount, description and date (YYYYMMDD) of the expense
+
+        batch (boolean, default True)
+            False to predict the expense alone, right away (e.g. an online prediction, whose caller is waiting)
+
+        Returns
+        -------
+        (y_pred, features, history)
+            The prediction of the expense, its features (data frame with one row) and the history used to engineer them
+        """
+        key = (expense['user'], id(trained_model))
+        window = self.window if batch else 0
+
+        with self.lock:
+            batch = self.pending.get(key) if window > 0 else None
+            leader = batch is None
+
+            if leader:
+                batch = MicroBatch()
+
+                if window > 0:
+                    self.pending[key] = batch
+
+            index = len(batch.expenses)
+            batch.expenses.append(expense)
+
+            # A full batch doesn't accept any other prediction
+            if len(batch.expenses) >= self.max_size and self.pending.get(key) is batch:
+                del self.pending[key]
+
+        if leader:
+            if window > 0:
+                time.sleep(window)
+
+            # Close the batch
+            with self.lock:
+                if self.pending.get(key) is batch:
+                    del self.pending[key]
+
+            try:
+                self._run(batch, expense['user'], trained_model, correlation_id, context)
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        return (batch.y_pred[index], batch.features.iloc[[index]].reset_index(drop=True), batch.history)
+
+# The micro-batcher shared by the whole process
+micro_batcher = MicroBatcher()
@@ -1,12 +1,15 @@
 import joblib
 import os
 import uuid
+import pandas as pd
 
 from toto_logger.logger import TotoLogger
 
-from dlg.history import HistoryDownloader
-from dlg.feature import FeatureEngineering
-from dlg.predictor import Predictor
+from dlg.historycache import history_cache
+from dlg.artifacts import ArtifactWriter
+
+from model.cache import model_cache
+from model.microbatch import micro_batcher
 
 from totoml.model import ModelPrediction
 
@@ -24,7 +27,7 @@ class SinglePredictor:
         Predicts the "monthly" classification of the provided expense
         '''
         correlation_id = context.correlation_id
-        trained_model = joblib.load(model.files['model'])
+        trained_model = model_cache.get(model, correlation_id)
         online = context.online
         context_process = context.process
 
@@ -41,31 +44,40 @@ class SinglePredictor:
         except KeyError as ke: 
             logger.compute(correlation_id, "[ PREDICTION LISTENER ] - Event {} has attributes missing. Got error: {}".format(data, ke), 'error')
 
-        # Create the folder where to store all the data
+        # The folder where to store the debug artifacts (if any)
         folder = "{tmp}/erboh/{fid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], fid=uuid.uuid1())
-        os.makedirs(name=folder, exist_ok=True)
+        artifacts = ArtifactWriter(folder, correlation_id, context=context_process)
+
+        # 1. Download the data for the 4 months before the expense date, engineer the features of the expense and predict, 
+        # together with the other concurrent predictions of the same user (see MicroBatcher). The online predictions don't wait for a batch
+        expense = {"id": expense_id, "user": user, "category": category, "amount": amount, "description": description, "date": date}
 
-        # 1. Download the data for the 4 months before the expense date
-        history_downloader = HistoryDownloader(folder, correlation_id, context=context_process)
-        history_downloader.download_from(user=user, num_months=4, from_date=date)
-        history_filename = history_downloader.append_expense(expense_id, user, amount, category, description, date)
+        (prediction, features, history) = micro_batcher.predict(trained_model, expense, correlation_id, context=context_process, batch=not online)
 
-        # 2. Feature Engineering
-        (model_feature_names, features_filename) = FeatureEngineering(folder, history_filename, correlation_id, context=context_process).do(user=user)
+        logger.compute(correlation_id, '[ {context} ] - [ PREDICT ] - Prediction: {p}'.format(context=context_process, p=prediction), 'info')
 
-        # 3. Load the model and predict
-        (y_pred, y) = Predictor(features_filename, model_feature_names, correlation_id, model=trained_model, context=context_process).do()
+        # Debug artifacts
+        artifacts.save(history, 'history.{user}'.format(user=user))
+        artifacts.save(features, 'features.{user}'.format(user=user))
 
-        logger.compute(correlation_id, '[ {context} ] - [ PREDICT ] - Prediction: {p}'.format(context=context_process, p=y_pred[0]), 'info')
+        files = artifacts.files()
 
-        # 4. Post an update to the expense
+        # 2. Post an update to the expense
         if not online:
-            update_expense({"id": expense_id, "monthly": y_pred[0]}, correlation_id, context=context_process)
+            # Current label of the expense, if it's already in the history
+            current_monthly = history.loc[history['id'] == expense_id, 'monthly'] if 'monthly' in history.columns else []
+            current_monthly = current_monthly.iloc[0] if len(current_monthly) > 0 else None
+
+            emitted = update_expense({"id": expense_id, "monthly": prediction}, correlation_id, context=context_process, current_monthly=current_monthly, model_version=model.info['version'])
+
+            # The label of the expense changed: the cached history has to be synced again from its date
+            if emitted and history_cache() is not None: 
+                history_cache().invalidate(since=date)
 
-            return ModelPrediction(files=[history_filename, features_filename])
+            return ModelPrediction(files=files)
 
         # Return the prediction
-        return ModelPrediction(prediction={"expenseId": expense_id, "monthly": int(y_pred[0])}, files=[history_filename, features_filename])
+        return ModelPrediction(prediction={"expenseId": expense_id, "monthly": int(prediction)}, files=files)
 
 
 # {"correlationId": "202002121919219199", "id": "5d71e5adcb15b1191e7ba273", "amount": 699.9, "user": "nicolas.matteazzi@gmail.com", "category": "AUTO", "description": "Train", "date": "20190906"}
\ No newline at end of file
@@ -8,48 +8,181 @@ from totoml.model import ModelPrediction
 
 from toto_logger.logger import TotoLogger
 
-from dlg.history import HistoryDownloader
+from dlg.history import HistoryDownloader, HistoryDownloadError
+from dlg.checkpoint import BatchCheckpoint
+from dlg.historycache import history_cache
 from dlg.feature import FeatureEngineering
 from dlg.predictor import Predictor
+from dlg.artifacts import ArtifactWriter
+
+from model.cache import model_cache
+from model import jobs
 
 from remote.expenses import update_expenses
 
 logger = TotoLogger()
 
+class BatchIncompleteError(Exception): 
+    pass
+
 class BatchPredictor:
 
     def __init__(self):
-        pass
+        self.model_version = None
 
     def predict (self, model, context, data):
 
         correlation_id = context.correlation_id
-        trained_model = joblib.load(model.files['model'])
+        trained_model = model_cache.get(model, correlation_id)
         context_process = context.process
 
+        # The version of the model, recorded with the published predictions (see MetricsStore)
+        self.model_version = model.info['version']
+
         user = 'all'
         if data is not None and "user" in data: 
             user = data['user']
 
-        # Create the folder where to store all the data
+        # All the users: one user at a time, with a checkpoint
+        if user == 'all': 
+            return self.predict_all(trained_model, correlation_id, context_process, data)
+
+        # The folder where to store the debug artifacts (if any)
         folder = "{tmp}/erboh/{fid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], fid=uuid.uuid1())
-        os.makedirs(name=folder, exist_ok=True)
+        artifacts = ArtifactWriter(folder, correlation_id, context=context_process)
 
         # 1. Download all history
-        history_filename = HistoryDownloader(folder, correlation_id, context=context_process).download(user=user)
+        jobs.stage('history')
+        history = HistoryDownloader(folder, correlation_id, context=context_process).load(user=user)
+
+        if history is None: 
+            return ModelPrediction()
+
+        artifacts.save(history, 'history.{user}'.format(user=user))
+
+        self.predict_history(history, user, trained_model, correlation_id, context_process, artifacts)
+
+        return ModelPrediction(files=artifacts.files())
+
+    def predict_all(self, trained_model, correlation_id, context_process, data): 
+        """
+        Predicts the expenses of all the users, one user (unit) at a time, so that only the data of one user is in memory. 
+
+        The batch runs in a work folder named after its batchId (from the data) or its correlation id, with a checkpoint 
+        (see BatchCheckpoint): if the batch is run again with the same batchId or correlation id, the users that were completed 
+        are skipped and their updates are not published again. A batch job that fails or is interrupted by a crash is run again 
+        that way (see JobQueue), and so is a batch submitted again with the same batchId. 
+        Raises BatchIncompleteError if some users were not completed (updates that failed to publish). 
+        The work folder is deleted (by Toto ML) only when all the users are completed
+        """
+        batch_id = data['batchId'] if data is not None and 'batchId' in data else correlation_id
+
+        folder = "{tmp}/erboh/batch/{bid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], bid=batch_id)
+        checkpoint = BatchCheckpoint(folder)
+
+        # 1. Download all history, partitioned by user
+        units = checkpoint.units()
+
+        if units is None: 
+            jobs.stage('history')
+
+            logger.compute(correlation_id, '[ {context} ] - [ BATCH ] - Starting batch {b}: downloading the history'.format(context=context_process, b=batch_id), 'info')
+
+            checkpoint.reset()
+            units = {}
+
+            try: 
+                for (index, shard) in enumerate(HistoryDownloader(folder, correlation_id, context=context_process).iter_shards(user='all')): 
+                    units.update(checkpoint.save_shard(index, shard))
+
+            except HistoryDownloadError as e: 
+                logger.compute(correlation_id, '[ {context} ] - [ BATCH ] - {e}'.format(context=context_process, e=e), 'error')
+                raise
+
+            checkpoint.save_units(units)
+
+        done = checkpoint.done()
+
+        logger.compute(correlation_id, '[ {context} ] - [ BATCH ] - Batch {b}: {u} users, {d} already completed'.format(context=context_process, b=batch_id, u=len(units), d=len(done)), 'info')
+
+        # 2. Predict, one user at a time
+        jobs.stage('predict')
+
+        artifacts = ArtifactWriter('{folder}/predictions'.format(folder=folder), correlation_id, context=context_process)
+        failed = 0
+
+        for (unit, user) in units.items(): 
+
+            if unit in done: 
+                continue
+
+            history = checkpoint.history(unit)
+
+            record = self.predict_history(history, user, trained_model, correlation_id, context_process, artifacts, name=unit)
+
+            # Updates that failed to publish: the user will be done again when the batch is run again (see JobQueue)
+            if record['failed'] > 0: 
+                failed += 1
+                continue
+
+            checkpoint.complete(unit, record)
+
+        artifacts.wait()
+
+        # The job fails and is run again (see JobQueue): the users not completed are done again
+        if failed > 0: 
+            raise BatchIncompleteError('Batch {b}: {f} users not completed'.format(b=batch_id, f=failed))
+
+        logger.compute(correlation_id, '[ {context} ] - [ BATCH ] - Batch {b} completed'.format(context=context_process, b=batch_id), 'info')
+
+        return ModelPrediction(files=[checkpoint.manifest_filename])
+
+    def predict_history(self, history, user, trained_model, correlation_id, context_process, artifacts, name=None): 
+        """
+        Predicts the expenses of the history that have no "monthly" label and publishes the updates
+
+        Parameters
+        ----------
+        name (string, default None)
+            The suffix of the artifacts: features.{name} and predictions.{name}. Defaults to 'features.{user}' and 'predictions'
+
+        Returns
+        -------
+        record (dict)
+            The number of predictions and the number of updates emitted, suppressed and failed
+        """
+        record = {"predictions": 0, "emitted": 0, "suppressed": 0, "failed": 0}
 
         # 2. Build Features for historical data
-        (model_feature_names, features_filename) = FeatureEngineering(folder, history_filename, correlation_id, context=context_process).do(user=user)
+        jobs.stage('features')
+        (model_feature_names, features) = FeatureEngineering(artifacts.folder, history, correlation_id, context=context_process).engineer(user=user)
+
+        if features is None: 
+            return record
+
+        artifacts.save(features, 'features.{name}'.format(name=name if name is not None else user))
 
         # 3. Load the model and predict
-        (y_pred, y, predictions_filename) = Predictor(features_filename, model_feature_names, correlation_id, save_to_folder=folder, model=trained_model, context=context_process).do()
+        jobs.stage('predict')
+        predictor = Predictor(features, model_feature_names, correlation_id, model=trained_model, context=context_process)
+        (y_pred, y) = predictor.do()
 
         # 5. For each prediction, update the expense (asynchronously)
         if y_pred is None: 
-            return ModelPrediction(files=[history_filename, features_filename])
+            return record
+
+        artifacts.save(predictor.predictions, 'predictions.{name}'.format(name=name) if name is not None else 'predictions')
+
+        jobs.stage('publish')
+
+        report = update_expenses(predictor.predictions, correlation_id, context=context_process, model_version=self.model_version)
+
+        # The labels of the predicted expenses changed: the cached history has to be synced again from the oldest of them
+        if history_cache() is not None: 
+            history_cache().invalidate(since=history.loc[history['id'].isin(predictor.predictions['id']), 'date'].min())
 
-        update_expenses(predictions_filename, correlation_id, context=context_process)
+        record.update({"predictions": len(y_pred), "emitted": report['emitted'], "suppressed": report['suppressed'], "failed": report['failed']})
 
-        return ModelPrediction(files=[history_filename, features_filename])
+        return record
 
 # Example: {"user": "nicolas.matteazzi@gmail.com", "correlationId": "test-predict-batch"}
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import uuid
+import pandas as pd
+
+from totoml.model import ModelPrediction
+
+from toto_logger.logger import TotoLogger
+
+from dlg.history import HistoryDownloader
+from dlg.compact import empty_history, concat_history
+from dlg.historycache import history_cache
+from dlg.feature import FeatureEngineering
+from dlg.predictor import Predictor
+from dlg.artifacts import ArtifactWriter
+from dlg.metrics import metrics_store
+from dlg.snapshot import feature_snapshots
+
+from model.cache import model_cache
+from model import jobs
+
+from remote.expenses import update_expenses
+from remote.published import published_store
+
+logger = TotoLogger()
+
+def add_expenses(history, expenses):
+    """
+    Adds the expenses (dicts) to the (compact) history: the new ones (e.g. a new expense whose event arrived before it could be downloaded), 
+    and the changed ones, whose values replace the ones in the history (e.g. the cached history, see HistoryCache). 
+    A changed expense without a "monthly" label keeps the label it has in the history
+    """
+    rows = {}
+
+    for expense in expenses:
+        rows[expense['id']] = {
+            "id": expense['id'],
+            "amount": float(expense['amount']),
+            "category": expense['category'],
+            "date": str(expense['date']),
+            "description": expense.get('description', ''),
+            "monthly": expense.get('monthly'),
+            "user": expense['user']
+        }
+
+    if len(rows) == 0:
+        return history
+
+    if 'id' in history.columns and 'monthly' in history.columns: 
+        replaced = history['id'].isin(list(rows.keys()))
+
+        for (id, monthly) in zip(history.loc[replaced, 'id'], history.loc[replaced, 'monthly']):
+            if rows[id]['monthly'] is None:
+                rows[id]['monthly'] = monthly
+
+        history = history.loc[~replaced]
+
+    elif 'id' in history.columns: 
+        history = history.loc[~history['id'].isin(list(rows.keys()))]
+
+    return concat_history([history, pd.DataFrame(list(rows.values()))])
+
+class IncrementalPredictor:
+    """
+    Re-predicts only the expenses affected by a set of new or changed expenses, instead of all the expenses (see BatchPredictor).
+
+    An expense of month M only changes the features of the expenses with the same user, category and amount in the months M to M + 4:
+    only the history of those months (and of the 4 months before M) is downloaded, and only those expenses are re-predicted:
+    the ones that have no "monthly" label, and the ones whose label was set by the model (see PublishedStore.labeled()).
+    Labels set by the users are never overwritten.
+    Only the predictions that change the label are published (see update_expenses())
+    """
+
+    def __init__(self):
+        self.model_version = None
+
+    def predict(self, model, context, data):
+        """
+        Parameters
+        ----------
+        data (dict)
+            {"expenses": [...]}: the new or changed expenses, each with the id, user, category, amount, description and date (YYYYMMDD).
+            A changed expense can carry its values before the change in a "previous" dict (e.g. {"amount": ..., "date": ...}),
+            so that the expenses that matched the old values are re-predicted as well.
+            A "monthly" label on a changed expense is the label set by the user: it's never overwritten, 
+            and it's counted in the metrics of the prediction that was made on the expense (see MetricsStore)
+        """
+        correlation_id = context.correlation_id
+        trained_model = model_cache.get(model, correlation_id)
+        context_process = context.process
+
+        changes = data['expenses']
+
+        # The version of the model, recorded with the published predictions (see MetricsStore)
+        self.model_version = model.info['version']
+
+        # The labels set on the changed expenses complete the metrics of the predictions made on them
+        labeled = [c for c in changes if c.get('monthly') is not None]
+
+        if len(labeled) > 0 and metrics_store() is not None: 
+            counted = metrics_store().record_labels([c['id'] for c in labeled], [c['monthly'] for c in labeled])
+
+            logger.compute(correlation_id, '[ {context} ] - [ INCREMENTAL ] - {n} labels received, {c} predictions counted in the metrics'.format(context=context_process, n=len(labeled), c=counted), 'info')
+
+        # The labels change the training features
+        if len(labeled) > 0 and feature_snapshots() is not None: 
+            feature_snapshots().count_label_changes(len(labeled))
+
+        # The folder where to store the debug artifacts (if any)
+        folder = "{tmp}/erboh/{fid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], fid=uuid.uuid1())
+        artifacts = ArtifactWriter(folder, correlation_id, context=context_process)
+
+        logger.compute(correlation_id, '[ {context} ] - [ INCREMENTAL ] - Re-predicting the expenses affected by {n} changed expenses'.format(context=context_process, n=len(changes)), 'info')
+
+        users = []
+        for change in changes:
+            if change['user'] not in users:
+                users.append(change['user'])
+
+        for user in users:
+            self.predict_user(user, [c for c in changes if c['user'] == user], trained_model, correlation_id, context_process, artifacts)
+
+        return ModelPrediction(files=artifacts.files())
+
+    def predict_user(self, user, changes, trained_model, correlation_id, context_process, artifacts):
+        '''
+        Re-predicts the expenses of the user affected by the changes
+        '''
+        downloader = HistoryDownloader(artifacts.folder, correlation_id, context=context_process)
+
+        # 1. Download the history from the 4 months before the oldest change
+        jobs.stage('history')
+
+        dates = [str(c['date']) for c in changes] + [str(c['previous']['date']) for c in changes if c.get('previous') and 'date' in c['previous']]
+
+        history = downloader.load(user=user, dateGte=min([downloader.date_from(4, date) for date in dates]))
+
+        if history is None:
+            history = empty_history()
+
+        history = add_expenses(history, changes)
+
+        artifacts.save(history, 'history.{user}'.format(user=user))
+
+        # The expenses labeled by the model can be re-predicted
+        predicted = None
+        store = published_store()
+
+        if store is not None and 'monthly' in history.columns:
+            labeled = store.labeled(history.loc[history['monthly'].notnull(), 'id'])
+
+            # ...unless the change carries another label than the model's: it's been set by the user
+            user_set = [c['id'] for c in changes if c.get('monthly') is not None and labeled.get(str(c['id'])) != bool(c['monthly'])]
+
+            store.forget(user_set)
+
+            predicted = set(labeled.keys()) - set([str(id) for id in user_set])
+
+        # 2. Build the features of the affected expenses
+        jobs.stage('features')
+        (model_feature_names, features) = FeatureEngineering(artifacts.folder, history, correlation_id, context=context_process, changes=changes, predicted=predicted).engineer(user=user)
+
+        if features is None:
+            return
+
+        artifacts.save(features, 'features.{user}'.format(user=user))
+
+        # 3. Predict
+        jobs.stage('predict')
+        predictor = Predictor(features, model_feature_names, correlation_id, model=trained_model, context=context_process)
+        (y_pred, y) = predictor.do()
+
+        if y_pred is None:
+            return
+
+        artifacts.save(predictor.predictions, 'predictions.{user}'.format(user=user))
+
+        # 4. Publish the predictions that change the label
+        jobs.stage('publish')
+
+        update_expenses(predictor.predictions, correlation_id, context=context_process, model_version=self.model_version)
+
+        # The labels of the predicted expenses changed: the cached history has to be synced again from the oldest of them
+        if history_cache() is not None:
+            history_cache().invalidate(since=history.loc[history['id'].isin(predictor.predictions['id']), 'date'].min())
+
+# Example: {"expenses": [{"id": "5d71e5adcb15b1191e7ba273", "amount": 699.9, "user": "nicolas.matteazzi@gmail.com", "category": "AUTO", "description": "Train", "date": "20190906"}]}
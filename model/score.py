@@ -5,8 +5,14 @@ import pandas as pd
 
 from dlg.history import HistoryDownloader
 from dlg.feature import FeatureEngineering
+from dlg.snapshot import feature_snapshots
 from dlg.predictor import Predictor
 from dlg.score import Scorer
+from dlg.metrics import metrics_store
+from dlg.artifacts import ArtifactWriter
+
+from model.cache import model_cache
+from model import jobs
 
 from totoml.model import ModelScore
 
@@ -14,10 +20,28 @@ from toto_logger.logger import TotoLogger
 
 logger = TotoLogger()
 
+# The scoring modes: from the accumulated confusion matrix of the model version (see MetricsStore), or recomputed on the whole history
+SCORE_MODES = ['accumulated', 'full']
+
 class ScoreProcess: 
 
-    def __init__(self): 
+    def __init__(self, mode=None, min_labels=None): 
+        """
+        Parameters
+        ----------
+        mode (string, default None)
+            One of SCORE_MODES. Defaults to the TOTO_SCORE_MODE environment variable, or 'full'. 
+            The accumulated scoring falls back to the full one until min_labels predictions of the model version got their label
+
+        min_labels (int, default None)
+            The min number of labeled predictions for the accumulated scoring. Defaults to the TOTO_SCORE_MIN_LABELS environment variable, or 500
+        """
         self.user = 'all'
+        self.mode = mode if mode is not None else os.environ.get('TOTO_SCORE_MODE', 'full')
+        self.min_labels = min_labels if min_labels is not None else int(os.environ.get('TOTO_SCORE_MIN_LABELS', 500))
+
+        if self.mode not in SCORE_MODES: 
+            raise ValueError('Score mode {m} not supported. Supported modes: {s}'.format(m=self.mode, s=SCORE_MODES))
    
     def score(self, model, context): 
         """
@@ -27,24 +51,61 @@ class ScoreProcess:
         model_name = model.info['name']    
         context_process = context.process
 
-        # Create the folder where to store all the data
+        # The metrics accumulated as the predictions of this model version got their labels
+        if self.mode == 'accumulated' and metrics_store() is not None: 
+
+            confusion = metrics_store().confusion(model.info['version'])
+
+            if sum(confusion.values()) >= max(self.min_labels, 1): 
+                logger.compute(correlation_id, '[ {context} ] - [ SCORING ] - Accumulated confusion matrix of version {v}: {c}'.format(context=context_process, v=model.info['version'], c=confusion), 'info')
+
+                return ModelScore(metrics_store().scores(model.info['version']), None)
+
+            logger.compute(correlation_id, '[ {context} ] - [ SCORING ] - {n} labeled predictions of version {v} (less than {m}): scoring on the whole history'.format(context=context_process, n=sum(confusion.values()), v=model.info['version'], m=self.min_labels), 'info')
+
+        # The folder where to store the debug artifacts (if any)
         folder = "{tmp}/erboh/{fid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], fid=uuid.uuid1())
-        os.makedirs(name=folder, exist_ok=True)
+        artifacts = ArtifactWriter(folder, correlation_id, context=context_process)
+
+        # 1. & 2. Download all history and engineer the features, or reuse the features snapshot (see FeatureSnapshots)
+        def build(): 
+
+            jobs.stage('history')
+            history = HistoryDownloader(folder, correlation_id, context=context_process).load(user=self.user)
+
+            artifacts.save(history, 'history.{user}'.format(user=self.user))
+
+            jobs.stage('features')
+            # TRAINING = TRUE because we want to keep the "monthly" column 
+            (model_feature_names, features) = FeatureEngineering(folder, history, correlation_id, training=True, context=context_process).engineer(user=self.user)
 
-        # 1. Download the historical data
-        history_filename = HistoryDownloader(folder, correlation_id, context=context_process).download(user=self.user)
+            artifacts.save(features, 'features.{user}'.format(user=self.user))
 
-        # 2. Engineer features
-        # TRAINING = TRUE because we want to keep the "monthly" column 
-        (model_feature_names, features_filename) = FeatureEngineering(folder, history_filename, correlation_id, training=True, context=context_process).do(user=self.user)
+            return (model_feature_names, features, history)
 
-        trained_model = joblib.load(model.files['model'])
+        # The expenses from a date on: tells whether the history changed since a snapshot
+        def probe(date_gte): 
+            return HistoryDownloader(folder, correlation_id, context=context_process).fetch_shard(self.user, date_gte)
+
+        snapshots = feature_snapshots()
+
+        if snapshots is not None: 
+            (model_feature_names, features) = snapshots.get(build, probe, correlation_id, context=context_process)
+        else: 
+            (model_feature_names, features, history) = build()
+
+        trained_model = model_cache.get(model, correlation_id)
 
         # 3. Predict on features
-        (y_pred, y) = Predictor(features_filename, model_feature_names, correlation_id, predict_only_labeled=True, model=trained_model, context=context_process).do()
+        jobs.stage('predict')
+        (y_pred, y) = Predictor(features, model_feature_names, correlation_id, predict_only_labeled=True, model=trained_model, context=context_process).do()
 
         # 4. Calculate accuracy
+        jobs.stage('score')
         score = Scorer(correlation_id, context=context_process).do(y, y_pred)
 
-        return ModelScore(score, [history_filename, features_filename])
+        # Wait for the artifacts: Toto ML deletes the folder once the scoring is done
+        artifacts.wait()
+
+        return ModelScore(score, artifacts.files())
 
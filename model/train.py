@@ -2,12 +2,18 @@ import os
 import uuid
 import joblib
 import pandas as pd
+import numpy as np
 
-from dlg.trainer_nogrid import Trainer
+from dlg import trainer, trainer_nogrid, trainer_incremental
 from dlg.history import HistoryDownloader
 from dlg.feature import FeatureEngineering
+from dlg.snapshot import feature_snapshots
 from dlg.predictor import Predictor
 from dlg.score import Scorer
+from dlg.artifacts import ArtifactWriter
+from dlg.compiled import compile_model
+
+from model import jobs
 
 from toto_logger.logger import TotoLogger
 
@@ -15,10 +21,27 @@ from totoml.model import TrainedModel
 
 logger = TotoLogger()
 
+# The trainers: fixed hyperparameters, or hyperparameters search (see dlg.trainer)
+TRAINERS = {
+    'fixed': trainer_nogrid.Trainer, 
+    'search': trainer.Trainer, 
+    'incremental': trainer_incremental.Trainer
+}
+
 class TrainingProcess: 
 
-    def __init__(self): 
+    def __init__(self, trainer=None): 
+        """
+        Parameters
+        ----------
+        trainer (string, default None)
+            One of TRAINERS. Defaults to the TOTO_TRAINER environment variable, or 'fixed'
+        """
         self.user = 'all'
+        self.trainer = trainer if trainer is not None else os.environ.get('TOTO_TRAINER', 'fixed')
+
+        if self.trainer not in TRAINERS: 
+            raise ValueError('Trainer {t} not supported. Supported trainers: {s}'.format(t=self.trainer, s=list(TRAINERS.keys())))
 
     def train(self, model_info, context):
 
@@ -30,27 +53,103 @@ class TrainingProcess:
         folder = "{tmp}/{model_name}/{fid}".format(tmp=os.environ['TOTO_TMP_FOLDER'], model_name=model_name, fid=uuid.uuid1())
         os.makedirs(name=folder, exist_ok=True)
 
-        # 1. Download all history
-        history_filename = HistoryDownloader(folder, correlation_id, context=context_process).download(user=self.user)
+        # Written on the training path: Toto ML uploads them with the retrained model (training data files)
+        artifacts = ArtifactWriter(folder, correlation_id, context=context_process, default_mode='sync')
+
+        # 1. & 2. Download all history and engineer the features, or reuse the features snapshot (see FeatureSnapshots)
+        def build(): 
+
+            jobs.stage('history')
+            history = HistoryDownloader(folder, correlation_id, context=context_process).load(user=self.user)
+
+            artifacts.save(history, 'history.{user}'.format(user=self.user))
+
+            jobs.stage('features')
+            # TRAINING = TRUE because we want to keep the "monthly" column 
+            (model_feature_names, features) = FeatureEngineering(folder, history, correlation_id, training=True, context=context_process).engineer(user=self.user)
 
-        # 2. Engineer features
-        # TRAINING = TRUE because we want to keep the "monthly" column 
-        (model_feature_names, features_filename) = FeatureEngineering(folder, history_filename, correlation_id, training=True, context=context_process).do(user=self.user)
+            artifacts.save(features, 'features.{user}'.format(user=self.user))
+
+            return (model_feature_names, features, history)
+
+        # The expenses from a date on: tells whether the history changed since a snapshot
+        def probe(date_gte): 
+            return HistoryDownloader(folder, correlation_id, context=context_process).fetch_shard(self.user, date_gte)
+
+        snapshots = feature_snapshots()
+
+        if snapshots is not None: 
+            (model_feature_names, features) = snapshots.get(build, probe, correlation_id, context=context_process)
+        else: 
+            (model_feature_names, features, history) = build()
 
         # 3. Training
-        (trained_model, train_features_filename, test_features_filename) = Trainer(folder, features_filename, model_feature_names, correlation_id, context=context_process).do()
+        jobs.stage('train')
+        options = {}
+
+        # The incremental training starts from the promoted model
+        if self.trainer == 'incremental': 
+            (options['base_model'], options['base_labels']) = self.champion(model_info, folder, context)
+
+        (trained_model, train_features, test_features) = TRAINERS[self.trainer](folder, features, model_feature_names, correlation_id, context=context_process, **options).fit()
+
+        artifacts.save(train_features, 'features_train')
+        artifacts.save(test_features, 'features_test')
 
         # 4. Predict and score
-        (y_test_pred, y_test) = Predictor(test_features_filename, model_feature_names, correlation_id, predict_only_labeled=True, model=trained_model, context=context_process).do()
+        jobs.stage('score')
+        (y_test_pred, y_test) = Predictor(test_features, model_feature_names, correlation_id, predict_only_labeled=True, model=trained_model, context=context_process).do()
 
         score = Scorer(correlation_id, context=context_process).do(y_test, y_test_pred)
 
+        # Check that the model can be compiled for the inference (see dlg.compiled), with the test set as parity check
+        compiled = compile_model(trained_model, test_features[model_feature_names])
+
+        logger.compute(correlation_id, '[ {context} ] - [ TRAINING ] - Model compiled for inference: {c}'.format(context=context_process, c=compiled is not None), 'info')
+
         # 5. Save all the objects
+        jobs.stage('save')
         model_filepath = "{folder}/model".format(folder=folder)
 
         joblib.dump(trained_model, model_filepath)
 
-        return TrainedModel({"model": model_filepath}, [history_filename, features_filename], score)
+        # The labels the model was trained with (the training set, which keeps the index of the features), for the next incremental training
+        labels_filepath = "{folder}/labels.npy".format(folder=folder)
+
+        np.save(labels_filepath, trainer_incremental.label_hashes(features.loc[train_features.index]))
+
+        # Wait for the artifacts: Toto ML deletes the folder once the model is saved
+        artifacts.wait()
+
+        return TrainedModel({"model": model_filepath, "labels": labels_filepath}, artifacts.files() or [], score)
+
+    def champion(self, model_info, folder, context): 
+        """
+        Downloads the promoted (champion) model and the labels it was trained with (see trainer_incremental.label_hashes())
+
+        Returns
+        -------
+        (model, labels)
+            None for the ones that are not available
+        """
+        # Imported here: only the incremental training needs the storage
+        from totoml.remote.gcpstorage import GCPStorage
+
+        os.makedirs('{folder}/champion'.format(folder=folder), exist_ok=True)
+
+        try: 
+            files = GCPStorage(context).load_champion_model(model_info, '{folder}/champion'.format(folder=folder))
+        except Exception as e: 
+            logger.compute(context.correlation_id, '[ {context} ] - [ TRAINING ] - Promoted model not available: {e}'.format(context=context.process, e=e), 'warn')
+            return (None, None)
+
+        if files is None or 'model' not in files: 
+            return (None, None)
+
+        model = joblib.load(files['model'])
+        labels = np.load(files['labels']) if 'labels' in files else None
+
+        return (model, labels)
 
 
 
@@ -1,26 +1,95 @@
+import numpy as np
 import pandas as pd
 
 from toto_pubsub.publisher import TotoEventPublisher
 from google.cloud import pubsub_v1
 from toto_logger.logger import TotoLogger
 
+from dlg.artifacts import read_artifact
+from dlg.metrics import metrics_store
+from dlg.snapshot import feature_snapshots
+
+from remote.publisher import BatchPublisher, PubSubEventPublisher
+from remote.published import published_store
+
 publisher = TotoEventPublisher(microservice='model-erboh', topics=['expenseUpdateRequested'])
 
+# Publisher of the batches of updates, whose failures can be seen (see BatchPublisher)
+pubsub_publisher = PubSubEventPublisher()
+
 logger = TotoLogger()
 
-def update_expense(expense, correlation_id, context=''): 
+def changed(ids, monthly, current=None, published=None): 
     """
-    This method updates a single expense
-    It updates the "monthly" property of the expense
+    Tells which predictions have to be published: the ones that differ from the current "monthly" value of the expense 
+    and from the last value published for it
+
+    Parameters
+    ----------
+    ids (list)
+        The ids of the expenses
+
+    monthly (list of bool)
+        The predicted values
+
+    current (array, default None)
+        The current "monthly" values of the expenses (True, False, or null when not labeled)
+
+    published (PublishedStore, default None)
+        The record of the last published values
+
+    Returns
+    -------
+    changed (numpy array of bool)
+    """
+    mask = np.ones(len(ids), dtype=bool)
+
+    if current is not None: 
+        current = pd.Series(current, dtype=object)
+        mask = current.isnull().to_numpy() | (current.to_numpy() != np.array(monthly, dtype=bool))
+
+    if published is not None and mask.any(): 
+        last = published.last([id for (id, m) in zip(ids, mask) if m])
+        mask &= np.array([last.get(str(id)) != m for (id, m) in zip(ids, monthly)], dtype=bool)
+
+    return mask
+
+def update_expense(expense, correlation_id, context='', current_monthly=None, model_version=None): 
     """
-    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Updating payment with prediction'.format(context=context), 'info')
+    This method updates a single expense
+    It updates the "monthly" property of the expense, unless it already has that value or it's already been published
+
+    Parameters
+    ----------
+    current_monthly (boolean, default None)
+        The current "monthly" value of the expense, if known
+
+    model_version (default None)
+        The version of the model that made the prediction: the prediction (published or suppressed) is recorded in the metrics (see MetricsStore)
 
+    Returns
+    -------
+    emitted (boolean)
+        True if the update has been published, False if it's been suppressed
+    """
     id = expense['id']
 
     if expense['monthly'] == 1:
         monthly = True
     else: 
         monthly = False
+
+    store = published_store()
+
+    if not changed([id], [monthly], current=[current_monthly], published=store)[0]: 
+        logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Payment already has monthly = {m}: update suppressed'.format(context=context, m=monthly), 'info')
+
+        if model_version is not None and metrics_store() is not None: 
+            metrics_store().record_predictions(model_version, [id], [monthly], published=False)
+
+        return False
+
+    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Updating payment with prediction'.format(context=context), 'info')
     
     # Format the message
     msg = {
@@ -32,34 +101,84 @@ def update_expense(expense, correlation_id, context=''):
     # Post the expense to the update queue
     publisher.publish(topic='expenseUpdateRequested', event=msg)
 
-    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Payment updated'.format(context=context), 'info')
+    if store is not None: 
+        store.record([id], [monthly])
+
+    if model_version is not None and metrics_store() is not None: 
+        metrics_store().record_predictions(model_version, [id], [monthly])
+
+    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Payment updated'.format(context=context), 'info')
 
-def update_expenses(predictions_filename, correlation_id, context=''): 
+    return True
+
+def update_expenses(predictions_filename, correlation_id, context='', event_publisher=None, model_version=None): 
     """
     This method updates multiple expenses
-    The input is a predictions filename
+    The input is a predictions filename, or the predictions data frame
+
+    The messages are built from the whole predictions columns at once, and published in batches (see BatchPublisher). 
+    Only the predictions that changed are published (see changed()): the ones that differ from the current value 
+    of the expense (the 'current_monthly' column, if present) and from the last value published for it (see PublishedStore)
+
+    Parameters
+    ----------
+    event_publisher (object, default None)
+        The publisher of the events (an object with a publish(topic, event) method, e.g. an in-process stand-in for tests). 
+        Defaults to the PubSubEventPublisher
+
+    model_version (default None)
+        The version of the model that made the predictions: the published and suppressed predictions are recorded in the metrics (see MetricsStore)
+
+    Returns
+    -------
+    report (dict)
+        The publishing report (see BatchPublisher.close()), with the number of updates emitted and suppressed
     """
     # Load the predictions
-    predictions = pd.read_csv(predictions_filename)
+    if isinstance(predictions_filename, pd.DataFrame): 
+        predictions = predictions_filename
+    else: 
+        predictions = read_artifact(predictions_filename, columns=['id', 'occurs_monthly', 'current_monthly'])
 
-    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Updating {r} payments with predictions'.format(context=context, r=len(predictions)), 'info')
+    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Updating {r} payments with predictions'.format(context=context, r=len(predictions)), 'info')
 
-    for index, row in predictions.iterrows():
-        id = row['id']
-        if row['occurs_monthly'] == 1: 
-            monthly = True
-        else: 
-            monthly = False
+    ids = predictions['id'].tolist()
+    monthly = (predictions['occurs_monthly'].to_numpy() == 1).tolist()
 
-        # Format the message
-        msg = {
-            'correlationId': correlation_id,
-            "id": id, 
-            "monthly": monthly
-        }
+    store = published_store()
 
-        # Post the expense to the update queue
-        publisher.publish(topic='expenseUpdateRequested', event=msg)
+    mask = changed(ids, monthly, current=predictions['current_monthly'] if 'current_monthly' in predictions.columns else None, published=store)
 
-    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Payments updated'.format(context=context), 'info')
-    
+    if model_version is not None and metrics_store() is not None and not mask.all(): 
+        metrics_store().record_predictions(model_version, [id for (id, m) in zip(ids, mask) if not m], [value for (value, m) in zip(monthly, mask) if not m], published=False)
+
+    ids = [id for (id, m) in zip(ids, mask) if m]
+    monthly = [value for (value, m) in zip(monthly, mask) if m]
+
+    batch_publisher = BatchPublisher(event_publisher if event_publisher is not None else pubsub_publisher, 'expenseUpdateRequested', correlation_id, context=context)
+
+    # Post the expenses to the update queue
+    batch_publisher.publish_all([{'correlationId': correlation_id, "id": id, "monthly": m} for (id, m) in zip(ids, monthly)])
+
+    report = batch_publisher.close()
+
+    # Record what has actually been published
+    failed = set([event['id'] for event in batch_publisher.failed_events])
+    published = [(id, m) for (id, m) in zip(ids, monthly) if id not in failed]
+
+    if store is not None: 
+        store.record([id for (id, m) in published], [m for (id, m) in published])
+
+    # The published labels change the training features
+    if feature_snapshots() is not None: 
+        feature_snapshots().count_label_changes(len(published))
+
+    if model_version is not None and metrics_store() is not None: 
+        metrics_store().record_predictions(model_version, [id for (id, m) in published], [m for (id, m) in published])
+
+    report['emitted'] = len(ids)
+    report['suppressed'] = len(mask) - len(ids)
+
+    logger.compute(correlation_id, '[ {context} ] - [ UPDATE ] - Payments updated: {e} updates emitted, {s} suppressed (unchanged)'.format(context=context, e=report['emitted'], s=report['suppressed']), 'info')
+
+    return report
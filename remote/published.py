@@ -0,0 +1,118 @@
+import os
+import time
+import sqlite3
+import threading
+
+# Max number of ids per SQL query
+QUERY_CHUNK_SIZE = 500
+
+class PublishedStore:
+    """
+    Persistent record of the last "monthly" value published for every expense (see remote.expenses).
+
+    Records older than max_age are ignored, so that an update that got lost downstream is published again eventually.
+    The labels set by the model are also kept apart, without expiring (see labeled()): they tell which labels the model can overwrite.
+
+    The record is a SQLite database, safe to share between the threads of a process and between processes.
+
+    Parameters
+    ----------
+    filename (string)
+        The SQLite database file
+
+    max_age (float, default 7 days)
+        The max age (seconds) of a record to be considered
+    """
+
+    def __init__(self, filename, max_age=7 * 24 * 3600):
+        self.filename = filename
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        folder = os.path.dirname(filename)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # Waits for the writer of another process (e.g. the job workers publishing a batch) instead of failing
+        self.connection = sqlite3.connect(filename, check_same_thread=False, timeout=30)
+
+        # Readers don't block the writer of another process
+        self.connection.execute('PRAGMA journal_mode=WAL')
+
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS published (id TEXT PRIMARY KEY, monthly INTEGER NOT NULL, ts REAL NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS labels (id TEXT PRIMARY KEY, monthly INTEGER NOT NULL)')
+
+    def select(self, query, ids, args=[]):
+        """
+        Runs the query (with an "id IN ({p})" placeholder) on the ids, by chunks, and returns the dict {id: monthly value (bool)}
+        """
+        ids = [str(id) for id in ids]
+        values = {}
+
+        with self.lock:
+            for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[i:i + QUERY_CHUNK_SIZE]
+
+                rows = self.connection.execute(query.format(p=','.join(['?'] * len(chunk))), args + chunk)
+
+                values.update({id: bool(monthly) for (id, monthly) in rows})
+
+        return values
+
+    def last(self, ids):
+        """
+        Returns a dict {id: last published monthly value (bool)} for the ids that have a recent enough record
+        """
+        return self.select('SELECT id, monthly FROM published WHERE ts >= ? AND id IN ({p})', ids, [time.time() - self.max_age])
+
+    def labeled(self, ids):
+        """
+        Returns a dict {id: monthly value (bool)} for the ids whose label has been set by the model, however old
+        """
+        return self.select('SELECT id, monthly FROM labels WHERE id IN ({p})', ids)
+
+    def record(self, ids, monthly):
+        """
+        Records the monthly values (iterable of bools) published for the ids, as the labels set by the model
+        """
+        now = time.time()
+        rows = [(str(id), int(m)) for (id, m) in zip(ids, monthly)]
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO published (id, monthly, ts) VALUES (?, ?, ?)', [row + (now, ) for row in rows])
+            self.connection.executemany('INSERT OR REPLACE INTO labels (id, monthly) VALUES (?, ?)', rows)
+
+    def forget(self, ids):
+        """
+        Forgets the labels set by the model on the ids (e.g. because the user set another label): they're not overwritten anymore
+        """
+        ids = [str(id) for id in ids]
+
+        with self.lock, self.connection:
+            for i in range(0, len(ids), QUERY_CHUNK_SIZE):
+                chunk = ids[i:i + QUERY_CHUNK_SIZE]
+
+                self.connection.execute('DELETE FROM labels WHERE id IN ({p})'.format(p=','.join(['?'] * len(chunk))), chunk)
+
+# The stores shared by the whole process, by file
+published_stores = {}
+
+def published_store():
+    '''
+    Returns the record of the published values: the TOTO_PUBLISHED_STORE environment variable (SQLite file),
+    or {TOTO_TMP_FOLDER}/erboh/published.sqlite if not set. TOTO_PUBLISHED_STORE can be set to 'none' to disable the record.
+    The TOTO_PUBLISHED_MAX_AGE environment variable sets the max age of the records, in hours (default 168, a week)
+    '''
+    filename = os.environ.get('TOTO_PUBLISHED_STORE')
+
+    if filename is None and os.environ.get('TOTO_TMP_FOLDER'):
+        filename = '{tmp}/erboh/published.sqlite'.format(tmp=os.environ['TOTO_TMP_FOLDER'])
+
+    if filename is None or filename == 'none':
+        return None
+
+    if filename not in published_stores:
+        published_stores[filename] = PublishedStore(filename, max_age=float(os.environ.get('TOTO_PUBLISHED_MAX_AGE', 168)) * 3600)
+
+    return published_stores[filename]
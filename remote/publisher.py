@@ -0,0 +1,245 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import pubsub_v1
+from toto_logger.logger import TotoLogger
+
+logger = TotoLogger()
+
+# Max number of messages of a Pub/Sub publish request
+PUBSUB_MAX_MESSAGES = 1000
+
+class PubSubEventPublisher:
+    """
+    Publishes events on Pub/Sub, with the same publish(topic=..., event=...) method as the TotoEventPublisher,
+    through a PublisherClient that batches the messages (BatchSettings) and bounds the messages in flight (PublishFlowControl:
+    publishing blocks when over). publish() returns the future of the message, so that its failure can be seen (see BatchPublisher):
+    the TotoEventPublisher returns nothing.
+
+    The client is created at the first event.
+
+    Parameters
+    ----------
+    project_id (string, default None)
+        The Google project of the topics. Defaults to the TOTO_EVENTS_GCP_PROJECT_ID environment variable
+
+    batch_size (int, default None)
+        The max number of messages per publish request (at most PUBSUB_MAX_MESSAGES). Defaults to the TOTO_PUBLISH_BATCH_SIZE environment variable, or 500
+
+    max_latency (float, default None)
+        The max time (seconds) a message waits for its request to fill up. Defaults to the TOTO_PUBLISH_MAX_LATENCY environment variable, or 0.1
+
+    max_in_flight (int, default None)
+        The max number of requests being published at the same time. Defaults to the TOTO_PUBLISH_MAX_IN_FLIGHT environment variable, or 8
+    """
+
+    def __init__(self, project_id=None, batch_size=None, max_latency=None, max_in_flight=None):
+        self.project_id = project_id
+        self.batch_size = min(batch_size if batch_size is not None else int(os.environ.get('TOTO_PUBLISH_BATCH_SIZE', 500)), PUBSUB_MAX_MESSAGES)
+        self.max_latency = max_latency if max_latency is not None else float(os.environ.get('TOTO_PUBLISH_MAX_LATENCY', 0.1))
+        self.max_in_flight = max_in_flight if max_in_flight is not None else int(os.environ.get('TOTO_PUBLISH_MAX_IN_FLIGHT', 8))
+        self.lock = threading.Lock()
+        self.client = None
+
+    def _client(self):
+        with self.lock:
+            if self.client is None:
+                self.client = pubsub_v1.PublisherClient(
+                    batch_settings=pubsub_v1.types.BatchSettings(max_messages=self.batch_size, max_latency=self.max_latency),
+                    publisher_options=pubsub_v1.types.PublisherOptions(flow_control=pubsub_v1.types.PublishFlowControl(
+                        message_limit=self.batch_size * self.max_in_flight,
+                        limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK
+                    ))
+                )
+
+            return self.client
+
+    def publish(self, topic, event):
+        """
+        Publishes the event (dict, sent as JSON) on the topic (just the name, without the project)
+
+        Returns
+        -------
+        future (google.cloud.pubsub_v1.publisher.futures.Future)
+            The future of the message: its result() is the message id, or raises the publishing error
+        """
+        project_id = self.project_id if self.project_id is not None else os.environ['TOTO_EVENTS_GCP_PROJECT_ID']
+
+        future = self._client().publish('projects/{p}/topics/{t}'.format(p=project_id, t=topic), json.dumps(event).encode('utf-8'))
+
+        logger.event_out(event['correlationId'], topic, '')
+
+        return future
+
+class BatchPublisher:
+    """
+    Publishes events in batches, in the background, with a bounded number of batches in flight.
+
+    Events are grouped in batches of batch_size events. A batch is sent when it's full,
+    when its first event is older than max_latency, or when the publisher is closed.
+    Every batch is published by a worker thread: when max_in_flight batches are being published,
+    sending a new one blocks until one of them completes (flow control).
+
+    The events are published with publisher.publish(topic=..., event=...). If that returns a future
+    (e.g. a Pub/Sub publish future, see PubSubEventPublisher), the worker publishes the whole batch and then waits for the futures,
+    so that failures are counted. The events that failed are kept in failed_events.
+
+    Parameters
+    ----------
+    publisher (object)
+        The publisher of the single events, e.g. a PubSubEventPublisher, or any in-process stand-in with the same publish() method
+
+    topic (string)
+        The topic to publish the events on
+
+    batch_size (int, default None)
+        The max number of events per batch. Defaults to the TOTO_PUBLISH_BATCH_SIZE environment variable, or 500
+
+    max_latency (float, default None)
+        The max time (seconds) an event waits for its batch to fill up. Defaults to the TOTO_PUBLISH_MAX_LATENCY environment variable, or 0.1
+
+    max_in_flight (int, default None)
+        The max number of batches being published at the same time. Defaults to the TOTO_PUBLISH_MAX_IN_FLIGHT environment variable, or 8
+    """
+
+    def __init__(self, publisher, topic, correlation_id, context='', batch_size=None, max_latency=None, max_in_flight=None):
+        self.publisher = publisher
+        self.topic = topic
+        self.correlation_id = correlation_id
+        self.context = context
+        self.batch_size = batch_size if batch_size is not None else int(os.environ.get('TOTO_PUBLISH_BATCH_SIZE', 500))
+        self.max_latency = max_latency if max_latency is not None else float(os.environ.get('TOTO_PUBLISH_MAX_LATENCY', 0.1))
+        self.max_in_flight = max_in_flight if max_in_flight is not None else int(os.environ.get('TOTO_PUBLISH_MAX_IN_FLIGHT', 8))
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='publisher')
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.batch = []
+        self.timer = None
+        self.futures = []
+
+        self.start = time.time()
+        self.published = 0
+        self.failed = 0
+        self.batches = 0
+        self.error = None
+        self.failed_events = []
+
+    def _fail(self, event, error):
+        with self.stats_lock:
+            self.failed += 1
+            self.error = error
+            self.failed_events.append(event)
+
+    def _publish_batch(self, batch):
+        '''
+        Publishes a batch of events (runs in a worker thread)
+        '''
+        try:
+            futures = []
+
+            for event in batch:
+                try:
+                    futures.append((event, self.publisher.publish(topic=self.topic, event=event)))
+                except Exception as e:
+                    self._fail(event, e)
+
+            # The futures of the batch complete together
+            for (event, future) in futures:
+                try:
+                    if hasattr(future, 'result'):
+                        future.result()
+
+                    with self.stats_lock:
+                        self.published += 1
+
+                except Exception as e:
+                    self._fail(event, e)
+        finally:
+            self.in_flight.release()
+
+    def _send(self):
+        '''
+        Sends the current batch to a worker. Has to be called holding the lock
+        '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if len(self.batch) == 0:
+            return
+
+        (batch, self.batch) = (self.batch, [])
+
+        # Flow control: wait for a free slot
+        self.in_flight.acquire()
+
+        self.batches += 1
+        self.futures.append(self.executor.submit(self._publish_batch, batch))
+
+    def _expire(self, batch):
+        '''
+        Sends the batch if it's still the current one once max_latency is over
+        '''
+        with self.lock:
+            if self.batch is batch:
+                self._send()
+
+    def publish(self, event):
+        """
+        Adds an event to the current batch
+        """
+        with self.lock:
+            self.batch.append(event)
+
+            if len(self.batch) >= self.batch_size:
+                self._send()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_latency, self._expire, args=[self.batch])
+                self.timer.daemon = True
+                self.timer.start()
+
+    def publish_all(self, events):
+        """
+        Adds all the events (iterable) to the batches
+        """
+        for event in events:
+            self.publish(event)
+
+    def close(self):
+        """
+        Sends the last batch, waits for all the batches to be published and logs the throughput and the failures
+
+        Returns
+        -------
+        report (dict)
+            The number of events published and failed, the number of batches, the elapsed seconds and the events per second
+        """
+        with self.lock:
+            self._send()
+
+        for future in self.futures:
+            future.result()
+
+        self.executor.shutdown()
+
+        elapsed = time.time() - self.start
+
+        report = {
+            "published": self.published,
+            "failed": self.failed,
+            "batches": self.batches,
+            "seconds": elapsed,
+            "eventsPerSecond": self.published / elapsed if elapsed > 0 else None
+        }
+
+        logger.compute(self.correlation_id, '[ {context} ] - [ PUBLISH ] - Published {p} {t} events in {b} batches, {s:.2f}s ({r:.0f} events/s), {f} failed'.format(context=self.context, p=self.published, t=self.topic, b=self.batches, s=elapsed, r=report['eventsPerSecond'] or 0, f=self.failed), 'info')
+
+        if self.failed > 0:
+            logger.compute(self.correlation_id, '[ {context} ] - [ PUBLISH ] - {f} {t} events failed. Last error: {e}'.format(context=self.context, f=self.failed, t=self.topic, e=repr(self.error)), 'error')
+
+        return report
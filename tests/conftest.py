@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The modules are imported as in the app (e.g. "from dlg.feature import ..."), from the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read when the modules calling the Toto APIs are imported: the tests never call them
+os.environ.setdefault('TOTO_API_AUTH', 'test')
+os.environ.setdefault('TOTO_HOST', 'localhost')
+
+@pytest.fixture(autouse=True)
+def tmp_folder(tmp_path, monkeypatch):
+    '''
+    Every test gets its own TOTO_TMP_FOLDER
+    '''
+    monkeypatch.setenv('TOTO_TMP_FOLDER', str(tmp_path))
+
+    return tmp_path
@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from dlg.artifacts import ArtifactWriter, read_artifact
+
+def frame():
+    return pd.DataFrame({
+        "id": pd.Categorical(['a', 'b', 'c']),
+        "amount": np.array([999, 1250, -1], dtype=np.int64),
+        "description": ['netflix', None, 'coop'],
+        "monthly": [True, None, False]
+    })
+
+@pytest.mark.parametrize('artifact_format', ['npz', 'csv'])
+def test_artifacts_are_single_files(tmp_folder, artifact_format):
+    artifacts = ArtifactWriter(str(tmp_folder / 'run'), 'cid', mode='sync', artifact_format=artifact_format)
+
+    filename = artifacts.save(frame(), 'features.all')
+
+    assert artifacts.files() == [filename]
+    assert os.path.isfile(filename)
+
+def test_npz_round_trip(tmp_folder):
+    artifacts = ArtifactWriter(str(tmp_folder / 'run'), 'cid', mode='sync', artifact_format='npz')
+
+    filename = artifacts.save(frame(), 'features.all')
+
+    df = read_artifact(filename)
+
+    assert df['id'].tolist() == ['a', 'b', 'c']
+    assert df['amount'].tolist() == [999, 1250, -1]
+    assert df['description'].tolist()[0::2] == ['netflix', 'coop'] and pd.isnull(df['description'][1])
+    assert df['monthly'].tolist()[0::2] == [True, False] and pd.isnull(df['monthly'][1])
+
+    assert read_artifact(filename, columns=['amount', 'other']).columns.tolist() == ['amount']
+
+def test_default_mode(tmp_folder, monkeypatch):
+    monkeypatch.delenv('TOTO_ARTIFACTS', raising=False)
+
+    assert ArtifactWriter(str(tmp_folder / 'predict'), 'cid').mode == 'async'
+    assert ArtifactWriter(str(tmp_folder / 'train'), 'cid', default_mode='sync').mode == 'sync'
+
+    monkeypatch.setenv('TOTO_ARTIFACTS', 'none')
+
+    assert ArtifactWriter(str(tmp_folder / 'train'), 'cid', default_mode='sync').mode == 'none'
@@ -0,0 +1,73 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.neural_network import MLPClassifier
+
+from dlg.compiled import CompiledMLP, compile_model, parity_check
+
+def binary_features(rows, columns, seed=0):
+    return np.random.default_rng(seed).integers(0, 2, size=(rows, columns))
+
+def fitted(hidden_layer_sizes, activation='identity', columns=8):
+    X = binary_features(500, columns)
+    y = (X[:, 0] + X[:, 1] + X[:, 2] >= 2).astype(np.int64)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+        model = MLPClassifier(activation=activation, hidden_layer_sizes=hidden_layer_sizes, max_iter=200, random_state=100)
+        model.fit(pd.DataFrame(X, columns=['f{i}'.format(i=i) for i in range(columns)]), y)
+
+    return model
+
+@pytest.mark.parametrize('hidden_layer_sizes', [(5, ), (5, 5), (9, 9)])
+def test_compiled_predicts_as_the_model(hidden_layer_sizes):
+    model = fitted(hidden_layer_sizes)
+    compiled = compile_model(model)
+
+    assert isinstance(compiled, CompiledMLP)
+
+    X = pd.DataFrame(binary_features(10000, 8, seed=1), columns=model.feature_names_in_)
+
+    assert np.array_equal(compiled.predict(X), model.predict(X))
+    assert np.array_equal(compiled.predict(X.to_numpy()), model.predict(X))
+    assert np.allclose(compiled.predict_proba(X), model.predict_proba(X), atol=1e-5)
+
+def test_other_activations_are_not_compiled():
+    assert compile_model(fitted((5, ), activation='relu')) is None
+
+def threshold_model(bias):
+    '''
+    A model whose decision is x0 + x1 + bias: on [1, 0], the logistic is just above 0.5 for a bias just above -1
+    '''
+    model = MLPClassifier(activation='identity', hidden_layer_sizes=(1, ), max_iter=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=ConvergenceWarning)
+        model.fit(np.array([[0, 0], [1, 1]]), np.array([0, 1]))
+
+    model.coefs_ = [np.array([[1.0], [1.0]]), np.array([[1.0]])]
+    model.intercepts_ = [np.array([0.0]), np.array([bias])]
+
+    return model
+
+def test_float32_threshold_edge():
+    X = np.array([[1, 0], [0, 0], [1, 1]])
+
+    # float32 rounds the bias to -1: the compiled decision is exactly 0 (class 0), the model's is 1e-10 (class 1)
+    model = threshold_model(-1 + 1e-10)
+
+    assert model.predict(X).tolist() == [1, 0, 1]
+    assert CompiledMLP(model).predict(X).tolist() == [0, 0, 1]
+
+    # The parity check catches it: the model is not compiled
+    assert not parity_check(model, CompiledMLP(model), X)
+    assert compile_model(model, X) is None
+
+    # Away from the edge, the compiled model agrees
+    model = threshold_model(-1 + 1e-3)
+
+    assert np.array_equal(CompiledMLP(model).predict(X), model.predict(X))
+    assert compile_model(model, X) is not None
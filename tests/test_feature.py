@@ -0,0 +1,21 @@
+import pandas as pd
+
+from dlg.feature import bow, FeatureEngineering, MODEL_FEATURE_NAMES
+
+def expenses(descriptions):
+    return pd.DataFrame([
+        {"id": 'e{m}'.format(m=m), "amount": 9.99, "category": 'FOOD', "date": '2019{m:02d}05'.format(m=m), "description": d, "monthly": True if m < len(descriptions) else None, "user": 'user@x.com'}
+        for (m, d) in enumerate(descriptions, start=1)
+    ])
+
+def test_bow_without_words():
+    matrix = bow(pd.DataFrame({"description": ['.', 'a', '']}))
+
+    assert matrix.shape == (3, 0)
+
+def test_features_without_words():
+    (names, features) = FeatureEngineering(None, expenses(['x', '.', 'x', '']), 'cid').engineer(user='user@x.com')
+
+    assert names == MODEL_FEATURE_NAMES
+    assert features['id'].tolist() == ['e4']
+    assert features['sac1_m1'].tolist() == [1]
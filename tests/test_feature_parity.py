@@ -0,0 +1,145 @@
+import re
+from datetime import datetime as dt
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.feature_extraction.text import CountVectorizer
+
+import dlg.lookback
+from dlg.compact import compact_history
+from dlg.feature import bow, sparse_nbytes, FeatureEngineering, MODEL_FEATURE_NAMES
+from dlg.lookback import LOOKBACK_FEATURE_NAMES, LookbackIndex, to_engineer
+from dlg.months import MonthStore
+
+# The baseline feature engineering, row by row (before the MonthStore, the LookbackIndex and the sparse bag of words)
+
+def baseline_month(df, current_date, delta):
+    month = current_date.month + delta
+    year = current_date.year + (month - 1) // 12
+
+    return df[df['yearMonth'] == year * 100 + (month - 1) % 12 + 1]
+
+def baseline_overlaps(ds, row):
+    return ds['description_bow'].apply(lambda other: np.sum(np.logical_and(other.tolist()[0], row['description_bow'].tolist()[0])))
+
+def baseline_same_amt_cat(row, dataset):
+    ds = dataset[(dataset['category'] == row['category']) & (dataset['amount'] == row['amount']) & (dataset['user'] == row['user'])]
+
+    features = dict.fromkeys(['sacsw1', 'sacsw2', 'sacsw3m', 'sac1', 'sac2m', 'sacd', 'sacd3'], 0)
+
+    if len(ds) > 0:
+        shared = sum(baseline_overlaps(ds, row) > 0)
+
+        days = pd.to_datetime(ds['date'], format='%Y%m%d').dt.day
+        row_day = dt.strptime(str(row['date']), '%Y%m%d').day
+
+        if sum(days == row_day) > 0:
+            features['sacd'] = 1
+        elif sum(days <= row_day + 3) > 0 and sum(days >= row_day - 3) > 0:
+            features['sacd3'] = 1
+
+        if len(ds) == 1:
+            features['sacsw1' if shared == 1 else 'sac1'] = 1
+        elif shared == 0:
+            features['sac2m'] = 1
+        elif shared == 2:
+            features['sacsw2'] = 1
+        elif shared > 2:
+            features['sacsw3m'] = 1
+
+    return pd.Series(features)
+
+def baseline_sesm(row, dataset):
+    ds = dataset[(dataset['category'] == row['category']) & (dataset['amount'] == row['amount']) & (dataset['user'] == row['user'])]
+
+    return int(len(ds) > 1 and sum(baseline_overlaps(ds, row) > 0) > 1)
+
+def baseline_features(history, training):
+    df = history.copy()
+    df['description'] = df['description'].apply(lambda x: re.sub(r'\.', ' ', x))
+
+    vectorizer = CountVectorizer().fit(df['description'])
+    df['description_bow'] = df['description'].apply(lambda x: vectorizer.transform([x]).toarray())
+
+    features = []
+
+    for month in sorted(df['yearMonth'].unique()):
+
+        features_m = df[(df['yearMonth'] == month) & (True if training else df['monthly'].isnull())]
+
+        if features_m.empty:
+            continue
+
+        current_date = dt(month // 100, month % 100, 1)
+
+        for k in range(1, 5):
+            fm = features_m.apply(baseline_same_amt_cat, axis=1, dataset=baseline_month(df, current_date, -k))
+            for name in fm.columns:
+                features_m['{f}_m{k}'.format(f=name, k=k)] = fm[name]
+
+        features_m['sesm'] = features_m.apply(baseline_sesm, axis=1, dataset=features_m)
+
+        features.append(features_m)
+
+    return pd.concat(features).set_index('id').sort_index()
+
+def fixture_history(rows=400, seed=7):
+    '''
+    A history of 2 users over 8 months (across a year), with few amounts and categories so that the lookback finds matches,
+    and descriptions sharing some words
+    '''
+    rng = np.random.default_rng(seed)
+    words = ['netflix', 'spotify', 'affitto', 'palestra', 'esselunga', 'coop', 'treno', 'pizza', 'abbonamento', 'mensile']
+    months = [201910, 201911, 201912, 202001, 202002, 202003, 202004, 202005]
+
+    dates = [months[m] * 100 + d for (m, d) in zip(rng.integers(0, len(months), rows), rng.integers(1, 29, rows))]
+
+    history = pd.DataFrame({
+        "id": ['e{i:04d}'.format(i=i) for i in range(rows)],
+        "amount": rng.choice([9.99, 20.0, 45.5, 700.0], rows),
+        "category": rng.choice(['SVAGO', 'FOOD', 'PALESTRA', 'CASA'], rows),
+        "date": dates,
+        "description": ['.'.join(rng.choice(words, rng.integers(1, 4))) if i % 3 == 0 else ' '.join(rng.choice(words, rng.integers(1, 4))) for i in range(rows)],
+        "monthly": [None if m < 0.4 else bool(m < 0.7) for m in rng.random(rows)],
+        "user": rng.choice(['a@x.com', 'b@x.com'], rows)
+    })
+    history['yearMonth'] = history['date'] // 100
+
+    return history.sort_values('date', kind='stable').reset_index(drop=True)
+
+@pytest.mark.parametrize('training', [True, False])
+def test_features_match_the_baseline(training):
+    history = fixture_history()
+
+    expected = baseline_features(history, training)
+
+    (names, features) = FeatureEngineering(None, history.drop(columns=['yearMonth']), 'cid', training=training).engineer(user='all')
+
+    features = features.assign(id=features['id'].astype(str)).set_index('id').sort_index()
+
+    assert names == MODEL_FEATURE_NAMES
+    assert features.index.tolist() == expected.index.tolist()
+    assert features[LOOKBACK_FEATURE_NAMES].astype(np.int64).equals(expected[LOOKBACK_FEATURE_NAMES].astype(np.int64))
+
+def test_overlap_chunks_do_not_change_the_features(monkeypatch):
+    store = MonthStore(compact_history(fixture_history()))
+    descriptions_bow = bow(store.df)
+    targets = np.flatnonzero(to_engineer(store.df, training=True))
+
+    expected = LookbackIndex(store.df, descriptions_bow).compute(targets)
+
+    monkeypatch.setattr(dlg.lookback, 'OVERLAP_CHUNK_SIZE', 7)
+
+    assert np.array_equal(LookbackIndex(store.df, descriptions_bow).compute(targets), expected)
+
+def test_bag_of_words_memory_ceiling():
+    # The documented size of the bag of words: nnz * 8 + (rows + 1) * 4 bytes (see the README)
+    history = fixture_history(rows=5000)
+    descriptions_bow = bow(compact_history(history))
+
+    assert descriptions_bow.shape[0] == len(history)
+    assert sparse_nbytes(descriptions_bow) == descriptions_bow.nnz * 8 + (len(history) + 1) * 4
+
+    # At most 3 words per description: at most 3 * 8 + 4 bytes per expense
+    assert sparse_nbytes(descriptions_bow) <= len(history) * 28 + 4
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+import requests
+
+import dlg.history as history
+from dlg.history import HistoryDownloader, HistoryDownloadError
+
+EXPENSES = [
+    {"id": "e1", "amount": 9.99, "category": "SVAGO", "date": "20200110", "description": "netflix", "monthly": True, "user": "user@x.com"},
+    {"id": "e2", "amount": 9.99, "category": "SVAGO", "date": "20200210", "description": "netflix", "monthly": True, "user": "user@x.com"},
+    {"id": "e3", "amount": 9.99, "category": "SVAGO", "date": "20200310", "description": "netflix", "monthly": None, "user": "user@x.com"}
+]
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{s}'.format(s=self.status_code), response=self)
+
+    def iter_content(self, chunk_size=1):
+        yield self.body
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+@pytest.fixture
+def api(monkeypatch):
+    '''
+    The expenses API, answering with the queued responses (status, body), then with all the expenses (ignoring the dates)
+    '''
+    calls = []
+    responses = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+
+        if len(responses) > 0:
+            (status, body) = responses.pop(0)
+            return Response(status, body)
+
+        return Response(200, json.dumps({"expenses": EXPENSES}).encode('utf-8'))
+
+    monkeypatch.setattr(history.session, 'get', get)
+    monkeypatch.setattr(history, 'DOWNLOAD_BACKOFF', 0)
+
+    return (calls, responses)
+
+def fetch(date_gte='20100101', date_lte=None):
+    return HistoryDownloader(None, 'cid').fetch_shard('all', date_gte, date_lte)
+
+@pytest.mark.parametrize('status', [500, 503, 429])
+def test_server_errors_are_retried(api, status):
+    (calls, responses) = api
+    responses.extend([(status, b''), (status, b'')])
+
+    assert len(fetch()) == 3
+    assert len(calls) == 3
+
+def test_connection_errors_are_retried(api, monkeypatch):
+    (calls, responses) = api
+    get = history.session.get
+
+    def flaky(url, **kwargs):
+        if len(calls) == 0:
+            calls.append(url)
+            raise requests.ConnectionError('reset')
+        return get(url, **kwargs)
+
+    monkeypatch.setattr(history.session, 'get', flaky)
+
+    assert len(fetch()) == 3
+    assert len(calls) == 2
+
+@pytest.mark.parametrize('status, body', [(404, b''), (200, b'{"expenses": [{"id": "e1", '), (200, b'{"other": []}')])
+def test_client_errors_and_malformed_responses_are_not_retried(api, status, body):
+    (calls, responses) = api
+    responses.append((status, body))
+
+    with pytest.raises(HistoryDownloadError):
+        fetch()
+
+    assert len(calls) == 1
+
+def test_failure_after_the_retries(api):
+    (calls, responses) = api
+    responses.extend([(502, b'')] * (history.DOWNLOAD_RETRIES + 1))
+
+    with pytest.raises(HistoryDownloadError):
+        fetch()
+
+    assert len(calls) == history.DOWNLOAD_RETRIES + 1
+
+def test_shard_dates_are_filtered(api):
+    assert fetch('20200201', '20200229')['id'].tolist() == ['e2']
+    assert fetch('20200201')['id'].tolist() == ['e2', 'e3']
+    assert fetch('20200401') is None
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+import pandas as pd
+
+from dlg.compact import compact_history
+from dlg.filelock import FileLock
+from dlg.historycache import HistoryCache
+
+def history(user, dates):
+    return compact_history(pd.DataFrame({
+        "id": ['{u}-{d}'.format(u=user, d=d) for d in dates],
+        "amount": [9.99] * len(dates),
+        "category": ['SVAGO'] * len(dates),
+        "date": dates,
+        "description": ['netflix'] * len(dates),
+        "monthly": [True] * len(dates),
+        "user": [user] * len(dates)
+    }))
+
+def test_user_entry_is_locked_between_processes(tmp_folder):
+    cache = HistoryCache(str(tmp_folder / 'cache'))
+    fetched = []
+
+    def fetch(date_gte):
+        fetched.append(date_gte)
+        return history('user@x.com', ['20200110'])
+
+    # Another process syncing the same user
+    other = FileLock('{f}/.lock'.format(f=cache._user_folder('user@x.com')))
+    other.acquire()
+
+    reader = threading.Thread(target=lambda: cache.get('user@x.com', '20200101', fetch))
+    reader.start()
+
+    time.sleep(0.3)
+
+    assert fetched == []
+
+    other.release()
+    reader.join(timeout=10)
+
+    assert fetched == ['20200101']
+
+def test_evicted_entry_keeps_its_lock(tmp_folder):
+    cache = HistoryCache(str(tmp_folder / 'cache'), max_bytes=0)
+
+    cache.get('a@x.com', '20200101', lambda date_gte: history('a@x.com', ['20200110']))
+    cache.get('b@x.com', '20200101', lambda date_gte: history('b@x.com', ['20200110']))
+
+    evicted = cache._user_folder('a@x.com')
+
+    assert sorted(os.listdir(evicted)) == ['.lock']
+    assert 'meta.json' in os.listdir(cache._user_folder('b@x.com'))
+
+    # Downloaded again in full
+    fetched = []
+    df = cache.get('a@x.com', '20200101', lambda date_gte: fetched.append(date_gte) or history('a@x.com', ['20200110']))
+
+    assert fetched == ['20200101']
+    assert df['id'].tolist() == ['a@x.com-20200110']
+
+def test_invalidate_all_drops_the_entries(tmp_folder):
+    cache = HistoryCache(str(tmp_folder / 'cache'))
+
+    cache.get('a@x.com', '20200101', lambda date_gte: history('a@x.com', ['20200110']))
+    cache.invalidate()
+
+    assert cache._read_meta(cache._user_folder('a@x.com')) is None
@@ -0,0 +1,129 @@
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from dlg.filelock import FileLock
+from model import jobs
+from model.jobs import JobQueue, lock_filename, read_status, write_status, run_job
+
+class FakeModel:
+    info = {"name": "erboh", "version": 1}
+    files = []
+
+@pytest.fixture
+def queue(monkeypatch):
+    '''
+    A job queue that records the jobs it runs instead of running them
+    '''
+    queue = JobQueue(workers=1, retention=3600, max_attempts=3)
+    queue.runs = []
+
+    monkeypatch.setattr(queue, '_run', lambda status, model: queue.runs.append(dict(status)))
+
+    return queue
+
+def job(status, owner='dead', attempts=1):
+    status = {"jobId": 'job-{s}-{o}-{a}'.format(s=status, o=owner, a=attempts), "kind": "predict-batch", "correlationId": "cid", "data": {"batchId": "b1"}, "submitted": time.time(), "status": status, "owner": owner, "stages": [], "attempts": attempts}
+    write_status(status)
+
+    return status
+
+def done(error=None):
+    future = Future()
+
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+    return future
+
+def test_resume_runs_the_orphaned_jobs(queue):
+    orphan = job('running')
+    job('done')
+    job('failed')
+
+    assert queue.resume(FakeModel()) == [orphan['jobId']]
+    assert queue.runs[0]['attempts'] == 2
+    assert queue.runs[0]['data'] == {"batchId": "b1"}
+
+def test_resume_skips_the_jobs_of_a_live_queue(queue):
+    live = FileLock(lock_filename('owner.alive'))
+    live.acquire()
+
+    try:
+        job('queued', owner='alive')
+
+        assert queue.resume(FakeModel()) == []
+    finally:
+        live.release()
+
+def test_resume_skips_the_running_jobs(queue):
+    running = job('running')
+
+    job_lock = FileLock(lock_filename(running['jobId']))
+    job_lock.acquire()
+
+    try:
+        assert queue.resume(FakeModel()) == []
+    finally:
+        job_lock.release()
+
+def test_resume_fails_the_jobs_without_attempts_left(queue):
+    orphan = job('running', attempts=3)
+
+    assert queue.resume(FakeModel()) == []
+    assert read_status(orphan['jobId'])['status'] == 'failed'
+
+def test_resume_skips_the_jobs_of_this_queue(queue):
+    queue._own()
+    job('queued', owner=queue.owner)
+
+    assert queue.resume(FakeModel()) == []
+
+def test_failed_job_is_run_again(queue):
+    failed = job('failed')
+
+    queue._check(done(), failed['jobId'], 'cid', FakeModel())
+
+    assert [run['attempts'] for run in queue.runs] == [2]
+
+def test_killed_job_is_run_again(queue):
+    queue.executor = 'broken'
+    killed = job('running')
+
+    queue._check(done(BrokenProcessPool('killed')), killed['jobId'], 'cid', FakeModel())
+
+    assert queue.executor is None
+    assert read_status(killed['jobId'])['status'] == 'failed'
+    assert [run['attempts'] for run in queue.runs] == [2]
+
+def test_failed_job_is_not_run_again_after_the_last_attempt(queue):
+    failed = job('failed', attempts=3)
+
+    queue._check(done(), failed['jobId'], 'cid', FakeModel())
+
+    assert queue.runs == []
+
+def test_done_job_is_not_run_again(queue):
+    ended = job('done')
+
+    queue._check(done(), ended['jobId'], 'cid', FakeModel())
+
+    assert queue.runs == []
+
+def test_job_runs_once_at_a_time():
+    running = job('running')
+
+    job_lock = FileLock(lock_filename(running['jobId']))
+    job_lock.acquire()
+
+    try:
+        run_job(running['jobId'], running['kind'], FakeModel.info, FakeModel.files, running['data'], 'cid')
+    finally:
+        job_lock.release()
+
+    assert read_status(running['jobId']) == running
+    assert jobs.current_job is None
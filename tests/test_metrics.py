@@ -0,0 +1,62 @@
+import sqlite3
+
+from dlg.metrics import MetricsStore
+
+def test_echo_counts_the_prediction_as_kept(tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics.sqlite'))
+
+    store.record_predictions(1, ['a', 'b'], [True, False])
+
+    # The echoes of the published predictions
+    assert store.record_labels(['a', 'b'], [True, False]) == 2
+    assert store.confusion(1) == {"tp": 1, "fp": 0, "fn": 0, "tn": 1}
+
+    # The user confirms a: already counted
+    assert store.record_labels(['a'], [True]) == 0
+    assert store.confusion(1) == {"tp": 1, "fp": 0, "fn": 0, "tn": 1}
+
+def test_user_correction_moves_the_kept_count(tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics.sqlite'))
+
+    store.record_predictions(1, ['a', 'b'], [True, False])
+    store.record_labels(['a', 'b'], [True, False])
+
+    # The user sets the other labels
+    assert store.record_labels(['a', 'b'], [False, True]) == 2
+    assert store.confusion(1) == {"tp": 0, "fp": 1, "fn": 1, "tn": 0}
+
+    # Not pending anymore
+    assert store.record_labels(['a', 'b'], [True, True]) == 0
+
+def test_suppressed_predictions_are_counted_on_the_user_label(tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics.sqlite'))
+
+    store.record_predictions(1, ['a', 'b'], [True, False], published=False)
+
+    assert store.record_labels(['a', 'b'], [True, True]) == 2
+    assert store.confusion(1) == {"tp": 1, "fp": 0, "fn": 1, "tn": 0}
+
+def test_suppressed_resend_keeps_the_pending_echo(tmp_path):
+    store = MetricsStore(str(tmp_path / 'metrics.sqlite'))
+
+    store.record_predictions(1, ['a'], [True])
+    store.record_predictions(1, ['a'], [True], published=False)
+
+    store.record_labels(['a'], [True])
+    store.record_labels(['a'], [False])
+
+    assert store.confusion(1) == {"tp": 0, "fp": 1, "fn": 0, "tn": 0}
+
+def test_store_created_before_the_echo_columns(tmp_path):
+    filename = str(tmp_path / 'metrics.sqlite')
+
+    connection = sqlite3.connect(filename)
+    connection.execute('CREATE TABLE pending (id TEXT PRIMARY KEY, version TEXT NOT NULL, predicted INTEGER NOT NULL, ts REAL NOT NULL)')
+    connection.execute("INSERT INTO pending VALUES ('old', '1', 1, 0)")
+    connection.commit()
+    connection.close()
+
+    store = MetricsStore(filename)
+
+    assert store.record_labels(['old'], [True]) == 1
+    assert store.confusion(1) == {"tp": 1, "fp": 0, "fn": 0, "tn": 0}
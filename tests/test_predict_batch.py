@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dlg.compact import compact_history
+from dlg.history import HistoryDownloader
+import model.predict_batch as predict_batch
+from model.predict_batch import BatchPredictor, BatchIncompleteError
+
+USERS = ['user{u}@x.com'.format(u=u) for u in range(4)]
+
+class Killed(Exception):
+    pass
+
+class MonthlyModel:
+    '''
+    Stand-in for the trained model: every expense occurs monthly
+    '''
+    def predict(self, X):
+        return np.ones(len(X), dtype=int)
+
+def fixture_history():
+    '''
+    12 months of expenses of every user: a monthly subscription (labeled) and a few unlabeled expenses
+    '''
+    rows = []
+
+    for (u, user) in enumerate(USERS):
+        for month in range(1, 13):
+            rows.append({"id": 'sub-{u}-{m}'.format(u=u, m=month), "amount": 9.99, "category": 'SVAGO', "date": '2019{m:02d}05'.format(m=month), "description": 'netflix', "monthly": month < 12, "user": user})
+            rows.append({"id": 'food-{u}-{m}'.format(u=u, m=month), "amount": 20.0 + month, "category": 'FOOD', "date": '2019{m:02d}12'.format(m=month), "description": 'coop', "monthly": None, "user": user})
+
+    return pd.DataFrame(rows).sort_values(by=['date'])
+
+@pytest.fixture
+def batch(monkeypatch):
+    '''
+    The history is downloaded from the fixture, and update_expenses() records what is published
+    '''
+    monkeypatch.delenv('TOTO_HISTORY_CACHE', raising=False)
+
+    downloads = []
+
+    def iter_shards(self, user, dateGte='20100101'):
+        downloads.append(user)
+        yield compact_history(fixture_history())
+
+    monkeypatch.setattr(HistoryDownloader, 'iter_shards', iter_shards)
+
+    published = []
+
+    def update_expenses(predictions, correlation_id, context='', event_publisher=None, model_version=None):
+        published.append(predictions['id'].astype(str).tolist())
+        return {"emitted": len(predictions), "suppressed": 0, "failed": 0}
+
+    monkeypatch.setattr(predict_batch, 'update_expenses', update_expenses)
+
+    return (downloads, published)
+
+def run(data):
+    return BatchPredictor().predict_all(MonthlyModel(), 'cid', 'PREDICT BATCH', data)
+
+def test_batch_killed_midway_resumes_without_publishing_twice(batch, monkeypatch):
+    (downloads, published) = batch
+    update_expenses = predict_batch.update_expenses
+
+    def killed_at_third_user(predictions, *args, **kwargs):
+        if len(published) == 2:
+            raise Killed()
+        return update_expenses(predictions, *args, **kwargs)
+
+    monkeypatch.setattr(predict_batch, 'update_expenses', killed_at_third_user)
+
+    with pytest.raises(Killed):
+        run({"batchId": "b1"})
+
+    completed = [id for ids in published for id in ids]
+
+    assert len(published) == 2
+
+    # Run again (e.g. the job resumed after the crash)
+    monkeypatch.setattr(predict_batch, 'update_expenses', update_expenses)
+
+    prediction = run({"batchId": "b1"})
+
+    resumed = [id for ids in published[2:] for id in ids]
+
+    assert len(published) == len(USERS)
+    assert set(completed).isdisjoint(resumed)
+    assert len(set(completed + resumed)) == len(completed) + len(resumed)
+    assert set(completed + resumed) == set(fixture_history().query('monthly.isnull()', engine='python')['id'])
+
+    # The history was downloaded once
+    assert downloads == ['all']
+    assert len(prediction.files) == 1
+
+def test_batch_with_unpublished_updates_fails(batch, monkeypatch):
+    (downloads, published) = batch
+
+    monkeypatch.setattr(predict_batch, 'update_expenses', lambda predictions, *args, **kwargs: {"emitted": 0, "suppressed": 0, "failed": len(predictions)})
+
+    with pytest.raises(BatchIncompleteError):
+        run({"batchId": "b2"})
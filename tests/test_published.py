@@ -0,0 +1,27 @@
+import sqlite3
+import threading
+import time
+
+from remote.published import PublishedStore
+
+def test_store_is_shared_between_processes(tmp_folder):
+    filename = str(tmp_folder / 'published.sqlite')
+    store = PublishedStore(filename)
+
+    assert store.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    # Another process writing: the store waits for it instead of failing with "database is locked"
+    other = sqlite3.connect(filename, check_same_thread=False)
+    other.execute('BEGIN IMMEDIATE')
+    other.execute("INSERT INTO labels (id, monthly) VALUES ('e0', 1)")
+
+    threading.Timer(0.5, other.commit).start()
+
+    # Readers are not blocked by the writer
+    assert store.labeled(['e0']) == {}
+
+    start = time.time()
+    store.record(['e1'], [True])
+
+    assert time.time() - start >= 0.4
+    assert store.labeled(['e0', 'e1']) == {"e0": True, "e1": True}
@@ -0,0 +1,94 @@
+import threading
+import time
+from concurrent.futures import Future
+
+from remote.publisher import BatchPublisher
+
+class FuturePublisher:
+    '''
+    Stand-in for the PubSubEventPublisher: publish() returns a future, that fails for the events with "fail",
+    and that completes only once released (to keep the batches in flight)
+    '''
+
+    def __init__(self, hold=False):
+        self.events = []
+        self.released = threading.Event()
+        self.lock = threading.Lock()
+
+        if not hold:
+            self.released.set()
+
+    def publish(self, topic, event):
+        future = Future()
+
+        with self.lock:
+            self.events.append(event)
+
+        def complete():
+            self.released.wait()
+
+            if event.get('fail'):
+                future.set_exception(RuntimeError('publish failed'))
+            else:
+                future.set_result('message-{id}'.format(id=event['id']))
+
+        threading.Thread(target=complete, daemon=True).start()
+
+        return future
+
+def test_failed_futures_are_counted():
+    publisher = BatchPublisher(FuturePublisher(), 'expensesToLabel', 'cid', batch_size=3, max_latency=10, max_in_flight=2)
+
+    events = [{"id": i, "fail": i in [1, 5]} for i in range(8)]
+
+    publisher.publish_all(events)
+    report = publisher.close()
+
+    assert report['published'] == 6
+    assert report['failed'] == 2
+    assert report['batches'] == 3
+    assert sorted([event['id'] for event in publisher.failed_events]) == [1, 5]
+    assert isinstance(publisher.error, RuntimeError)
+
+def test_batch_is_sent_after_max_latency():
+    stand_in = FuturePublisher()
+    publisher = BatchPublisher(stand_in, 'expensesToLabel', 'cid', batch_size=100, max_latency=0.2, max_in_flight=2)
+
+    publisher.publish({"id": 0})
+    publisher.publish({"id": 1})
+
+    time.sleep(0.05)
+    assert stand_in.events == []
+
+    time.sleep(0.5)
+    assert [event['id'] for event in stand_in.events] == [0, 1]
+    assert publisher.batches == 1
+
+    report = publisher.close()
+
+    assert report['published'] == 2
+    assert report['batches'] == 1
+
+def test_close_waits_for_the_batches_in_flight():
+    stand_in = FuturePublisher(hold=True)
+    publisher = BatchPublisher(stand_in, 'expensesToLabel', 'cid', batch_size=2, max_latency=10, max_in_flight=4)
+
+    publisher.publish_all([{"id": i} for i in range(5)])
+
+    reports = []
+    closing = threading.Thread(target=lambda: reports.append(publisher.close()))
+    closing.start()
+
+    time.sleep(0.3)
+
+    # The batches are all sent, but their futures have not completed
+    assert len(stand_in.events) == 5
+    assert closing.is_alive()
+    assert reports == []
+
+    stand_in.released.set()
+    closing.join(timeout=10)
+
+    assert reports[0]['published'] == 5
+    assert reports[0]['failed'] == 0
+    assert reports[0]['batches'] == 3
@@ -0,0 +1,90 @@
+import pandas as pd
+
+from dlg.compact import compact_history
+from dlg.snapshot import FeatureSnapshots, feature_snapshots
+
+def history(dates):
+    return compact_history(pd.DataFrame({
+        "id": ['e{i}'.format(i=i) for i in range(len(dates))],
+        "amount": [9.99] * len(dates),
+        "category": ['SVAGO'] * len(dates),
+        "date": dates,
+        "description": ['netflix'] * len(dates),
+        "monthly": [True] * len(dates),
+        "user": ['user@x.com'] * len(dates)
+    }))
+
+class Source:
+    '''
+    The history to download: builds the features (counting the builds) and probes the expenses from a date on
+    '''
+    def __init__(self, dates):
+        self.dates = dates
+        self.builds = 0
+        self.probes = []
+
+    def build(self):
+        self.builds += 1
+        h = history(self.dates)
+
+        return (['amount'], pd.DataFrame({"amount": h['amount'], "monthly": 1}), h)
+
+    def probe(self, date_gte):
+        self.probes.append(date_gte)
+        h = history([d for d in self.dates if d >= date_gte])
+
+        return h if len(h) > 0 else None
+
+def get(snapshots, source):
+    return snapshots.get(source.build, source.probe, 'cid')
+
+def test_unchanged_history_reuses_the_snapshot(tmp_folder):
+    snapshots = FeatureSnapshots(str(tmp_folder / 'snapshots'))
+    source = Source(['20200101', '20200105', '20200105'])
+
+    (names, features) = get(snapshots, source)
+    (names, reused) = get(snapshots, source)
+
+    assert source.builds == 1
+    assert source.probes == ['20200105']
+    assert reused.equals(features)
+
+def test_new_expense_invalidates_the_snapshot(tmp_folder):
+    snapshots = FeatureSnapshots(str(tmp_folder / 'snapshots'))
+    source = Source(['20200101', '20200105'])
+
+    get(snapshots, source)
+
+    # Same day, and a later one
+    source.dates.append('20200105')
+    get(snapshots, source)
+
+    source.dates.append('20200107')
+    get(snapshots, source)
+
+    assert source.builds == 3
+
+def test_label_change_invalidates_the_snapshot(tmp_folder):
+    snapshots = FeatureSnapshots(str(tmp_folder / 'snapshots'))
+    source = Source(['20200101', '20200105'])
+
+    get(snapshots, source)
+
+    snapshots.count_label_changes(2)
+
+    assert snapshots.label_changes() == 2
+
+    get(snapshots, source)
+    get(snapshots, source)
+
+    assert source.builds == 2
+
+def test_snapshots_are_enabled_by_default(monkeypatch):
+    monkeypatch.delenv('TOTO_FEATURE_SNAPSHOT_MAX_AGE', raising=False)
+    monkeypatch.delenv('TOTO_FEATURE_SNAPSHOTS', raising=False)
+
+    assert feature_snapshots().max_age == 24 * 3600
+
+    monkeypatch.setenv('TOTO_FEATURE_SNAPSHOT_MAX_AGE', '0')
+
+    assert feature_snapshots() is None
@@ -0,0 +1,59 @@
+import time
+import threading
+
+import warnings
+
+import numpy as np
+import pytest
+from sklearn.neural_network import MLPClassifier
+
+from dlg import trainer
+from dlg.trainer import Trainer, DEFAULT_PARAMS, fit_candidate, init_folds
+
+def dataset(n=600):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(n, 4))
+    y = (X[:, 0] + X[:, 1] > 0).astype(np.int64)
+
+    return (X, y)
+
+def test_candidate_stops_at_the_deadline():
+    (X, y) = dataset()
+    init_folds([(X, y, X, y)])
+
+    (model, score) = fit_candidate({"hidden_layer_sizes": (5, ), "alpha": 0.1}, 0, None, 50, time.time() - 1)
+
+    assert score is None
+
+    (model, score) = fit_candidate({"hidden_layer_sizes": (5, ), "alpha": 0.1}, 0, None, 50, time.time() + 60)
+
+    # As trained by fit() for the same epochs
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        expected = MLPClassifier(activation='identity', random_state=100, hidden_layer_sizes=(5, ), alpha=0.1, max_iter=50).fit(X, y)
+
+    assert len(model.loss_curve_) == len(expected.loss_curve_)
+    assert model.loss_curve_[-1] == pytest.approx(expected.loss_curve_[-1], rel=0.01)
+    assert score > 0.5
+
+def test_search_over_budget_leaves_no_candidate_running():
+    (X, y) = dataset()
+
+    start = time.time()
+    params = Trainer(None, None, [], 'cid', n_jobs=1, budget=0.01).search(X, y)
+
+    assert params == DEFAULT_PARAMS
+    assert time.time() - start < 5
+    assert [t for t in threading.enumerate() if t.name.startswith('ThreadPoolExecutor')] == []
+
+def test_search_in_budget():
+    (X, y) = dataset(n=150)
+
+    params = Trainer(None, None, [], 'cid', n_jobs=1, budget=600).search(X, y)
+
+    assert params['hidden_layer_sizes'] in trainer.PARAM_GRID['hidden_layer_sizes']
+    assert params['alpha'] in trainer.PARAM_GRID['alpha']
+
+def test_fit_raises_if_the_features_cant_be_read(tmp_folder):
+    with pytest.raises(FileNotFoundError):
+        Trainer(None, str(tmp_folder / 'missing.parquet'), ['amount'], 'cid', n_jobs=1).fit()